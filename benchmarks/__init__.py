@@ -0,0 +1,3 @@
+"""
+Microbenchmarks of resourcesync_push, see benchmarks.suite.
+"""
@@ -0,0 +1,6 @@
+from benchmarks.suite import main
+
+import sys
+
+
+sys.exit(main())
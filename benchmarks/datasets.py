@@ -0,0 +1,100 @@
+"""
+The synthetic datasets of the benchmarks. They are generated from a
+fixed seed, so that every run measures the same subscriptions and
+changelists.
+"""
+
+import random
+import time
+
+
+SEED = 20140501
+
+# subscribers per topic
+TOPIC_SIZE = 10
+
+# share of the subscriptions whose lease is over
+EXPIRED = 0.1
+
+CHANGES = ["created", "updated", "deleted"]
+
+URLSET = """<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"
+ xmlns:rs="http://www.openarchives.org/rs/terms/">
+%s
+</urlset>
+"""
+
+URL = """<url>
+<loc>%(loc)s</loc>
+<lastmod>%(lastmod)s</lastmod>
+<rs:md change="%(change)s" hash="md5:%(hash)s" length="%(length)s" \
+type="%(type)s" />
+</url>"""
+
+
+def topic_url(num):
+    return "http://publisher%d.example.org/resourcesync/topic/%d" % (
+        num % 100, num)
+
+
+def subscriptions(count, now=None):
+    """
+    A topic -> {callback: lease} dict of count subscriptions, with
+    TOPIC_SIZE subscribers per topic. The leases are relative to now, a
+    tenth of them are over.
+    """
+
+    rand = random.Random(SEED)
+    now = now or time.time()
+    subs = {}
+    for num in range(count):
+        topic = topic_url(num // TOPIC_SIZE)
+        callback = "http://subscriber%d.example.net/callback/%d" % (
+            rand.randint(0, 999), num)
+        if rand.random() < EXPIRED:
+            lease = now - rand.uniform(1, 86400)
+        else:
+            lease = now + rand.uniform(3600, 86400 * 30)
+        subs.setdefault(topic, {})[callback] = lease
+    return subs
+
+
+def changes(count):
+    """
+    The (lastmod, loc, md) arguments of count change notifications.
+    """
+
+    rand = random.Random(SEED + count)
+    entries = []
+    for num in range(count):
+        md = {
+            'change': rand.choice(CHANGES),
+            'hash': "%032x" % rand.getrandbits(128),
+            'length': str(rand.randint(100, 10 ** 7)),
+            'type': "text/html",
+        }
+        lastmod = "2014-05-%02dT%02d:%02d:%02dZ" % (
+            rand.randint(1, 31), rand.randint(0, 23), rand.randint(0, 59),
+            rand.randint(0, 59))
+        loc = "http://example.org/resource/%d/%d" % (rand.randint(0, 999),
+                                                     num)
+        entries.append((lastmod, loc, md))
+    return entries
+
+
+def changelist(count):
+    """
+    A ResourceSync change notification payload of count urls.
+    """
+
+    urls = []
+    for lastmod, loc, md in changes(count):
+        entry = dict(md, lastmod=lastmod, loc=loc)
+        urls.append(URL % entry)
+    return URLSET % "\n".join(urls)
+
+
+def link_header(num=0):
+    return "<%s>;rel=self, <http://localhost:8000/publish>;rel=hub" % \
+        topic_url(num)
@@ -0,0 +1,147 @@
+"""
+Times the benchmarks and writes their results as json, and compares
+the results of two runs.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+
+class Result(object):
+    """
+    The timings of a benchmark, in seconds per call. A call processes
+    ops items, such as subscriptions or urls.
+    """
+
+    def __init__(self, name, params, ops, number, times):
+        self.name = name
+        self.params = params
+        self.ops = ops
+        self.number = number
+        self.times = sorted(times)
+
+    def median(self):
+        middle = len(self.times) // 2
+        if len(self.times) % 2:
+            return self.times[middle]
+        return (self.times[middle - 1] + self.times[middle]) / 2.0
+
+    def mean(self):
+        return sum(self.times) / len(self.times)
+
+    def stdev(self):
+        mean = self.mean()
+        return (sum((value - mean) ** 2 for value in self.times) /
+                len(self.times)) ** 0.5
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'params': self.params,
+            'ops': self.ops,
+            'number': self.number,
+            'repeat': len(self.times),
+            'min': self.times[0],
+            'max': self.times[-1],
+            'median': self.median(),
+            'mean': self.mean(),
+            'stdev': self.stdev(),
+            'ops_per_second': self.ops / self.times[0] if self.times[0]
+            else None,
+        }
+
+
+def measure(func, repeat=5, min_time=0.2, max_number=1000000):
+    """
+    Calls func in loops long enough to last min_time seconds, repeat
+    times. Returns the number of calls per loop and the seconds per call
+    of each loop.
+    """
+
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= max_number:
+            break
+        # aim past min_time with the next loop.
+        number = min(max_number,
+                     max(number * 2, int(number * min_time * 1.2 /
+                                         max(elapsed, 1e-9))))
+
+    times = [elapsed / number]
+    times.extend(elapsed / number
+                 for elapsed in timer.repeat(repeat - 1, number))
+    return number, times
+
+
+def revision():
+    """
+    The git revision of the tree, or None outside of a checkout.
+    """
+
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+    """
+    The json serializable report of a run.
+    """
+
+    return {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'revision': revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'results': [result.as_dict() for result in results],
+    }
+
+
+def write_report(results, output):
+    data = json.dumps(report(results), indent=2, sort_keys=True)
+    if output == "-":
+        sys.stdout.write(data + "\n")
+        return
+    with open(output, "w") as report_file:
+        report_file.write(data + "\n")
+
+
+def result_key(result):
+    return "%s[%s]" % (result['name'], ",".join(
+        "%s=%s" % item for item in sorted(result['params'].items())))
+
+
+def compare(baseline, current, threshold=1.25):
+    """
+    Compares the fastest times of the benchmarks in two reports. Returns
+    the (key, baseline seconds, current seconds, ratio) of each
+    benchmark run in both, and the keys of the benchmarks slower than
+    threshold times the baseline.
+    """
+
+    previous = dict((result_key(result), result)
+                    for result in baseline['results'])
+    rows = []
+    regressions = []
+    for result in current['results']:
+        key = result_key(result)
+        if key not in previous:
+            continue
+        before = previous[key]['min']
+        ratio = result['min'] / before if before else None
+        rows.append((key, before, result['min'], ratio))
+        if ratio and ratio > threshold:
+            regressions.append(key)
+    return rows, regressions
@@ -0,0 +1,335 @@
+"""
+The microbenchmarks of the hub, publisher and subscriber internals.
+
+    python -m benchmarks --tier full --output results.json
+    python -m benchmarks --compare results.json
+
+Each benchmark group sets up its datasets once and yields the calls to
+time. The hub benchmarks run against a subscription store in a
+temporary directory, with a config file of their own, and deliver the
+notifications inline to stand-in subscribers on localhost.
+"""
+
+from resourcesync_push import ResourceSyncPuSH
+from resourcesync_push.hub import hub as hub_app
+from resourcesync_push.hub.hub import Hub, HubContext
+from resourcesync_push.loadgen import StandInSubscribers
+from resourcesync_push.publisher.publisher import Publisher
+
+from benchmarks import datasets
+from benchmarks.harness import Result, measure, write_report, compare, \
+    result_key
+
+from contextlib import contextmanager
+from StringIO import StringIO
+
+import argparse
+import functools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+TIERS = {
+    'quick': {'subscriptions': [1000, 10000], 'changelists': [1, 100]},
+    'full': {'subscriptions': [1000, 100000, 1000000],
+             'changelists': [1, 100, 10000]},
+}
+
+HUB_CONFIG = """[general]
+log_mode=
+
+[hub]
+url=http://localhost:8000/
+mimetypes=application/xml
+subscription_store=%(store)s
+subscribers_file=%(prefix)s.pk
+subscriptions_db=%(prefix)s.db
+delivery=inline
+dead_letter_file=%(prefix)s-dead_letters.log
+lease_sweep_interval=86400
+metrics=false
+"""
+
+# the benchmark groups, as (names, function) in the order they run
+BENCHMARKS = []
+
+
+def benchmark(*names):
+    """
+    Registers a benchmark group yielding the benchmarks names.
+    """
+
+    def register(func):
+        BENCHMARKS.append((names, func))
+        return func
+    return register
+
+
+class Workspace(object):
+    """
+    The temporary directory of a run, and the hub contexts opened in it.
+    """
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="resourcesync_bench")
+        self.contexts = []
+
+    def hub_context(self, store, count, subscriptions=None):
+        """
+        A hub context with its own config, whose store holds the
+        synthetic dataset of count subscriptions, with the topics of
+        the subscriptions dict replaced.
+        """
+
+        prefix = os.path.join(self.directory, "%s-%s" % (store, count))
+        config_file = prefix + ".ini"
+        with open(config_file, "w") as cnf_file:
+            cnf_file.write(HUB_CONFIG % {'store': store, 'prefix': prefix})
+
+        context = HubContext("hub", config_files=[config_file])
+        self.contexts.append(context)
+        dataset = datasets.subscriptions(count)
+        dataset.update(subscriptions or {})
+        Hub(context=context).save_subscriptions(dataset)
+        return context
+
+    def close_context(self, context):
+        context.close()
+        self.contexts.remove(context)
+
+    def close(self):
+        for context in list(self.contexts):
+            self.close_context(context)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def wsgi_call(app, method, path, body="", headers=None, expect="200"):
+    """
+    A function calling the WSGI app with a request, which checks the
+    status of the response on the first call.
+    """
+
+    checked = []
+
+    def start_response(status, response_headers):
+        if not checked:
+            if not status.startswith(expect):
+                raise AssertionError("%s %s: %s, expected %s" % (
+                    method, path, status, expect))
+            checked.append(status)
+
+    def call():
+        env = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'SERVER_NAME': "localhost",
+            'SERVER_PORT': "8000",
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+        }
+        env.update(headers or {})
+        return "".join(app(env, start_response))
+
+    return call
+
+
+@benchmark("save_subscriptions", "read_subscriptions")
+def bench_store(workspace, sizes):
+    for store in ["sqlite", "pickle"]:
+        for count in sizes['subscriptions']:
+            context = workspace.hub_context(store, count)
+            hub = Hub(context=context)
+            subscriptions = datasets.subscriptions(count)
+            params = {'store': store, 'subscriptions': count}
+            yield ("save_subscriptions", params, count,
+                   lambda: hub.save_subscriptions(subscriptions))
+            yield ("read_subscriptions", params, count,
+                   hub.read_subscriptions)
+            workspace.close_context(context)
+
+
+@benchmark("verify_lease")
+def bench_verify_lease(workspace, sizes):
+    context = workspace.hub_context("pickle", 0)
+    hub = Hub(context=context)
+    for count in sizes['subscriptions']:
+        subscriptions = datasets.subscriptions(count)
+        yield ("verify_lease", {'subscriptions': count}, count,
+               lambda: hub.verify_lease(subscriptions))
+    workspace.close_context(context)
+
+
+@benchmark("get_topic_hub_url", "make_link_header")
+def bench_link_header(workspace, sizes):
+    link_header = datasets.link_header()
+    yield ("get_topic_hub_url", {}, 1,
+           lambda: ResourceSyncPuSH.get_topic_hub_url(link_header))
+
+    base = ResourceSyncPuSH()
+    topic_url = datasets.topic_url(0)
+    yield ("make_link_header", {}, 1,
+           lambda: base.make_link_header(
+               hub_url="http://localhost:8000/publish", topic_url=topic_url))
+
+
+@benchmark("create_change_notification")
+def bench_change_notification(workspace, sizes):
+    publisher = Publisher({}, None)
+    for count in sizes['changelists']:
+        changes = datasets.changes(count)
+
+        def create(changes=changes):
+            for lastmod, loc, md in changes:
+                publisher.create_change_notification(lastmod=lastmod,
+                                                     loc=loc, md=md)
+        yield ("create_change_notification", {'urls': count}, count, create)
+
+
+@benchmark("hub_application")
+def bench_hub_application(workspace, sizes):
+    # the topic published to has TOPIC_SIZE stand-in subscribers, so a
+    # publish measures parsing the request, reading the subscribers and
+    # handing the notifications to the dispatcher; they are sent from
+    # the transport threads meanwhile.
+    subscribers = StandInSubscribers(datasets.TOPIC_SIZE)
+    lease = time.time() + 86400
+    subscriptions = {datasets.topic_url(0): dict(
+        (subscribers.callback(num), lease)
+        for num in range(datasets.TOPIC_SIZE))}
+    try:
+        for result in hub_application(workspace, sizes, subscriptions):
+            yield result
+    finally:
+        subscribers.close()
+
+
+def hub_application(workspace, sizes, subscriptions):
+    for count in sizes['subscriptions']:
+        context = workspace.hub_context("sqlite", count, subscriptions)
+        app = functools.partial(hub_app.application, context=context)
+        params = {'request': "unknown", 'subscriptions': count}
+        yield ("hub_application", params, 1,
+               wsgi_call(app, "GET", "/unknown", expect="404"))
+
+        params = {'request': "register", 'subscriptions': count}
+        yield ("hub_application", params, 1,
+               wsgi_call(app, "GET", "/register"))
+
+        for urls in sizes['changelists']:
+            params = {'request': "publish", 'subscriptions': count,
+                      'urls': urls, 'delivery': "inline"}
+            headers = {'CONTENT_TYPE': "application/xml",
+                       'HTTP_LINK': datasets.link_header()}
+            yield ("hub_application", params, urls,
+                   wsgi_call(app, "POST", "/publish",
+                             body=datasets.changelist(urls),
+                             headers=headers, expect="204"))
+        workspace.close_context(context)
+
+
+def run(sizes, names=None, repeat=5, min_time=0.2, progress=None):
+    """
+    Runs the benchmarks, or only the ones whose name contains one of
+    names. Returns the list of their results.
+    """
+
+    def selected(name):
+        return not names or any(part in name for part in names)
+
+    results = []
+    workspace = Workspace()
+    try:
+        for group_names, group in BENCHMARKS:
+            if not any(selected(name) for name in group_names):
+                continue
+            for name, params, ops, func in group(workspace, sizes):
+                if not selected(name):
+                    continue
+                number, times = measure(func, repeat=repeat,
+                                        min_time=min_time)
+                result = Result(name, params, ops, number, times)
+                results.append(result)
+                if progress:
+                    progress(result)
+    finally:
+        workspace.close()
+    return results
+
+
+@contextmanager
+def quiet():
+    """
+    Silences the log records printed by the apps while benchmarking.
+    """
+
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def print_result(result):
+    result = result.as_dict()
+    sys.stderr.write("%-70s %12.3f us %14.1f ops/s\n" % (
+        result_key(result), result['min'] * 1e6,
+        result['ops_per_second'] or 0))
+
+
+def sizes_option(value):
+    return [int(size) for size in value.split(",") if size]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Microbenchmarks of resourcesync_push.")
+    parser.add_argument("--tier", choices=sorted(TIERS), default="quick",
+                        help="the dataset sizes to run with")
+    parser.add_argument("--subscriptions", type=sizes_option,
+                        help="comma separated numbers of subscriptions")
+    parser.add_argument("--changelists", type=sizes_option,
+                        help="comma separated numbers of changelist urls")
+    parser.add_argument("--filter", action="append", dest="names",
+                        help="only run the benchmarks whose name contains "
+                        "this, can be repeated")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum seconds per timing loop")
+    parser.add_argument("--output", "-o", default="-",
+                        help="file to write the json results to")
+    parser.add_argument("--compare",
+                        help="json results of a previous run to compare to")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    sizes = dict(TIERS[args.tier])
+    if args.subscriptions:
+        sizes['subscriptions'] = args.subscriptions
+    if args.changelists:
+        sizes['changelists'] = args.changelists
+
+    with quiet():
+        results = run(sizes, names=args.names, repeat=args.repeat,
+                      min_time=args.min_time, progress=print_result)
+    write_report(results, args.output)
+
+    if not args.compare:
+        return 0
+
+    with open(args.compare) as baseline_file:
+        baseline = json.load(baseline_file)
+    current = {'results': [result.as_dict() for result in results]}
+    rows, regressions = compare(baseline, current, args.threshold)
+    for key, before, after, ratio in rows:
+        sys.stderr.write("%-70s %12.3f us -> %12.3f us %6.2fx%s\n" % (
+            key, before * 1e6, after * 1e6, ratio or 0,
+            " REGRESSION" if key in regressions else ""))
+    return 1 if regressions else 0
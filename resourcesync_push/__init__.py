@@ -4,9 +4,12 @@ methods for reading config files, making http requests, error handling,
 etc.
 """
 
-from requests_futures.sessions import FuturesSession
+from resourcesync_push.transport import Transport
+from resourcesync_push.logger import make_record
+from resourcesync_push.profiling import profiler
+from resourcesync_push.hub.allowlist import TopicList, AddressList, \
+    parse_list
 from requests.utils import parse_header_links
-from requests.adapters import HTTPAdapter
 import ConfigParser
 from ConfigParser import NoOptionError, NoSectionError
 import os
@@ -15,6 +18,7 @@ import json
 
 HTTP_STATUS_CODE = {
     200: "OK",
+    202: "Accepted",
     204: "No Content",
     302: "Found",
     400: "Bad Request",
@@ -23,9 +27,22 @@ HTTP_STATUS_CODE = {
     405: "Method Not Allowed",
     406: "Not Acceptable",
     409: "Conflict",
+    413: "Request Entity Too Large",
+    429: "Too Many Requests",
     500: "Unexpected server error",
+    503: "Service Unavailable",
 }
 
+# NOTE: more paths can be added to look for the config files.
+# order of files matter, the config in the first file
+# will be overwritten by the values in the next file.
+CONFIG_FILES = [
+    os.path.join(os.path.dirname(__file__),
+                 "../conf/resourcesync_push.ini"),
+    "/etc/resourcesync_push.ini",
+    "/etc/resourcesync_push/resourcesync_push.ini",
+]
+
 
 class ResourceSyncPuSH(object):
     """
@@ -34,36 +51,47 @@ class ResourceSyncPuSH(object):
     etc.
     """
 
-    def __init__(self):
+    # the config files read by get_config
+    config_files = CONFIG_FILES
+
+    def __init__(self, context=None):
         """
-        Inititalizes the Futures-Requests session with the
-        max number of workers and retires.
+        Inititalizes the config and logging values. If an application
+        context is given, its transport and config are shared instead.
         """
 
-        # max workers and retries should be configurable?
-        self.session = FuturesSession(max_workers=10)
-        adapter = HTTPAdapter(max_retries=3)
-        self.session.mount("http://", adapter)
         self._start_response = None
 
+        # logging messages
+        self.log_msg = {}
+        self.log_msg['payload'] = ""
+        self.log_msg['msg'] = []
+        self.log_msg['link_header'] = ""
+        self.log_msg['module'] = ""
+
+        if context:
+            self._transport = context.transport
+            self._log_shipper = context.log_shipper
+            self.config = context.config
+            self.log_msg['module'] = context.classname
+            return
+
+        # created on first use, from the config read by get_config
+        self._transport = None
+        self._log_shipper = None
+
         # config parameters
         self.config = {}
         self.config['log_mode'] = ""
         self.config['mimetypes'] = []
-        self.config['trusted_publishers'] = []
-        self.config['trusted_topics'] = []
+        self.config['trusted_publishers'] = AddressList()
+        self.config['trusted_topics'] = TopicList()
         self.config['my_url'] = ""
         self.config['hub_url'] = ""
         self.config['topic_url'] = ""
         self.config['subscribers_file'] = ""
         self.config['server_path'] = ""
-
-        # logging messages
-        self.log_msg = {}
-        self.log_msg['payload'] = ""
-        self.log_msg['msg'] = []
-        self.log_msg['link_header'] = ""
-        self.log_msg['module'] = ""
+        self.config['transport'] = {}
 
     def get_config(self, classname=None):
         """
@@ -77,20 +105,9 @@ class ResourceSyncPuSH(object):
 
         self.log_msg['module'] = classname
 
-        # NOTE: more paths can be added to look for the config files.
-        # order of files matter, the config in the first file
-        # will be overwritten by the values in the next file.
-        cnf_file = []
-        cnf_file.extend([
-            os.path.join(os.path.dirname(__file__),
-                         "../conf/resourcesync_push.ini"),
-            "/etc/resourcesync_push.ini",
-            "/etc/resourcesync_push/resourcesync_push.ini",
-        ])
-
         # loading values from configuration file
         conf = ConfigParser.ConfigParser()
-        conf.read(cnf_file)
+        conf.read(self.config_files)
         if not conf:
             raise IOError("Unable to read config file")
 
@@ -106,8 +123,69 @@ class ResourceSyncPuSH(object):
                       in the config file.")
                 raise
 
+        self.get_transport_config(conf, classname)
+        self.get_options(conf, "general", [
+            ("max_body_size", "getint", 16777216),
+            ("spool_size", "getint", 1048576),
+            # log shipping
+            ("log_queue_size", "getint", 10000),
+            ("log_batch_size", "getint", 100),
+            ("log_flush_interval", "getfloat", 1),
+            ("log_payload_max", "getint", 256),
+            ("log_topic_rate", "getint", 0),
+            ("log_sample_rate", "getfloat", 0.01),
+            # profiling
+            ("profiling", "getboolean", False),
+            ("profiling_file", "get", os.path.join(
+                os.path.dirname(__file__), "../db/profiling.log")),
+            ("profiling_max_bytes", "getint", 10485760),
+            ("profiling_backups", "getint", 5),
+            ("profile_every", "getint", 0),
+            ("profile_dir", "get", os.path.join(
+                os.path.dirname(__file__), "../db/profiles")),
+        ])
         self.get_demo_config(conf)
 
+    def get_transport_config(self, conf, classname):
+        """
+        Reads the http transport options. The values in the [general]
+        section apply to all the modules and can be overridden in the
+        section of the classname.
+        """
+
+        options = {
+            'max_workers': conf.getint,
+            'max_retries': conf.getint,
+            'pool_connections': conf.getint,
+            'pool_maxsize': conf.getint,
+            'connect_timeout': conf.getfloat,
+            'read_timeout': conf.getfloat,
+            'keep_alive': conf.getboolean,
+        }
+
+        transport = {}
+        for section in ["general", classname]:
+            for option, get_value in options.items():
+                try:
+                    if conf.get(section, option).strip():
+                        transport[option] = get_value(section, option)
+                except (NoSectionError, NoOptionError):
+                    pass
+
+            # host:size pairs separated by a ,
+            try:
+                host_pool_maxsize = conf.get(section, "host_pool_maxsize")
+            except (NoSectionError, NoOptionError):
+                continue
+            transport['host_pool_maxsize'] = {}
+            for host_size in host_pool_maxsize.split(","):
+                if not host_size.strip():
+                    continue
+                host, size = host_size.strip().rsplit(":", 1)
+                transport['host_pool_maxsize'][host] = int(size)
+
+        self.config['transport'] = transport
+
     def get_demo_config(self, conf):
         """
         Reads the [demo_hub] section from the config file if the
@@ -141,24 +219,29 @@ class ResourceSyncPuSH(object):
         Reads the [hub] section from the config file.
         """
 
+        # the allowlists are parsed once into sets, an empty one allows
+        # any value.
         try:
-            self.config['mimetypes'] = conf.get("hub", "mimetypes")
+            mimetypes = conf.get("hub", "mimetypes")
         except (NoSectionError, NoOptionError):
             # reourcesync hub by default
-            self.config['mimetypes'] = "application/xml"
+            mimetypes = "application/xml"
+        self.config['mimetypes'] = frozenset(
+            mimetype.lower() for mimetype in parse_list(mimetypes))
 
         try:
-            self.config['trusted_publishers'] = conf.get("hub",
-                                                         "trusted_publishers")
+            self.config['trusted_publishers'] = AddressList(
+                conf.get("hub", "trusted_publishers"))
         except (NoSectionError, NoOptionError):
             # will allow any publisher
-            self.config['trusted_publishers'] = []
+            self.config['trusted_publishers'] = AddressList()
 
         try:
-            self.config['trusted_topics'] = conf.get("hub", "trusted_topics")
+            self.config['trusted_topics'] = TopicList(
+                conf.get("hub", "trusted_topics"))
         except (NoSectionError, NoOptionError):
             # will accept any topic
-            self.config['trusted_topics'] = []
+            self.config['trusted_topics'] = TopicList()
 
         try:
             self.config['my_url'] = conf.get("hub", "url")
@@ -179,8 +262,84 @@ class ResourceSyncPuSH(object):
         if not os.path.isfile(self.config['subscribers_file']):
             open(self.config['subscribers_file'], 'a').close()
 
+        db_dir = os.path.join(os.path.dirname(__file__), "../db")
+        self.get_options(conf, "hub", [
+            # subscription store
+            ("subscription_store", "get", "sqlite"),
+            ("subscriptions_db", "get",
+             os.path.join(db_dir, "subscriptions.db")),
+            ("lease_sweep_interval", "getfloat", 60),
+            ("shared_index", "getboolean", False),
+            ("shared_index_interval", "getfloat", 1),
+            ("shared_index_file", "get",
+             os.path.join(db_dir, "subscriptions.idx")),
+            ("pattern_subscriptions", "getboolean", True),
+            ("pattern_refresh_interval", "getfloat", 1),
+            # verification
+            ("verify_workers", "getint", 4),
+            ("verify_max_pending", "getint", 10000),
+            ("verify_timeout", "getfloat", 10),
+            ("verify_max_attempts", "getint", 3),
+            ("verify_retry_delay", "getfloat", 5),
+            ("bulk_max_subscriptions", "getint", 1000),
+            # admission control
+            ("publisher_rate", "getfloat", 0),
+            ("publisher_burst", "getfloat", 10),
+            ("topic_rate", "getfloat", 0),
+            ("topic_burst", "getfloat", 10),
+            ("rate_limit_file", "get",
+             os.path.join(db_dir, "ratelimit.bin")),
+            ("rate_limit_slots", "getint", 65536),
+            ("max_inflight_bytes", "getint", 0),
+            ("overload_retry_after", "getfloat", 5),
+            # delivery
+            ("fetch_max_pending", "getint", 1000),
+            ("feed_cache_size", "getint", 1000),
+            ("fetch_debounce", "getfloat", 0),
+            ("aggregation_window", "getfloat", 0),
+            ("aggregation_max_urls", "getint", 1000),
+            ("aggregation_max_bytes", "getint", 1048576),
+            ("dedup_window", "getfloat", 0),
+            ("dedup_cache_size", "getint", 10000),
+            ("delivery", "get", "inline"),
+            ("delivery_queue_file", "get",
+             os.path.join(db_dir, "delivery.db")),
+            ("delivery_visibility_timeout", "getfloat", 300),
+            ("delivery_engine", "get", "threads"),
+            ("async_max_concurrency", "getint", 1000),
+            ("async_max_per_host", "getint", 100),
+            ("retry_max_attempts", "getint", 5),
+            ("retry_base_delay", "getfloat", 1),
+            ("retry_max_delay", "getfloat", 300),
+            ("circuit_failure_threshold", "getint", 5),
+            ("circuit_reset_timeout", "getfloat", 60),
+            ("dead_letter_file", "get",
+             os.path.join(db_dir, "dead_letters.log")),
+            # metrics
+            ("metrics", "getboolean", True),
+            ("metrics_dir", "get", os.path.join(db_dir, "metrics")),
+            ("metrics_interval", "getfloat", 5),
+        ])
+
         return
 
+    def get_options(self, conf, section, options):
+        """
+        Reads optional values from a section of the config file. The
+        options are (name, type, default) tuples, where type is the
+        ConfigParser method that reads the value. Missing and blank
+        values are set to the default.
+        """
+
+        for name, value_type, default in options:
+            self.config[name] = default
+            try:
+                if conf.get(section, name).strip():
+                    self.config[name] = getattr(conf, value_type)(section,
+                                                                  name)
+            except (NoSectionError, NoOptionError):
+                pass
+
     def get_publisher_config(self, conf):
         """
         Reads the [publisher] section in the config file.
@@ -212,6 +371,17 @@ class ResourceSyncPuSH(object):
                   in the config file.")
             raise
 
+    @property
+    def transport(self):
+        """
+        The http transport, created from the transport config on first
+        use.
+        """
+
+        if not self._transport:
+            self._transport = Transport(**self.config['transport'])
+        return self._transport
+
     def send(self, url, method='POST',
              data=None,
              callback=None,
@@ -221,19 +391,11 @@ class ResourceSyncPuSH(object):
         to make (threaded) async requests.
         """
 
-        if method == 'POST':
-            return self.session.post(url,
-                                     data=data,
-                                     background_callback=callback,
-                                     headers=headers)
-        elif method == 'GET':
-            return self.session.get(url,
-                                    headers=headers)
-        elif method == 'HEAD':
-            return self.session.head(url,
-                                     headers=headers)
-        else:
-            return
+        return self.transport.send(url,
+                                   method=method,
+                                   data=data,
+                                   callback=callback,
+                                   headers=headers)
 
     def respond(self, code=200, msg="OK", headers=None):
         """
@@ -260,7 +422,8 @@ class ResourceSyncPuSH(object):
         headers and return the topic and hub urls.
         """
 
-        links = parse_header_links(link_header)
+        with profiler.span("parse_link_header"):
+            links = parse_header_links(link_header)
         topic = ""
         hub_url = ""
         for link in links:
@@ -286,17 +449,35 @@ class ResourceSyncPuSH(object):
 
     def log(self):
         """
-        Log handler. Will send the log info as json to the
-        demo hub if log_mode value is set to demo in the config file.
+        Log handler. Queues the log record for the log shipper of the
+        app context, which prints the records as json lines, or sends
+        them as json to the demo hub if log_mode value is set to demo in
+        the config file. The record only holds the size, the sha1 and
+        the start of the payload.
+        Without a context the record is written at once.
         """
+
+        if self._log_shipper:
+            return self._log_shipper.ship(self.log_msg)
+
+        record = make_record(self.log_msg,
+                             payload_max=self.config.get('log_payload_max',
+                                                         256))
         if self.config['log_mode'] == 'demo':
-            headers = {}
-            headers['Link'] = self.make_link_header(
-                hub_url=self.config['demo_hub_url'],
-                topic_url=self.config['demo_topic_url']
-            )
-            self.send(self.config['demo_hub_url'],
-                      data=json.dumps(self.log_msg),
-                      headers=headers)
+            self.post_log(json.dumps([record]))
         else:
-            print(self.log_msg)
+            print(json.dumps(record))
+
+    def post_log(self, data):
+        """
+        Sends a json list of log records to the demo hub.
+        """
+
+        headers = {}
+        headers['Link'] = self.make_link_header(
+            hub_url=self.config['demo_hub_url'],
+            topic_url=self.config['demo_topic_url']
+        )
+        return self.send(self.config['demo_hub_url'],
+                         data=data,
+                         headers=headers)
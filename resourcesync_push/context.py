@@ -0,0 +1,193 @@
+"""
+The process-lifetime application context. Holds the parsed config, the
+http transport and the routing data of the hub, publisher and subscriber
+apps so that they are built once per worker process and reused by every
+request.
+"""
+
+from resourcesync_push import ResourceSyncPuSH
+from resourcesync_push.transport import Transport
+from resourcesync_push.logger import LogShipper
+from resourcesync_push.profiling import profiler
+
+import os
+import threading
+import time
+import urlparse
+
+
+class AppContext(ResourceSyncPuSH):
+    """
+    The long-lived state of a WSGI app in a worker process. The config
+    files are re-read when their modification time changes.
+    """
+
+    log_shipper = None
+
+    # seconds between two checks of the config files' modification time.
+    reload_interval = 1.0
+
+    _contexts = {}
+    _contexts_lock = threading.Lock()
+
+    def __init__(self, classname, config_files=None):
+        ResourceSyncPuSH.__init__(self)
+        self.classname = classname
+        if config_files:
+            self.config_files = config_files
+        self.pid = os.getpid()
+        self.server_path = ""
+        self.topic_path = "/"
+
+        self._lock = threading.Lock()
+        self._mtimes = None
+        self._checked = 0
+        self._log_settings = None
+        self.load()
+
+    @classmethod
+    def get(cls, classname):
+        """
+        Returns the context for the classname in this process, creating
+        it on first use. A new context is created after a fork, as the
+        thread pool of the transport does not survive it.
+        """
+
+        pid = os.getpid()
+        key = (cls, classname)
+        context = cls._contexts.get(key)
+        if not context or context.pid != pid:
+            with cls._contexts_lock:
+                context = cls._contexts.get(key)
+                if not context or context.pid != pid:
+                    context = cls(classname)
+                    cls._contexts[key] = context
+        context.refresh()
+        return context
+
+    def config_mtimes(self):
+        """
+        The modification times of the config files, None for the files
+        that do not exist.
+        """
+
+        mtimes = []
+        for cnf_file in self.config_files:
+            try:
+                mtimes.append(os.stat(cnf_file).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def load(self):
+        """
+        Reads the config files and precomputes the routing data. The new
+        config replaces the old one in a single assignment, so requests
+        in flight keep using the config they started with.
+        """
+
+        start = time.time()
+        mtimes = self.config_mtimes()
+
+        loader = ResourceSyncPuSH()
+        loader.config_files = self.config_files
+        loader.get_config(self.classname)
+        config = loader.config
+
+        server_path = config.get('server_path', "")
+        topic_path = urlparse.urlparse(config.get('topic_url', "")).path
+        if server_path:
+            topic_path = topic_path.replace(server_path, "")
+        if not topic_path.startswith("/"):
+            topic_path = "/" + topic_path
+
+        if not self._transport or \
+                config['transport'] != self.config['transport']:
+            # the handlers and background threads built with the old
+            # transport keep sending with it; it is not closed, and is
+            # collected once they let go of it.
+            self._transport = Transport(**config['transport'])
+
+        self.config = config
+        profiler.configure(config)
+        profiler.record("config_load", start, time.time() - start)
+        self.update_log_shipper()
+        self.server_path = server_path
+        self.topic_path = topic_path
+        self._mtimes = mtimes
+        self._checked = time.time()
+
+    def update_log_shipper(self):
+        """
+        Replaces the log shipper when the log settings have changed. The
+        old one writes its queued records and stops.
+        """
+
+        settings = tuple(self.config.get(name) for name in [
+            'log_mode', 'demo_hub_url', 'demo_topic_url', 'log_queue_size',
+            'log_batch_size', 'log_flush_interval', 'log_payload_max',
+            'log_topic_rate', 'log_sample_rate'])
+        if self.log_shipper and self._log_settings == settings:
+            return
+
+        post = None
+        if self.config['log_mode'] == 'demo':
+            post = self.post_log
+        shipper = self.log_shipper
+        self.log_shipper = LogShipper.from_config(self.config, post=post)
+        self._log_settings = settings
+        if shipper:
+            shipper.stop()
+
+    def refresh(self):
+        """
+        Reloads the config if one of the config files has changed since
+        it was last read. Checks at most once every reload_interval
+        seconds.
+        """
+
+        now = time.time()
+        if now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+
+        if self.config_mtimes() == self._mtimes:
+            return
+
+        with self._lock:
+            if self.config_mtimes() == self._mtimes:
+                return
+            try:
+                self.load()
+            except Exception as err:
+                # keep serving with the last good config.
+                print("Error reloading config: %s" % err)
+                self._mtimes = self.config_mtimes()
+
+    def close(self):
+        """
+        Writes the queued log records and stops the http transport.
+        """
+
+        if self.log_shipper:
+            while self.log_shipper.flush():
+                pass
+            self.log_shipper.stop()
+        if self._transport:
+            self._transport.close()
+
+    def request_path(self, env):
+        """
+        Returns the path of the request relative to the server path.
+        """
+
+        req_path = env.get('PATH_INFO', "/")
+
+        # replace server path
+        if self.server_path:
+            req_path = req_path.replace(self.server_path, "")
+
+        if not req_path.startswith("/"):
+            req_path = "/" + req_path
+
+        return req_path
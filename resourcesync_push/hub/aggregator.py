@@ -0,0 +1,163 @@
+"""
+Merges the ResourceSync notifications posted for a topic within a time
+window into a single notification per subscriber.
+"""
+
+from resourcesync_push.hub.delivery import RetryTimer
+from resourcesync_push.metrics import metrics
+
+import re
+import threading
+
+
+URL_START = re.compile(r"<url[\s>]")
+URL_END = "</url>"
+UNTIL = re.compile(r"""\buntil=("[^"]*"|'[^']*')""")
+
+
+def split_urlset(payload):
+    """
+    Splits a urlset document into the text before the first <url>, the
+    <url> entries and the text after the last one. Returns None if the
+    payload has no <url> entries.
+    """
+
+    start = URL_START.search(payload)
+    end = payload.rfind(URL_END)
+    if not start or end < start.start():
+        return None
+    end += len(URL_END)
+    return payload[:start.start()], payload[start.start():end], payload[end:]
+
+
+class Batch(object):
+    """
+    The <url> entries of the notifications of a topic waiting for the
+    end of the window.
+    """
+
+    def __init__(self, head, tail, headers):
+        self.head = head
+        self.tail = tail
+        self.headers = headers
+        self.entries = []
+        self.urls = 0
+        self.size = len(head) + len(tail)
+
+    def add(self, head, entries):
+        # the merged changes run until the end of the last notification
+        until = UNTIL.search(head)
+        if until:
+            self.head = UNTIL.sub("until=" + until.group(1), self.head, 1)
+        self.entries.append(entries)
+        self.urls += len(URL_START.findall(entries))
+        self.size += len(entries)
+
+    def payload(self):
+        return self.head + "\n".join(self.entries) + self.tail
+
+
+class Aggregator(object):
+    """
+    Holds the notifications of a topic for window seconds after the
+    first one, then publishes their <url> entries as a single urlset with
+    publish(topic, payload, headers). The document head and the headers
+    are those of the first notification, with the until of the last one.
+    A batch is published before window if it reaches max_urls entries or
+    max_bytes bytes.
+    """
+
+    def __init__(self, publish, window=1.0, max_urls=1000,
+                 max_bytes=1048576):
+        self.publish = publish
+        self.window = window
+        self.max_urls = max_urls
+        self.max_bytes = max_bytes
+        self.timer = None
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def add(self, topic, payload, headers):
+        """
+        Adds a notification to the batch of its topic. Returns False if
+        the payload is not a urlset that can be merged.
+        """
+
+        # spooled bodies are sent on their own.
+        parts = isinstance(payload, basestring) and split_urlset(payload)
+        if not parts:
+            return False
+        head, entries, tail = parts
+
+        ready = []
+        with self._lock:
+            batch = self._batches.get(topic)
+            if batch and (batch.size + len(entries) > self.max_bytes or
+                          batch.headers.get('Content-Type') !=
+                          headers.get('Content-Type')):
+                ready.append(self._batches.pop(topic))
+                batch = None
+            if not batch:
+                batch = self._batches[topic] = Batch(head, tail, headers)
+                self.schedule(topic, batch)
+            batch.add(head, entries)
+            if batch.urls >= self.max_urls:
+                ready.append(self._batches.pop(topic))
+        metrics.incr("notifications_aggregated")
+
+        for batch in ready:
+            self.flush_batch(topic, batch)
+        return True
+
+    def schedule(self, topic, batch):
+        if not self.timer:
+            self.timer = RetryTimer(self.flush)
+            self.timer.start()
+        self.timer.schedule((topic, batch), self.window)
+
+    def flush(self, item):
+        """
+        Publishes a batch at the end of its window, unless it was
+        published already.
+        """
+
+        topic, batch = item
+        with self._lock:
+            if self._batches.get(topic) is not batch:
+                return
+            del self._batches[topic]
+        self.flush_batch(topic, batch)
+
+    def stop(self):
+        """
+        Stops the timer and publishes the pending batches at once.
+        """
+
+        with self._lock:
+            batches = self._batches.items()
+            self._batches = {}
+            timer = self.timer
+            self.timer = None
+        if timer:
+            timer.stop()
+        for topic, batch in batches:
+            self.flush_batch(topic, batch)
+        return timer
+
+    def flush_batch(self, topic, batch):
+        payload = batch.payload()
+        headers = dict(batch.headers)
+        headers['Content-Length'] = str(len(payload))
+        metrics.incr("aggregated_notifications_sent")
+        try:
+            self.publish(topic, payload, headers)
+        except Exception as err:
+            print("Error publishing to %s: %s" % (topic, err))
+            metrics.incr("publish_failures")
+
+    def pending(self):
+        """
+        The number of topics with a batch waiting.
+        """
+
+        return len(self._batches)
@@ -0,0 +1,140 @@
+"""
+The allowlists of the hub config, parsed once from their comma separated
+values so that checking a request does not scan the list. A list with
+entries is configured, and allows only what its valid entries match,
+nothing at all if none of them is valid.
+"""
+
+from resourcesync_push.hub.patterns import TopicTrie, WILDCARD, \
+    valid_topic
+
+import binascii
+import socket
+
+
+def parse_list(value):
+    """
+    The entries of a comma separated config value.
+    """
+
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.split(",")
+    return [entry.strip() for entry in value if entry.strip()]
+
+
+def parse_address(text):
+    """
+    Returns the (family, integer value) of an ip address, or None if
+    the text is not one. IPv4 addresses mapped to IPv6 are returned as
+    IPv4.
+    """
+
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            packed = socket.inet_pton(family, text)
+        except (socket.error, ValueError):
+            continue
+        value = int(binascii.hexlify(packed), 16)
+        if family == socket.AF_INET6 and value >> 32 == 0xffff:
+            return socket.AF_INET, value & 0xffffffff
+        return family, value
+    return None
+
+
+ADDRESS_BITS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+
+class TopicList(object):
+    """
+    A set of topics. An entry ending with * allows all the topics
+    starting with the rest of it. The list is not configured if it has
+    no entries.
+    """
+
+    def __init__(self, value=None):
+        self.topics = set()
+        self.prefixes = TopicTrie()
+        self.invalid = []
+        entries = parse_list(value)
+        self.configured = bool(entries)
+        for entry in entries:
+            if not valid_topic(entry):
+                print("Invalid topic in trusted_topics: %s" % entry)
+                self.invalid.append(entry)
+            elif entry.endswith(WILDCARD):
+                self.prefixes.insert(entry[:-len(WILDCARD)], True)
+            else:
+                self.topics.add(entry)
+
+    def __contains__(self, topic):
+        return topic in self.topics or bool(self.prefixes.match(topic))
+
+
+class AddressList(object):
+    """
+    A set of ip addresses, networks in CIDR notation and host names. The
+    host names are resolved when the list is read. The list is not
+    configured if it has no entries.
+    """
+
+    def __init__(self, value=None):
+        self.addresses = set()
+        # (family, prefix length) -> network values shifted to the prefix
+        self.networks = {}
+        # the entries that are not valid, or could not be resolved
+        self.invalid = []
+        entries = parse_list(value)
+        self.configured = bool(entries)
+        for entry in entries:
+            if not self.add(entry):
+                self.invalid.append(entry)
+
+    def add(self, entry):
+        """
+        Adds an entry. Returns False if it is not valid.
+        """
+
+        if "/" in entry:
+            address, prefix = entry.split("/", 1)
+            address = parse_address(address)
+            try:
+                prefix = int(prefix)
+            except ValueError:
+                address = None
+            if not address or not 0 <= prefix <= ADDRESS_BITS[address[0]]:
+                print("Invalid network in trusted_publishers: %s" % entry)
+                return False
+            family, value = address
+            shift = ADDRESS_BITS[family] - prefix
+            self.networks.setdefault((family, shift), set()).add(
+                value >> shift)
+            return True
+
+        address = parse_address(entry)
+        if address:
+            self.addresses.add(address)
+            return True
+        try:
+            infos = socket.getaddrinfo(entry, None)
+        except socket.error as err:
+            print("Could not resolve %s in trusted_publishers: %s" %
+                  (entry, err))
+            return False
+        addresses = set(filter(None, [parse_address(info[4][0])
+                                      for info in infos]))
+        self.addresses.update(addresses)
+        return bool(addresses)
+
+    def __contains__(self, text):
+        address = parse_address(text or "")
+        if not address:
+            return False
+        if address in self.addresses:
+            return True
+        family, value = address
+        for (net_family, shift), networks in self.networks.items():
+            if net_family == family and value >> shift in networks:
+                return True
+        return False
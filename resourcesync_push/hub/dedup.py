@@ -0,0 +1,69 @@
+"""
+Suppresses the broadcast of notifications identical to one recently
+published for the same topic, such as the ones re-posted by publishers
+that retry.
+"""
+
+from resourcesync_push.metrics import metrics
+from resourcesync_push.spool import body_data
+
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+
+class DuplicateFilter(object):
+    """
+    Remembers the digests of the payloads published for each topic for
+    window seconds, keeping at most max_size of them; the oldest are
+    forgotten first.
+    """
+
+    def __init__(self, window=10.0, max_size=10000):
+        self.window = window
+        self.max_size = max_size
+        # (topic, digest) -> expiry, in the order they expire
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(topic, payload):
+        return (topic, hashlib.sha1(body_data(payload)).digest())
+
+    def add(self, topic, payload):
+        """
+        Records a notification. Returns False if it is a duplicate of one
+        recorded within the window.
+        """
+
+        key = DuplicateFilter.key(topic, payload)
+        now = time.time()
+        with self._lock:
+            self.expire(now)
+            if key in self._seen:
+                metrics.incr("duplicates_suppressed")
+                return False
+            self._seen[key] = now + self.window
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+        return True
+
+    def discard(self, topic, payload):
+        """
+        Forgets a notification that could not be published, so that it
+        is not suppressed when the publisher posts it again.
+        """
+
+        with self._lock:
+            self._seen.pop(DuplicateFilter.key(topic, payload), None)
+
+    def expire(self, now):
+        while self._seen:
+            key, expiry = next(self._seen.iteritems())
+            if expiry > now:
+                break
+            del self._seen[key]
+
+    def size(self):
+        return len(self._seen)
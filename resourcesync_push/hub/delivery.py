@@ -0,0 +1,639 @@
+"""
+The delivery of the notifications to the subscribers: retries with
+backoff, circuit breakers and dead letters, the durable delivery queue
+of the hub and the worker that drains it.
+"""
+
+from resourcesync_push import ResourceSyncPuSH
+from resourcesync_push.hub.evloop import open_engine
+from resourcesync_push.spool import body_data
+from resourcesync_push.metrics import metrics
+
+from collections import namedtuple
+
+import base64
+import fcntl
+import heapq
+import itertools
+import json
+import random
+import sqlite3
+import threading
+import time
+import urlparse
+
+
+Job = namedtuple("Job", ["id", "callback", "payload", "headers", "attempts"])
+
+
+class DeliveryQueue(object):
+    """
+    A persistent queue of deliveries in an SQLite database. A publish
+    stores its payload once and adds one job per subscriber, in a single
+    transaction. Workers claim jobs for visibility_timeout seconds; the
+    jobs of a worker that dies before completing them are claimed again
+    once the timeout is over.
+    """
+
+    def __init__(self, filename, visibility_timeout=300):
+        self.filename = filename
+        self.visibility_timeout = visibility_timeout
+        self._local = threading.local()
+        self.setup()
+
+    @property
+    def connection(self):
+        """
+        The connection of the current thread.
+        """
+
+        conn = getattr(self._local, 'connection', None)
+        if not conn:
+            conn = sqlite3.connect(self.filename, timeout=30,
+                                   isolation_level=None)
+            # a publish is acknowledged once its jobs are on disk.
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.connection = conn
+        return conn
+
+    def setup(self):
+        """
+        Creates the tables.
+        """
+
+        conn = self.connection
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS payloads (
+            id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            headers TEXT NOT NULL,
+            refs INTEGER NOT NULL)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            payload_id INTEGER NOT NULL,
+            callback TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS jobs_not_before
+            ON jobs (not_before)""")
+
+    def enqueue(self, callbacks, payload, headers):
+        """
+        Adds a job for each callback url. Returns the number of jobs
+        added, or None if they could not be stored.
+        """
+
+        callbacks = list(callbacks)
+        if not callbacks:
+            return 0
+
+        conn = self.connection
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                payload_id = conn.execute(
+                    "INSERT INTO payloads (data, headers, refs) \
+                    VALUES (?, ?, ?)",
+                    (sqlite3.Binary(body_data(payload)), json.dumps(headers),
+                     len(callbacks))).lastrowid
+                now = time.time()
+                conn.executemany(
+                    "INSERT INTO jobs (payload_id, callback, not_before) \
+                    VALUES (?, ?, ?)",
+                    [(payload_id, callback, now) for callback in callbacks])
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as err:
+            print(err)
+            return None
+        return len(callbacks)
+
+    def claim(self, limit):
+        """
+        Claims up to limit jobs that are due. Returns the list of jobs.
+        The jobs of a payload share a single copy of it.
+        """
+
+        conn = self.connection
+        now = time.time()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT id, payload_id, callback, attempts FROM jobs \
+                    WHERE not_before <= ? ORDER BY not_before LIMIT ?",
+                    (now, limit)).fetchall()
+                conn.executemany(
+                    "UPDATE jobs SET not_before = ? WHERE id = ?",
+                    [(now + self.visibility_timeout, row[0])
+                     for row in rows])
+                payloads = {}
+                for payload_id in set(row[1] for row in rows):
+                    data, headers = conn.execute(
+                        "SELECT data, headers FROM payloads WHERE id = ?",
+                        (payload_id,)).fetchone()
+                    payloads[payload_id] = (str(data), json.loads(headers))
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as err:
+            print(err)
+            return []
+
+        return [Job(job_id, callback, payloads[payload_id][0],
+                    dict(payloads[payload_id][1]), attempts)
+                for job_id, payload_id, callback, attempts in rows]
+
+    def complete(self, job):
+        """
+        Removes a delivered (or given up) job, and its payload if no
+        other job uses it.
+        """
+
+        conn = self.connection
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT payload_id FROM jobs WHERE id = ?",
+                                   (job.id,)).fetchone()
+                if row:
+                    conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+                    conn.execute("UPDATE payloads SET refs = refs - 1 \
+                                 WHERE id = ?", row)
+                    conn.execute("DELETE FROM payloads \
+                                 WHERE id = ? AND refs <= 0", row)
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as err:
+            print(err)
+            return None
+        return True
+
+    def retry(self, job, attempts, not_before):
+        """
+        Releases a claimed job for another attempt at not_before.
+        """
+
+        try:
+            self.connection.execute(
+                "UPDATE jobs SET attempts = ?, not_before = ? WHERE id = ?",
+                (attempts, not_before, job.id))
+        except sqlite3.Error as err:
+            print(err)
+            return None
+        return True
+
+    def depth(self):
+        """
+        The number of jobs in the queue.
+        """
+
+        try:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM jobs").fetchone()[0]
+        except sqlite3.Error as err:
+            print(err)
+            return None
+
+    def pending_bytes(self):
+        """
+        The bytes left to deliver: the size of each payload times the
+        number of its jobs.
+        """
+
+        try:
+            return self.connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(data) * refs), 0) \
+                FROM payloads").fetchone()[0]
+        except sqlite3.Error as err:
+            print(err)
+            return None
+
+
+class Backoff(object):
+    """
+    Jittered exponential backoff. The delay before retry n is drawn
+    between 0 and base_delay * 2 ** n, capped at max_delay seconds.
+    A delivery is given up after max_attempts attempts.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=300.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempts):
+        """
+        The delay in seconds before the next attempt, after attempts
+        failed attempts.
+        """
+
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempts))
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending to a callback after failure_threshold consecutive
+    failures. After reset_timeout seconds a single trial delivery is let
+    through; the circuit closes again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = {}
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    def allow(self, callback):
+        """
+        Returns True if a delivery to the callback can be sent now.
+        """
+
+        with self._lock:
+            opened = self._opened.get(callback)
+            if opened is None:
+                return True
+            if time.time() - opened < self.reset_timeout:
+                return False
+            # half open: let one trial through, and wait for its result
+            self._opened[callback] = time.time()
+            return True
+
+    def remaining(self, callback):
+        """
+        Seconds until the circuit of the callback lets a trial through.
+        """
+
+        opened = self._opened.get(callback)
+        if opened is None:
+            return 0
+        return max(0, opened + self.reset_timeout - time.time())
+
+    def success(self, callback):
+        with self._lock:
+            self._failures.pop(callback, None)
+            self._opened.pop(callback, None)
+
+    def failure(self, callback):
+        with self._lock:
+            failures = self._failures.get(callback, 0) + 1
+            self._failures[callback] = failures
+            if failures >= self.failure_threshold:
+                self._opened[callback] = time.time()
+
+    def open_circuits(self):
+        """
+        The number of callbacks with an open circuit.
+        """
+
+        return len(self._opened)
+
+
+class DeadLetters(object):
+    """
+    Appends the notifications that could not be delivered to a file, one
+    json record per line, so they can be inspected and replayed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, delivery, error):
+        record = {
+            'time': time.time(),
+            'callback': delivery.callback,
+            'attempts': delivery.attempts,
+            'error': str(error),
+            'headers': delivery.headers,
+        }
+        payload = str(delivery.payload)
+        try:
+            record['payload'] = payload.decode("utf-8")
+        except UnicodeDecodeError:
+            record['payload_base64'] = base64.b64encode(payload)
+
+        try:
+            with open(self.filename, "a") as dead_letters:
+                fcntl.flock(dead_letters, fcntl.LOCK_EX)
+                dead_letters.write(json.dumps(record) + "\n")
+        except IOError as err:
+            print(err)
+
+
+class Delivery(object):
+    """
+    A notification to deliver to a callback. done(delivery, delivered)
+    is called once it is delivered or given up.
+    """
+
+    def __init__(self, callback, payload, headers, attempts=0,
+                 job=None, done=None):
+        self.callback = callback
+        self.payload = payload
+        self.headers = headers
+        self.attempts = attempts
+        self.job = job
+        self.done = done
+
+
+class RetryTimer(threading.Thread):
+    """
+    Dispatches the deliveries scheduled for a retry once they are due.
+    """
+
+    def __init__(self, dispatch):
+        threading.Thread.__init__(self, name="RetryTimer")
+        self.daemon = True
+        self.dispatch = dispatch
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def schedule(self, delivery, delay):
+        with self._cond:
+            heapq.heappush(self._heap, (time.time() + delay,
+                                        next(self._counter), delivery))
+            self._cond.notify()
+
+    def pending(self):
+        """
+        The number of deliveries waiting for a retry.
+        """
+
+        return len(self._heap)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (
+                        not self._heap or self._heap[0][0] > time.time()):
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.time()
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                due, count, delivery = heapq.heappop(self._heap)
+            self.dispatch(delivery)
+
+    def stop(self):
+        """
+        Stops the timer. Returns the items that were still scheduled, in
+        the order they were due.
+        """
+
+        with self._cond:
+            self._stopped = True
+            items = [item for due, count, item in sorted(self._heap)]
+            self._heap = []
+            self._cond.notify()
+        return items
+
+
+class Dispatcher(object):
+    """
+    Sends deliveries with send, retries the failed ones with backoff and
+    writes the ones that exhausted their retries to the dead letters.
+    Deliveries to a callback whose circuit is open are not sent, and
+    count as a failed attempt. By default the retries are scheduled on
+    a timer in this process.
+    """
+
+    def __init__(self, send, backoff=None, breaker=None,
+                 dead_letters=None, retry=None):
+        self.send = send
+        self.backoff = backoff or Backoff()
+        self.breaker = breaker or CircuitBreaker()
+        self.dead_letters = dead_letters
+        self.timer = None
+        self._retry = retry
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config, send, retry=None):
+        """
+        Creates a dispatcher with the retry settings of the hub config.
+        """
+
+        dispatcher = Dispatcher(send, retry=retry)
+        dispatcher.configure(config, send)
+        return dispatcher
+
+    def configure(self, config, send):
+        """
+        Applies the retry settings of the hub config, keeping the state
+        of the circuits and the pending retries.
+        """
+
+        self.send = send
+        self.backoff.max_attempts = config['retry_max_attempts']
+        self.backoff.base_delay = config['retry_base_delay']
+        self.backoff.max_delay = config['retry_max_delay']
+        self.breaker.failure_threshold = config['circuit_failure_threshold']
+        self.breaker.reset_timeout = config['circuit_reset_timeout']
+        if not config['dead_letter_file']:
+            self.dead_letters = None
+        elif not self.dead_letters or \
+                self.dead_letters.filename != config['dead_letter_file']:
+            self.dead_letters = DeadLetters(config['dead_letter_file'])
+
+    def stop(self):
+        """
+        Stops the retry timer. The pending retries are dropped.
+        """
+
+        with self._lock:
+            timer = self.timer
+            self.timer = None
+        if timer:
+            timer.stop()
+        return timer
+
+    def dispatch(self, delivery):
+        """
+        Sends a delivery, unless the circuit of its callback is open.
+        """
+
+        if not self.breaker.allow(delivery.callback):
+            return self.failed(delivery, "circuit open", retryable=True,
+                               min_delay=self.breaker.remaining(
+                                   delivery.callback))
+        start = time.time()
+        try:
+            future = self.send(delivery.callback,
+                               data=delivery.payload,
+                               headers=delivery.headers)
+        except Exception as err:
+            return self.failed(delivery, err, retryable=True)
+        future.add_done_callback(
+            lambda future: self.sent(delivery, future, start))
+
+    def sent(self, delivery, future, start=None):
+        """
+        Handles the response to a delivery. The latency and status are
+        counted per callback host.
+        """
+
+        labels = {'host': urlparse.urlsplit(delivery.callback).netloc}
+        if start:
+            metrics.observe("delivery_seconds", time.time() - start,
+                            labels=labels)
+        try:
+            response = future.result()
+        except Exception as err:
+            labels['status'] = "error"
+            metrics.incr("deliveries", labels=labels)
+            self.breaker.failure(delivery.callback)
+            return self.failed(delivery, err, retryable=True)
+
+        status = response.status_code
+        labels['status'] = str(status)
+        metrics.incr("deliveries", labels=labels)
+        if status < 300:
+            self.breaker.success(delivery.callback)
+            if delivery.done:
+                delivery.done(delivery, True)
+            return
+
+        # the callback is up, but does not want the notification.
+        retryable = status >= 500 or status in (408, 429)
+        if retryable:
+            self.breaker.failure(delivery.callback)
+        self.failed(delivery, "HTTP %s" % status, retryable=retryable)
+
+    def failed(self, delivery, error, retryable=False, min_delay=0):
+        """
+        Schedules a retry of a failed delivery, or gives it up.
+        """
+
+        delivery.attempts += 1
+        if not retryable or delivery.attempts >= self.backoff.max_attempts:
+            metrics.incr("dead_letters")
+            print("Delivery to %s failed after %s attempt(s): %s" %
+                  (delivery.callback, delivery.attempts, error))
+            if self.dead_letters:
+                self.dead_letters.write(delivery, error)
+            if delivery.done:
+                delivery.done(delivery, False)
+            return
+
+        delay = max(min_delay, self.backoff.delay(delivery.attempts))
+        self.retry(delivery, delay)
+
+    def retry(self, delivery, delay):
+        """
+        Dispatches the delivery again after delay seconds.
+        """
+
+        if self._retry:
+            return self._retry(delivery, delay)
+
+        with self._lock:
+            if not self.timer:
+                self.timer = RetryTimer(self.dispatch)
+                self.timer.start()
+        self.timer.schedule(delivery, delay)
+
+
+class DeliveryWorker(ResourceSyncPuSH):
+    """
+    Drains the delivery queue. Claims batches of due jobs and dispatches
+    them with the pooled transport or the event loop engine, keeping at
+    most max_in_flight deliveries pending. Failed deliveries go back to
+    the queue until their next attempt is due.
+    """
+
+    batch_size = 100
+    poll_interval = 0.5
+
+    def __init__(self, queue=None, max_in_flight=None):
+        ResourceSyncPuSH.__init__(self)
+        self.get_config("hub")
+        self.queue = queue or DeliveryQueue(
+            self.config['delivery_queue_file'],
+            visibility_timeout=self.config['delivery_visibility_timeout'])
+        self.engine = open_engine(self.config)
+        send = self.engine.send if self.engine else self.send
+        self.dispatcher = Dispatcher.from_config(self.config, send,
+                                                 retry=self.retry)
+        if not max_in_flight:
+            if self.engine:
+                max_in_flight = self.engine.max_concurrency
+            else:
+                max_in_flight = 2 * self.transport.max_workers
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._stopped = threading.Event()
+
+    def run(self):
+        """
+        Delivers the queued jobs until stopped.
+        """
+
+        while not self._stopped.is_set():
+            if not self.run_once():
+                self._stopped.wait(self.poll_interval)
+
+    def run_once(self):
+        """
+        Claims a batch of jobs and starts their delivery. Returns the
+        number of jobs claimed.
+        """
+
+        jobs = self.queue.claim(self.batch_size)
+        for job in jobs:
+            self._in_flight.acquire()
+            self.dispatcher.dispatch(Delivery(job.callback, job.payload,
+                                              job.headers,
+                                              attempts=job.attempts,
+                                              job=job,
+                                              done=self.delivered))
+        return len(jobs)
+
+    def delivered(self, delivery, delivered):
+        """
+        Removes a delivered or given up job from the queue.
+        """
+
+        try:
+            self.queue.complete(delivery.job)
+        finally:
+            self._in_flight.release()
+
+    def retry(self, delivery, delay):
+        """
+        Puts a failed job back in the queue until its next attempt.
+        """
+
+        try:
+            self.queue.retry(delivery.job, delivery.attempts,
+                             time.time() + delay)
+        finally:
+            self._in_flight.release()
+
+    def stop(self):
+        """
+        Stops claiming new jobs.
+        """
+
+        self._stopped.set()
+
+
+def main():
+    """
+    Entry point of the delivery worker process.
+    """
+
+    worker = DeliveryWorker()
+    print("Delivering from %s" % worker.queue.filename)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
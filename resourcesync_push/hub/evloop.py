@@ -0,0 +1,780 @@
+"""
+An event loop delivery engine. Drives thousands of concurrent callback
+requests from a single thread with non-blocking sockets, instead of one
+thread per pending request.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+import urlparse
+
+from resourcesync_push.spool import body_data
+from resourcesync_push.profiling import profiler
+
+
+# connection states
+CONNECTING, HANDSHAKE, SENDING, RECEIVING, IDLE = range(5)
+
+READ = select.POLLIN | select.POLLPRI
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+class DeliveryError(IOError):
+    """
+    A request that failed or timed out.
+    """
+    pass
+
+
+class Response(object):
+    """
+    The status, headers and body of a response.
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+class Request(object):
+    """
+    A request waiting to be sent, and the future of its response.
+    """
+
+    def __init__(self, url, method, data, headers, future):
+        self.method = method
+        self.future = future
+        self.retried = False
+
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ["http", "https"] or not parts.hostname:
+            raise DeliveryError("Unsupported url: %s" % url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.key = (self.scheme, self.host, self.port)
+
+        path = parts.path or "/"
+        if parts.query:
+            path = path + "?" + parts.query
+
+        data = data or ""
+        host_header = self.host
+        if parts.port:
+            host_header = "%s:%s" % (self.host, parts.port)
+        lines = ["%s %s HTTP/1.1" % (method, path),
+                 "Host: %s" % host_header]
+        for name, value in (headers or {}).items():
+            if name.lower() not in ["host", "content-length", "connection"]:
+                lines.append("%s: %s" % (name, value))
+        if data or method == "POST":
+            lines.append("Content-Length: %s" % len(data))
+        lines.extend(["", ""])
+        self.head = "\r\n".join(lines)
+        # a str, or the mapped data of a spooled body
+        self.body = body_data(data)
+
+
+class Host(object):
+    """
+    The queued requests, active count and idle keep-alive connections of
+    a (scheme, host, port).
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.queue = collections.deque()
+        self.active = 0
+        self.idle = []
+
+
+class Connection(object):
+    """
+    A non-blocking connection to a host, reused for several requests
+    while the host keeps it alive.
+    """
+
+    def __init__(self, loop, host, addrinfo):
+        self.loop = loop
+        self.host = host
+        self.request = None
+        self.sock = None
+        self.state = CONNECTING
+        self.deadline = None
+        self.reused = False
+        self.out = []
+        self.out_pos = 0
+        self.inbuf = ""
+
+        family, socktype, proto, canonname, address = addrinfo
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        self.fileno = self.sock.fileno()
+        err = self.sock.connect_ex(address)
+        if err not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+            self.sock.close()
+            raise socket.error(err, os.strerror(err))
+
+    def start(self, request):
+        """
+        Starts sending a request. Sent once the connection is up.
+        """
+
+        self.request = request
+        self.out = [part for part in [request.head, request.body] if part]
+        self.out_pos = 0
+        self.inbuf = ""
+        if self.state == CONNECTING:
+            self.loop.set_deadline(self, self.loop.connect_timeout)
+        else:
+            self.reused = True
+            self.state = SENDING
+            self.loop.set_deadline(self, self.loop.read_timeout)
+        self.loop.watch(self, WRITE)
+
+    def handle(self, events):
+        """
+        Advances the connection on poll events.
+        """
+
+        if self.state == IDLE:
+            # the host closed the idle connection
+            return self.loop.close(self)
+
+        if self.state == CONNECTING:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            if events & ERROR and not events & WRITE:
+                raise DeliveryError("Connection failed")
+            self.loop.set_deadline(self, self.loop.read_timeout)
+            if self.request.scheme == "https":
+                self.sock = self.loop.ssl_context.wrap_socket(
+                    self.sock, server_hostname=self.request.host,
+                    do_handshake_on_connect=False)
+                self.state = HANDSHAKE
+            else:
+                self.state = SENDING
+
+        if self.state == HANDSHAKE:
+            try:
+                self.sock.do_handshake()
+            except ssl.SSLWantReadError:
+                return self.loop.watch(self, READ)
+            except ssl.SSLWantWriteError:
+                return self.loop.watch(self, WRITE)
+            self.state = SENDING
+
+        if self.state == SENDING:
+            while self.out:
+                try:
+                    self.out_pos += self.sock.send(
+                        buffer(self.out[0], self.out_pos))
+                except ssl.SSLWantWriteError:
+                    return self.loop.watch(self, WRITE)
+                except ssl.SSLWantReadError:
+                    return self.loop.watch(self, READ)
+                except socket.error as err:
+                    if err.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                        return self.loop.watch(self, WRITE)
+                    raise
+                if self.out_pos < len(self.out[0]):
+                    return self.loop.watch(self, WRITE)
+                self.out.pop(0)
+                self.out_pos = 0
+            self.state = RECEIVING
+            return self.loop.watch(self, READ)
+
+        if self.state == RECEIVING:
+            self.receive()
+
+    def receive(self):
+        """
+        Reads the available data and completes the request once the
+        response is complete.
+        """
+
+        chunks = []
+        closed = False
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except ssl.SSLWantReadError:
+                break
+            except socket.error as err:
+                if err.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    break
+                raise
+            if not data:
+                closed = True
+                break
+            chunks.append(data)
+            if not isinstance(self.sock, ssl.SSLSocket) or \
+                    not self.sock.pending():
+                break
+        self.inbuf += "".join(chunks)
+
+        response, keep_alive = parse_response(self.inbuf,
+                                              self.request.method, closed)
+        if response:
+            return self.loop.finish(self, response, keep_alive)
+        if closed:
+            raise DeliveryError("Connection closed by the host")
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+def parse_chunked(body):
+    """
+    Decodes a chunked body. Returns None if it is not complete yet.
+    """
+
+    chunks = []
+    pos = 0
+    while True:
+        end = body.find("\r\n", pos)
+        if end < 0:
+            return None
+        size = int(body[pos:end].split(";")[0], 16)
+        pos = end + 2
+        if size == 0:
+            # skip the trailers
+            if body.find("\r\n\r\n", pos - 2) < 0:
+                return None
+            return "".join(chunks)
+        if len(body) < pos + size + 2:
+            return None
+        chunks.append(body[pos:pos + size])
+        pos += size + 2
+
+
+def parse_response(data, method, closed):
+    """
+    Parses the data received for a request. Returns the (response, keep
+    alive) pair, or (None, False) if the response is not complete yet.
+    """
+
+    end = data.find("\r\n\r\n")
+    while end >= 0 and data[9:10] == "1":
+        # skip informational (1xx) responses
+        data = data[end + 4:]
+        end = data.find("\r\n\r\n")
+    if end < 0:
+        return None, False
+
+    lines = data[:end].split("\r\n")
+    version, status = lines[0].split(" ", 2)[:2]
+    headers = {}
+    for line in lines[1:]:
+        name, value = line.split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    status = int(status)
+    body = data[end + 4:]
+
+    keep_alive = version == "HTTP/1.1"
+    connection = headers.get("connection", "").lower()
+    if connection == "close":
+        keep_alive = False
+    elif connection == "keep-alive":
+        keep_alive = True
+
+    if method == "HEAD" or status in [204, 304]:
+        content = ""
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        content = parse_chunked(body)
+    elif "content-length" in headers:
+        length = int(headers["content-length"])
+        content = body[:length] if len(body) >= length else None
+    else:
+        # the body ends when the host closes the connection
+        content = body if closed else None
+        keep_alive = False
+
+    if content is None:
+        return None, False
+    return Response(status, headers, content), keep_alive and not closed
+
+
+class Poller(object):
+    """
+    epoll where available, poll otherwise. Timeouts are in seconds.
+    """
+
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.scale = 1.0
+        else:
+            self.poller = select.poll()
+            self.scale = 1000.0
+
+    def register(self, fileno, events):
+        self.poller.register(fileno, events)
+
+    def modify(self, fileno, events):
+        self.poller.modify(fileno, events)
+
+    def unregister(self, fileno):
+        self.poller.unregister(fileno)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = timeout * self.scale
+        try:
+            return self.poller.poll(timeout)
+        except (IOError, select.error) as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self.poller, "close"):
+            self.poller.close()
+
+
+# the lookups of the resolver threads
+getaddrinfo = socket.getaddrinfo
+
+
+def open_engine(config):
+    """
+    Creates the event loop engine if the hub config selects it. Returns
+    None for the threaded transport.
+    """
+
+    if config.get('delivery_engine') != "async":
+        return None
+    return EventLoopTransport.from_config(config)
+
+
+class EventLoopTransport(object):
+    """
+    Sends requests from a single event loop thread. At most
+    max_concurrency requests are active at a time, and at most
+    max_per_host to the same host; the others wait in per-host queues
+    that are served in turn. Connections are kept alive and reused.
+
+    send() can be called from any thread, and returns a future of the
+    response, like the pooled Transport.
+    """
+
+    # seconds an idle keep-alive connection is kept open
+    idle_timeout = 30
+    # seconds the address of a host is cached, and a failed lookup
+    dns_ttl = 60
+    dns_error_ttl = 10
+    # threads resolving the host names, out of the event loop
+    dns_workers = 4
+
+    def __init__(self, max_concurrency=1000, max_per_host=100,
+                 connect_timeout=None, read_timeout=None):
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.ssl_context = ssl.create_default_context()
+
+        self._incoming = collections.deque()
+        self._hosts = {}
+        self._pending = collections.deque()
+        self._conns = {}
+        self._watched = {}
+        self._dns = {}
+        # (host, port) -> the (host, request) waiting for its address
+        self._resolving = {}
+        self._resolved = collections.deque()
+        self._resolver = None
+        # (deadline, count, connection), with the entries of the
+        # deadlines that changed left until they are popped
+        self._deadlines = []
+        self._counter = itertools.count()
+        self._active = 0
+        self._poller = Poller()
+        self._waker, self._wake_fd = os.pipe()
+        for fd in [self._waker, self._wake_fd]:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._poller.register(self._waker, READ)
+        self._thread = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config):
+        """
+        Creates the engine with the settings of the hub config.
+        """
+
+        transport = config.get('transport', {})
+        return EventLoopTransport(
+            max_concurrency=config['async_max_concurrency'],
+            max_per_host=config['async_max_per_host'],
+            connect_timeout=transport.get('connect_timeout'),
+            read_timeout=transport.get('read_timeout'))
+
+    def start(self):
+        """
+        Starts the event loop thread.
+        """
+
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self.run,
+                                            name="EventLoopTransport")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops the event loop. The requests still queued are failed.
+        """
+
+        self._stopped = True
+        self.wake()
+
+    def send(self, url, method='POST',
+             data=None,
+             callback=None,
+             headers=None):
+        """
+        Queues a request. Returns the future of its response.
+        """
+
+        future = Future()
+        if self._stopped:
+            future.set_exception(DeliveryError("Transport stopped"))
+            return future
+        try:
+            request = Request(url, method, data, headers, future)
+        except (DeliveryError, ValueError) as err:
+            future.set_exception(err)
+            return future
+
+        self._incoming.append(request)
+        if not self._thread:
+            self.start()
+        self.wake()
+        return profiler.track("send", future, url=url, method=method)
+
+    def wake(self):
+        wake_fd = self._wake_fd
+        if wake_fd is None:
+            return
+        try:
+            os.write(wake_fd, "x")
+        except OSError:
+            # the pipe is full, the loop will wake up anyway
+            pass
+
+    def set_deadline(self, conn, timeout):
+        """
+        Sets the deadline of a connection to timeout seconds from now,
+        or none.
+        """
+
+        if timeout is None:
+            conn.deadline = None
+            return
+        conn.deadline = time.time() + timeout
+        heapq.heappush(self._deadlines, (conn.deadline, next(self._counter),
+                                         conn))
+        if len(self._deadlines) > 2 * len(self._conns) + 1024:
+            # drop the entries of the changed deadlines
+            self._deadlines = [entry for entry in self._deadlines
+                               if self.current(entry)]
+            heapq.heapify(self._deadlines)
+
+    def current(self, entry):
+        """
+        Whether a deadline entry is still the deadline of its connection.
+        """
+
+        deadline, count, conn = entry
+        return conn.deadline == deadline and \
+            self._conns.get(conn.fileno) is conn
+
+    def active(self):
+        """
+        The number of requests being sent.
+        """
+
+        return self._active
+
+    def run(self):
+        """
+        The event loop.
+        """
+
+        while not self._stopped:
+            self.connect_resolved()
+            self.schedule()
+            for fileno, events in self._poller.poll(self.next_timeout()):
+                if fileno == self._waker:
+                    try:
+                        while os.read(self._waker, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                conn = self._conns.get(fileno)
+                if not conn:
+                    continue
+                try:
+                    conn.handle(events)
+                except (socket.error, ssl.SSLError, DeliveryError,
+                        ValueError) as err:
+                    self.fail(conn, err)
+            self.check_timeouts()
+
+        for conn in list(self._conns.values()):
+            self.fail(conn, DeliveryError("Transport stopped"))
+        for waiting in self._resolving.values():
+            for host, request in waiting:
+                request.future.set_exception(
+                    DeliveryError("Transport stopped"))
+        self._resolving = {}
+        if self._resolver:
+            self._resolver.shutdown(wait=False)
+        while self._incoming:
+            self._incoming.popleft().future.set_exception(
+                DeliveryError("Transport stopped"))
+        for host in self._hosts.values():
+            while host.queue:
+                host.queue.popleft().future.set_exception(
+                    DeliveryError("Transport stopped"))
+
+        wake_fd, self._wake_fd = self._wake_fd, None
+        os.close(wake_fd)
+        os.close(self._waker)
+        self._poller.close()
+
+    def schedule(self):
+        """
+        Moves the new requests to their host queues and starts as many
+        queued requests as the limits allow, one host at a time.
+        """
+
+        while self._incoming:
+            request = self._incoming.popleft()
+            host = self._hosts.get(request.key)
+            if not host:
+                host = self._hosts[request.key] = Host(request.key)
+            if not host.queue:
+                self._pending.append(host)
+            host.queue.append(request)
+
+        blocked = collections.deque()
+        while self._pending and self._active < self.max_concurrency:
+            host = self._pending.popleft()
+            if host.active >= self.max_per_host:
+                blocked.append(host)
+                continue
+            self.start_request(host, host.queue.popleft())
+            if host.queue:
+                self._pending.append(host)
+        self._pending.extend(blocked)
+
+    def start_request(self, host, request):
+        """
+        Sends a request on an idle connection to the host, or a new one
+        once the address of the host is known.
+        """
+
+        host.active += 1
+        self._active += 1
+        if host.idle:
+            return self.connect(host, request, None)
+
+        key = (request.host, request.port)
+        cached = self._dns.get(key)
+        if cached and cached[0] > time.time():
+            return self.connect(host, request, cached[1])
+
+        waiting = self._resolving.get(key)
+        if waiting is None:
+            waiting = self._resolving[key] = []
+            self.resolve(key)
+        waiting.append((host, request))
+
+    def connect(self, host, request, addrinfo):
+        """
+        Sends a request on an idle connection, or a new connection to
+        addrinfo, or fails it with the error of its lookup.
+        """
+
+        try:
+            if isinstance(addrinfo, Exception):
+                raise addrinfo
+            if host.idle:
+                conn = host.idle.pop()
+            else:
+                conn = Connection(self, host, addrinfo)
+                self._conns[conn.fileno] = conn
+            conn.start(request)
+        except (socket.error, socket.gaierror) as err:
+            host.active -= 1
+            self._active -= 1
+            request.future.set_exception(err)
+
+    def resolve(self, key):
+        """
+        Looks up the address of a (host, port) in the resolver threads.
+        """
+
+        if not self._resolver:
+            self._resolver = ThreadPoolExecutor(self.dns_workers)
+
+        def lookup():
+            try:
+                result = getaddrinfo(key[0], key[1], 0,
+                                     socket.SOCK_STREAM)[0]
+            except (socket.error, IndexError) as err:
+                result = socket.gaierror(*err.args) \
+                    if isinstance(err, IndexError) else err
+            self._resolved.append((key, result))
+            self.wake()
+
+        self._resolver.submit(lookup)
+
+    def connect_resolved(self):
+        """
+        Caches the addresses looked up, for dns_ttl seconds or
+        dns_error_ttl seconds for a failed lookup, and connects the
+        requests waiting for them.
+        """
+
+        while self._resolved:
+            key, result = self._resolved.popleft()
+            ttl = self.dns_error_ttl if isinstance(result, Exception) \
+                else self.dns_ttl
+            self._dns[key] = (time.time() + ttl, result)
+            for host, request in self._resolving.pop(key, []):
+                self.connect(host, request, result)
+
+    def watch(self, conn, events):
+        """
+        Waits for events on the socket of a connection.
+        """
+
+        if conn.fileno in self._watched:
+            if self._watched[conn.fileno] != events:
+                self._poller.modify(conn.fileno, events)
+        else:
+            self._poller.register(conn.fileno, events)
+        self._watched[conn.fileno] = events
+
+    def release(self, conn):
+        """
+        Frees the slot of the request of a connection.
+        """
+
+        if conn.request:
+            conn.request = None
+            conn.host.active -= 1
+            self._active -= 1
+
+    def finish(self, conn, response, keep_alive):
+        """
+        Completes the request of a connection with its response.
+        """
+
+        request = conn.request
+        self.release(conn)
+        if keep_alive:
+            conn.state = IDLE
+            self.set_deadline(conn, self.idle_timeout)
+            conn.host.idle.append(conn)
+            self.watch(conn, READ)
+        else:
+            self.close(conn)
+        request.future.set_result(response)
+
+    def fail(self, conn, err):
+        """
+        Fails the request of a connection and closes it. A request that
+        failed on a reused keep-alive connection before any response was
+        received is sent again once on a new connection.
+        """
+
+        request = conn.request
+        reused = conn.reused and not conn.inbuf
+        self.release(conn)
+        self.close(conn)
+        if not request:
+            return
+        if reused and not request.retried:
+            request.retried = True
+            if not conn.host.queue:
+                self._pending.append(conn.host)
+            conn.host.queue.appendleft(request)
+            return
+        request.future.set_exception(err)
+
+    def close(self, conn):
+        """
+        Closes a connection and forgets it.
+        """
+
+        if conn in conn.host.idle:
+            conn.host.idle.remove(conn)
+        if self._watched.pop(conn.fileno, None) is not None:
+            try:
+                self._poller.unregister(conn.fileno)
+            except (IOError, ValueError):
+                pass
+        self._conns.pop(conn.fileno, None)
+        conn.close()
+
+    def next_timeout(self):
+        """
+        Seconds until the next connection deadline.
+        """
+
+        if self._incoming or self._resolved or (
+                self._pending and self._active < self.max_concurrency):
+            return 0
+        while self._deadlines and not self.current(self._deadlines[0]):
+            heapq.heappop(self._deadlines)
+        if not self._deadlines:
+            return None
+        return max(0, self._deadlines[0][0] - time.time())
+
+    def check_timeouts(self):
+        """
+        Fails the requests and closes the idle connections past their
+        deadline.
+        """
+
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            entry = heapq.heappop(self._deadlines)
+            if not self.current(entry):
+                continue
+            conn = entry[2]
+            if conn.state == IDLE:
+                self.close(conn)
+            else:
+                # not retried, the request may have reached the host.
+                conn.reused = False
+                self.fail(conn, DeliveryError("Request timed out"))
+
@@ -0,0 +1,213 @@
+"""
+Fetches the feeds of the PuSH mode publish pings in the background and
+hands them to the hub for the fan-out to the subscribers.
+"""
+
+from resourcesync_push.hub.delivery import RetryTimer
+from resourcesync_push.metrics import metrics
+
+from collections import OrderedDict
+import hashlib
+import threading
+
+
+class FeedCache(object):
+    """
+    The ETag, Last-Modified and content hash of the last published
+    version of the most recently fetched feeds, up to max_size feeds.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._feeds = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """
+        The (etag, last modified, hash) of the feed, or None.
+        """
+
+        with self._lock:
+            entry = self._feeds.pop(url, None)
+            if entry:
+                self._feeds[url] = entry
+            return entry
+
+    def put(self, url, etag, last_modified, digest):
+        with self._lock:
+            self._feeds.pop(url, None)
+            self._feeds[url] = (etag, last_modified, digest)
+            while len(self._feeds) > self.max_size:
+                self._feeds.popitem(last=False)
+
+    def request_headers(self, url):
+        """
+        The headers of a conditional GET of the feed.
+        """
+
+        entry = self.get(url)
+        if not entry:
+            return {}
+        etag, last_modified, digest = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+
+class FeedFetcher(object):
+    """
+    Fetches feeds with the thread pool of the transport, so that the
+    publish pings can be answered without waiting for the fetch. Once a
+    feed is fetched, publish(url, response) fans it out.
+
+    The feeds are fetched with a conditional GET. A feed that is not
+    modified (304) or has the same content as the last time it was
+    published is not published again.
+
+    The pings for a feed that is already pending are coalesced: they
+    share its fetch and fan-out. A ping that arrives while the feed is
+    being fetched gets it fetched once more afterwards, since the feed
+    may have changed after the fetch started. The fetches wait debounce
+    seconds, so that a burst of pings is fetched and delivered once.
+
+    At most max_pending fetches are pending at a time. A failed fetch
+    is counted in the fetch_failures metric.
+    """
+
+    # the states of a pending feed
+    SCHEDULED, FETCHING, FETCH_AGAIN = range(3)
+
+    def __init__(self, send, publish, max_pending=1000, cache_size=1000,
+                 debounce=0):
+        self.send = send
+        self.publish = publish
+        self.max_pending = max_pending
+        self.debounce = debounce
+        self.cache = FeedCache(max_size=cache_size)
+        self.timer = None
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+    def submit(self, url):
+        """
+        Schedules a fetch of the feed at url, unless one is pending.
+        Returns False if too many fetches are pending.
+        """
+
+        with self._lock:
+            state = self._feeds.get(url)
+            if state is not None:
+                if state == self.FETCHING:
+                    self._feeds[url] = self.FETCH_AGAIN
+                metrics.incr("fetch_coalesced")
+                return True
+            if len(self._feeds) >= self.max_pending:
+                metrics.incr("fetch_rejected")
+                return False
+            self._feeds[url] = self.SCHEDULED
+
+        self.schedule(url)
+        return True
+
+    def schedule(self, url):
+        """
+        Fetches the feed after the debounce delay.
+        """
+
+        if not self.debounce:
+            return self.fetch(url)
+
+        with self._lock:
+            if not self.timer:
+                self.timer = RetryTimer(self.fetch)
+                self.timer.start()
+        self.timer.schedule(url, self.debounce)
+
+    def stop(self):
+        """
+        Stops the debounce timer. The feeds waiting for it are not
+        fetched.
+        """
+
+        with self._lock:
+            timer = self.timer
+            self.timer = None
+            if timer:
+                for url in timer.stop():
+                    self._feeds.pop(url, None)
+        return timer
+
+    def fetch(self, url):
+        """
+        Starts fetching the feed at url.
+        """
+
+        with self._lock:
+            self._feeds[url] = self.FETCHING
+
+        try:
+            future = self.send(url, method='GET',
+                               headers=self.cache.request_headers(url))
+        except Exception as err:
+            return self.fetched(url, None, err)
+        future.add_done_callback(lambda future: self.fetched(url, future))
+
+    def fetched(self, url, future, error=None):
+        """
+        Publishes a fetched feed, or counts the failure.
+        """
+
+        try:
+            if future is not None:
+                try:
+                    response = future.result()
+                except Exception as err:
+                    error = err
+            if error is None and response.status_code == 304:
+                metrics.incr("fetch_not_modified")
+                return
+            if error is None and not 200 <= response.status_code < 300:
+                error = "HTTP %s" % response.status_code
+            if error is not None:
+                print("Error fetching %s: %s" % (url, error))
+                metrics.incr("fetch_failures")
+                return
+
+            metrics.incr("fetches")
+            digest = hashlib.sha1(response.content).hexdigest()
+            cached = self.cache.get(url)
+            if cached and cached[2] == digest:
+                metrics.incr("fetch_unchanged")
+                self.cache.put(url, response.headers.get('etag'),
+                               response.headers.get('last-modified'), digest)
+                return
+
+            try:
+                published = self.publish(url, response)
+            except Exception as err:
+                print("Error publishing %s: %s" % (url, err))
+                published = False
+            if not published:
+                metrics.incr("publish_failures")
+                return
+            self.cache.put(url, response.headers.get('etag'),
+                           response.headers.get('last-modified'), digest)
+        finally:
+            with self._lock:
+                again = self._feeds.get(url) == self.FETCH_AGAIN
+                if again:
+                    self._feeds[url] = self.SCHEDULED
+                else:
+                    self._feeds.pop(url, None)
+            if again:
+                self.schedule(url)
+
+    def pending(self):
+        """
+        The number of feeds with a pending fetch.
+        """
+
+        return len(self._feeds)
@@ -1,75 +1,346 @@
 """The Hub resource."""
 
-from resourcesync_push import ResourceSyncPuSH
-
+from resourcesync_push import ResourceSyncPuSH, HTTP_STATUS_CODE
+from resourcesync_push.context import AppContext
+from resourcesync_push.spool import read_body, BodyTooLarge
+from resourcesync_push.metrics import metrics, MetricsWriter, render
+from resourcesync_push.profiling import profiler
+
+from resourcesync_push.hub.store import PickleStore, SQLiteStore, \
+    LeaseSweeper, verify_lease
+from resourcesync_push.hub.index import SharedIndex, IndexBuilder
+from resourcesync_push.hub.delivery import DeliveryQueue, Dispatcher, \
+    Delivery
+from resourcesync_push.hub.evloop import open_engine
+from resourcesync_push.hub.fetcher import FeedFetcher
+from resourcesync_push.hub.aggregator import Aggregator
+from resourcesync_push.hub.dedup import DuplicateFilter
+from resourcesync_push.hub.verifier import Verifier, VERIFIED, DECLINED, \
+    FAILED
+from resourcesync_push.hub.patterns import PatternIndex, is_pattern, \
+    valid_topic
+from resourcesync_push.hub.ratelimit import TokenBuckets, InflightBytes
+
+from collections import OrderedDict
+import json
+import math
+import re
+import threading
 import time
-import cPickle
-import copy
 import urlparse
-import urllib
 import os
 
 
+CONTROL_CHARACTERS = re.compile(r"[\x00-\x1f\x7f]")
+
+
+def valid_callback(callback):
+    """
+    Whether the callback url is free of control characters, such as a
+    newline decoded from %0A.
+    """
+
+    return not CONTROL_CHARACTERS.search(callback)
+
+
+def parse_lease(value):
+    """
+    The lease of a subscription in whole seconds, or None if the value
+    is not a positive number.
+    """
+
+    try:
+        lease = int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if lease <= 0:
+        return None
+    return lease
+
+
 class Hub(ResourceSyncPuSH):
     """
     The base class for hub resources.
     """
 
-    def __init__(self):
-        ResourceSyncPuSH.__init__(self)
-        self.get_config("hub")
+    def __init__(self, context=None):
+        ResourceSyncPuSH.__init__(self, context=context)
+        if context:
+            self.store = context.store
+            self.index = context.index
+            self.queue = context.queue
+            self.dispatcher = context.dispatcher
+            self.fetcher = context.fetcher
+            self.aggregator = context.aggregator
+            self.duplicates = context.duplicates
+            self.metrics_writer = context.metrics_writer
+            self.verifier = context.verifier
+            self.patterns = context.patterns
+            self.buckets = context.buckets
+            self.inflight = context.inflight
+        else:
+            self.get_config("hub")
+            self.store = Hub.open_store(self.config)
+            self.index = None
+            self.queue = Hub.open_queue(self.config)
+            engine = open_engine(self.config)
+            self.dispatcher = Dispatcher.from_config(
+                self.config, engine.send if engine else self.send)
+            self.fetcher = FeedFetcher(
+                self.send, self.publish_feed,
+                max_pending=self.config['fetch_max_pending'],
+                cache_size=self.config['feed_cache_size'],
+                debounce=self.config['fetch_debounce'])
+            # batches and digests only live as long as the application
+            # context.
+            self.aggregator = None
+            self.duplicates = None
+            self.metrics_writer = None
+            self.buckets = None
+            self.inflight = None
+            self.verifier = Verifier(
+                self.send, self.verified,
+                workers=self.config['verify_workers'],
+                max_pending=self.config['verify_max_pending'],
+                timeout=self.config['verify_timeout'],
+                max_attempts=self.config['verify_max_attempts'],
+                retry_delay=self.config['verify_retry_delay'])
+            self.patterns = PatternIndex(self.store) \
+                if self.config['pattern_subscriptions'] else None
+
+    @staticmethod
+    def open_store(config):
+        """
+        Opens the subscription store set in the config.
+        """
 
-    def save_subscriptions(self, subscriptions):
-        'Save subscribers to disk as a dict'
+        if config['subscription_store'] == "pickle":
+            return PickleStore(config['subscribers_file'])
+        return SQLiteStore(config['subscriptions_db'],
+                           pickle_file=config['subscribers_file'])
 
-        filename = self.config['subscribers_file']
+    @staticmethod
+    def open_queue(config):
+        """
+        Opens the delivery queue if the hub is set to queue the
+        deliveries. Returns None otherwise.
+        """
 
-        subscriptions = self.verify_lease(subscriptions)
-        sub_file = None
-        try:
-            sub_file = open(filename, 'wb')
-            cPickle.dump(subscriptions, sub_file)
-        except IOError as err:
-            print(err)
+        if config['delivery'] != "queue":
             return None
-        finally:
-            if sub_file:
-                sub_file.close()
-        return True
+        return DeliveryQueue(
+            config['delivery_queue_file'],
+            visibility_timeout=config['delivery_visibility_timeout'])
 
-    def read_subscriptions(self):
-        "Read subscriber's list from file"
+    def get_subscribers(self, topic):
+        """
+        Returns the {callback: lease} dict of the active subscribers of
+        the topic and of the wildcard topics matching it, from the
+        shared index if there is one. Returns None if the subscriptions
+        could not be read.
+        """
 
-        filename = self.config['subscribers_file']
+        with metrics.timer("store_seconds", labels={'op': "read"}), \
+                profiler.span("get_subscribers"):
+            subscribers = None
+            if self.index:
+                subscribers = self.index.get_subscribers(topic)
+            if subscribers is None:
+                subscribers = self.store.get_subscribers(topic)
+            if subscribers is None or not self.patterns:
+                return subscribers
+
+            matched = self.patterns.get_subscribers(topic)
+            if not matched:
+                return subscribers
+            matched.update(subscribers)
+            return matched
+
+    def valid_topic(self, topic):
+        """
+        Whether the topic can be subscribed to. With the wildcard
+        subscriptions on, a * may only end the topic.
+        """
 
-        data = {}
-        sub_file = None
-        try:
-            # using 'r+b' file permissions here so that the
-            # file gets created if there is none.
-            sub_file = open(filename, "r+b")
-            data = cPickle.load(sub_file)
-        except (IOError, EOFError) as err:
-            print(err)
-            return None
-        finally:
-            if sub_file:
-                sub_file.close()
-        return self.verify_lease(data)
+        return not self.patterns or valid_topic(topic)
+
+    def index_patterns(self, records):
+        """
+        Adds the saved changes of wildcard subscriptions to the pattern
+        index at once, instead of waiting for its next refresh.
+        """
+
+        if not self.patterns:
+            return
+        for record in records:
+            if not is_pattern(record[1]):
+                continue
+            if record[0] == "subscribe":
+                self.patterns.subscribe(*record[1:])
+            else:
+                self.patterns.unsubscribe(*record[1:])
+
+    def deliver(self, subscribers, payload, headers):
+        """
+        Sends the payload to the subscribers, retrying the failed
+        deliveries, or adds it to the delivery queue for the delivery
+        workers if the hub has one. Returns True once the deliveries are
+        started or queued.
+        """
+
+        with metrics.timer("fanout_seconds"):
+            if self.queue:
+                return self.queue.enqueue(subscribers, payload, headers) \
+                    is not None
+
+            done = None
+            if self.inflight:
+                self.inflight.add(len(payload) * len(subscribers))
+                done = self.inflight.done
+            for subscriber in subscribers:
+                self.dispatcher.dispatch(Delivery(subscriber, payload,
+                                                  headers, done=done))
+            return True
+
+    def rate_limited(self, kind, key):
+        """
+        Takes a token from the bucket of a publisher or a topic, kind
+        being "publisher" or "topic". Returns 0 if the request is
+        allowed, or else the seconds until it would be.
+        """
+
+        rate = self.config['%s_rate' % kind]
+        if not rate or not self.buckets:
+            return 0
+        return self.buckets.take("%s %s" % (kind, key), rate,
+                                 self.config['%s_burst' % kind])
+
+    def overloaded(self):
+        """
+        Whether the notifications waiting to be delivered are over
+        max_inflight_bytes.
+        """
+
+        return bool(self.config['max_inflight_bytes'] and self.inflight and
+                    self.inflight.value() >=
+                    self.config['max_inflight_bytes'])
+
+    def reject(self, code, reason, retry_after, msg):
+        """
+        Turns a publish request away, telling the publisher when to try
+        again.
+        """
+
+        metrics.incr("publishes_rejected", labels={'reason': reason})
+        return self.respond(code=code, msg=msg, headers=[
+            ("Retry-After", str(max(int(math.ceil(retry_after)), 1)))])
+
+    def publish_feed(self, topic, response):
+        """
+        Sends a feed fetched for a PuSH mode publish to the subscribers
+        of the topic. Returns True once the deliveries are started.
+        """
+
+        payload = response.content
+        headers = {
+            'Content-Type': response.headers.get('content-type'),
+            'Content-Length': str(len(payload))
+        }
+        return self.publish_notification(topic, payload, headers)
+
+    def publish_notification(self, topic, payload, headers):
+        """
+        Sends a notification to the current subscribers of the topic.
+        Returns True once the deliveries are started.
+        """
+
+        subscribers = self.get_subscribers(topic)
+        if subscribers is not None:
+            metrics.set("topic_subscribers", len(subscribers),
+                        labels={'topic': topic})
+        if not subscribers:
+            return subscribers is not None
+        return self.deliver(subscribers, payload, headers)
+
+    def save_subscriptions(self, subscriptions):
+        'Save subscribers to the store as a dict'
+
+        with metrics.timer("store_seconds", labels={'op': "write"}), \
+                profiler.span("save_subscriptions"):
+            return self.store.save_all(subscriptions)
+
+    def read_subscriptions(self):
+        "Read subscriber's list from the store"
+
+        with metrics.timer("store_seconds", labels={'op': "read"}), \
+                profiler.span("read_subscriptions"):
+            return self.store.read_all()
 
     def verify_lease(self, subscriptions):
         """
-        Loop through the dict of subscribers and del all the subscriptions
+        Returns the dict of subscribers without the subscriptions
         that are past their lease time.
         """
 
+        with profiler.span("verify_lease"):
+            return verify_lease(subscriptions)
+
+    def update_subscriber(self, topic, subscriber_url, lease,
+                          mode="subscribe"):
+        """
+        Given the topic, subscriber url and lease time, this method
+        adds a new subscriber and saves it.
+        """
+
+        with metrics.timer("store_seconds", labels={'op': "write"}), \
+                profiler.span("save_subscriptions", mode=mode):
+            if mode == "subscribe":
+                record = ("subscribe", topic, subscriber_url,
+                          time.time() + float(lease))
+                saved = self.store.subscribe(*record[1:])
+            elif mode == "unsubscribe":
+                record = ("unsubscribe", topic, subscriber_url)
+                saved = self.store.unsubscribe(*record[1:])
+            else:
+                return None
+        if saved:
+            self.index_patterns([record])
+        return saved
+
+    def update_subscriptions(self, requests):
+        """
+        Saves or removes the subscriptions of a list of verified
+        subscription requests, in a single write to the store.
+        """
+
         current_time = time.time()
-        subs = copy.deepcopy(subscriptions)
-        for topic in list(subscriptions):
-            for subscriber in subscriptions[topic]:
-                if subscriptions[topic][subscriber] <= current_time:
-                    del subs[topic][subscriber]
-        return subs
+        records = []
+        for request in requests:
+            if request['mode'] == "subscribe":
+                records.append(("subscribe", request['topic'],
+                                request['callback'],
+                                current_time + float(request['lease'])))
+            else:
+                records.append(("unsubscribe", request['topic'],
+                                request['callback']))
+        if not records:
+            return True
+
+        with metrics.timer("store_seconds", labels={'op': "write"}), \
+                profiler.span("save_subscriptions", mode="bulk"):
+            saved = self.store.update(records)
+        if saved:
+            self.index_patterns(records)
+        return saved
+
+    def verified(self, request):
+        """
+        Saves or removes the subscription of a verified subscription
+        request.
+        """
+
+        return self.update_subscriber(request['topic'], request['callback'],
+                                      request['lease'], mode=request['mode'])
 
     def base_n(self, num, bits,
                numerals="0123456789abcdefghijklmnopqrstuvwxyz"):
@@ -89,16 +360,17 @@ class HubPublisher(Hub):
     PuSH or ResourceSync mode and publishes to the appropriate subscribers.
     """
 
-    def __init__(self, env, start_response):
-        Hub.__init__(self)
+    def __init__(self, env, start_response, context=None):
+        Hub.__init__(self, context=context)
         self._env = env
         self._start_response = start_response
         self.push_url = ""
 
     def handle_push_request(self):
         """
-        Original PuSH spec mode. Fetches the resource in the hub.url param
-        and starts the broadcast of the data to the subscribers asynchronously.
+        Original PuSH spec mode. Accepts the ping and fetches the resource
+        in the hub.url param in the background, to broadcast it to the
+        subscribers.
         """
 
         query_st = self._env['wsgi.input'].read()
@@ -112,51 +384,33 @@ class HubPublisher(Hub):
                                 hub.url and hub.mode required.")
 
         if mode == "publish":
-            future = self.send(self.push_url,
-                               method='GET',
-                               callback=self.publish_push_payload)
-            while future.running():
-                pass
-            if future.done():
-                return self.respond(code=204, msg="")
-            else:
-                return self.respond(code=400,
-                                    msg="Error retrieving resource url:\
-                                    %s" % self.push_url)
+            wait = self.rate_limited("topic", self.push_url)
+            if wait:
+                return self.reject(429, "topic_rate", wait,
+                                   "Too many publishes for the topic.")
+            metrics.incr("publishes", labels={'topic': self.push_url,
+                                              'mode': "push"})
+            if not self.fetcher.submit(self.push_url):
+                return self.respond(code=503,
+                                    msg="Too many pending fetches.")
+            return self.respond(code=202, msg="")
 
         return self.respond(code=400, msg="Unrecognised mode")
 
-    def publish_push_payload(self, future_session, response):
-        """
-        The async callback method for the PuSH payload. Broadcasts the
-        payload to the subscribers.
-        """
-
-        subscriptions = self.read_subscriptions()
-        if not subscriptions:
-            return self.respond(code=500, msg="Error reading subscriptions.")
-        subscribers = subscriptions.get(self.push_url, None)
-        if not subscribers:
-            return self.respond(code=204, msg="")
-
-        payload = response.content
-        content_type = response.headers.get('content-type')
-        headers = {
-            'Content-Type': content_type,
-            'Content-Length': str(len(payload))
-        }
-        for subscriber in subscribers:
-            self.send(subscriber, data=payload, headers=headers)
-
-        return
-
     def handle_resourcesync_request(self, content_type="application/xml"):
         """
         ResourceSync payload. Gets the topic and hub url from the link
         header and broadcasts to the subscribers.
         """
 
-        payload = self._env['wsgi.input'].read()
+        try:
+            payload = read_body(self._env,
+                                max_size=self.config['max_body_size'],
+                                spool_size=self.config['spool_size'])
+        except BodyTooLarge:
+            return self.respond(code=413,
+                                msg="Payload larger than %s bytes." %
+                                self.config['max_body_size'])
         if not payload:
             return self.respond(code=400, msg="Payload of size > 0 expected.")
 
@@ -169,15 +423,22 @@ class HubPublisher(Hub):
         if not topic and not hub_url:
             return self.respond(code=400,
                                 msg="ResourceSync Link header spec not met.")
-        if self.config['trusted_topics'] and \
+        if self.config['trusted_topics'].configured and \
                 topic.strip() not in self.config['trusted_topics']:
             return self.respond(code=403,
                                 msg="Topic is not registered with the hub.")
-
-        subscriptions = self.read_subscriptions()
-        if not subscriptions:
+        wait = self.rate_limited("topic", topic)
+        if wait:
+            return self.reject(429, "topic_rate", wait,
+                               "Too many publishes for the topic.")
+
+        metrics.incr("publishes", labels={'topic': topic,
+                                          'mode': "resourcesync"})
+        subscribers = self.get_subscribers(topic)
+        if subscribers is None:
             return self.respond(code=500, msg="Error reading subscriptions.")
-        subscribers = subscriptions.get(topic, None)
+        metrics.set("topic_subscribers", len(subscribers),
+                    labels={'topic': topic})
         if not subscribers:
             return self.respond(code=204)
 
@@ -192,12 +453,24 @@ subscriber(s)""" % len(subscribers))
         self.log_msg['msg'].append("Payload size: %s bytes." %
                                    str(len(payload)))
         self.log_msg['link_header'] = link_header
-        self.log_msg['payload'] = payload
+        self.log_msg['topic'] = topic
+        if isinstance(payload, str):
+            # spooled payloads are not copied into the log.
+            self.log_msg['payload'] = payload
 
         self.log()
 
-        for subscriber in subscribers:
-            self.send(subscriber, data=payload, headers=headers)
+        if self.duplicates and not self.duplicates.add(topic, payload):
+            # already published
+            return self.respond(code=204)
+
+        if self.aggregator and self.aggregator.add(topic, payload, headers):
+            return self.respond(code=202, msg="")
+
+        if not self.deliver(subscribers, payload, headers):
+            if self.duplicates:
+                self.duplicates.discard(topic, payload)
+            return self.respond(code=500, msg="Error queuing notification.")
 
         # success
         return self.respond(code=204)
@@ -211,6 +484,22 @@ subscriber(s)""" % len(subscribers))
         if not self._env.get('REQUEST_METHOD', None) == 'POST':
             return self.respond(code=405, msg='Method Not Allowed.')
 
+        # before the body is read
+        if self.config['trusted_publishers'].configured and \
+                self._env.get('REMOTE_ADDR') not in \
+                self.config['trusted_publishers']:
+            metrics.incr("publishes_rejected", labels={'reason': "untrusted"})
+            return self.respond(code=403,
+                                msg="Publisher is not trusted by the hub.")
+        wait = self.rate_limited("publisher", self._env.get('REMOTE_ADDR'))
+        if wait:
+            return self.reject(429, "publisher_rate", wait,
+                               "Too many publishes from the publisher.")
+        if self.overloaded():
+            return self.reject(503, "overloaded",
+                               self.config['overload_retry_after'],
+                               "Too many notifications pending delivery.")
+
         content_type = self._env.get('CONTENT_TYPE', None).lower()
         if not content_type:
             return self.respond(code=400,
@@ -219,7 +508,7 @@ subscriber(s)""" % len(subscribers))
         if content_type == "application/x-www-form-urlencoded":
             return self.handle_push_request()
         elif not self.config['mimetypes'] or \
-                content_type in self.config['mimetypes']:
+                content_type.split(";")[0].strip() in self.config['mimetypes']:
             return self.handle_resourcesync_request(content_type=content_type)
 
         # error
@@ -232,78 +521,24 @@ class HubSubscriber(Hub):
     Listens for and processes subscription requests.
     """
 
-    def __init__(self, env, start_response):
-        Hub.__init__(self)
+    def __init__(self, env, start_response, context=None):
+        Hub.__init__(self, context=context)
         self._env = env
         self._start_response = start_response
 
-    def update_subscriber(self, topic, subscriber_url, lease,
-                          mode="subscribe"):
-        """
-        Given the topic, subscriber url and lease time, this method
-        adds a new subscriber and saves it.
-        """
-
-        subscriptions = {}
-        subscriptions = self.read_subscriptions()
-
-        if not subscriptions:
-            subscriptions = {}
-        try:
-            subscriptions[topic]
-        except Exception:
-            subscriptions[topic] = {}
-
-        if mode == "subscribe":
-            subscriptions[topic][subscriber_url] = time.time() + lease
-        elif mode == "unsubscribe":
-            if subscriber_url in subscriptions[topic]:
-                del subscriptions[topic][subscriber_url]
-
-        return self.save_subscriptions(subscriptions)
-
     def subscribe(self, to_verify):
         """
-        Handles Subscriptions. Checks the request, sends a challenge to
-        the subscriber and verifies if the client relays the challenge back.
+        Handles Subscriptions. Sends a challenge to the subscriber and
+        verifies if the client relays the challenge back, then saves
+        the subscription.
         Handles both subscription and unsubscription requests.
         """
 
-        challenge = self.base_n(abs(hash(time.time())), 36)
-        payload = {
-            'hub.mode': to_verify['mode'],
-            'hub.topic': to_verify['topic'],
-            'hub.challenge': challenge
-        }
-
-        url = '?'.join([to_verify['callback'], urllib.urlencode(payload)])
-
-        subscriber_saved = False
-        try:
-            future = self.send(url, method='GET')
-            response = future.result()
-            payload = response.content
-
-            if challenge in payload:
-                if to_verify['mode'] == 'subscribe':
-                    subscriber_saved = self.update_subscriber(to_verify['topic'],
-                                           to_verify['callback'],
-                                           to_verify['lease'],
-                                           mode="subscribe")
-                else:
-                    subscriber_saved = self.update_subscriber(to_verify['topic'],
-                                           to_verify['callback'],
-                                           to_verify['lease'],
-                                           mode="unsubscribe")
-            else:
-                return self.respond(code=409,
-                                    msg="Subscription verification failed")
-
-        except Exception:
+        if self.verifier.check(to_verify) != VERIFIED:
             return self.respond(code=409,
                                 msg="Subscription verification failed")
 
-        if subscriber_saved:
+        if self.verified(to_verify):
             # success
             return self.respond(code=204, msg="Subscription successful.")
         else:
@@ -335,6 +570,19 @@ class HubSubscriber(Hub):
         if not mode in ['subscribe', 'unsubscribe']:
             return self.respond(code=400, msg="Bad request: Unrecognized mode")
 
+        if callback and not valid_callback(callback):
+            return self.respond(code=400, msg="Bad request: \
+                Invalid characters in hub.callback")
+
+        if topic and not self.valid_topic(topic):
+            return self.respond(code=400, msg="Bad request: \
+                A wildcard may only end the topic")
+
+        lease = parse_lease(lease)
+        if lease is None:
+            return self.respond(code=400, msg="Bad request: \
+                hub.lease_seconds must be a positive number")
+
         verify = verify[0]
         if not verify in ['sync', 'async']:
             return self.respond(code=400,
@@ -345,11 +593,149 @@ class HubSubscriber(Hub):
                      'callback': callback,
                      'topic': topic,
                      'lease': lease}
-        # async
-        # FIXME: implement sync
+        if verify == 'async':
+            if not self.verifier.submit(to_verify):
+                return self.respond(code=503,
+                                    msg="Too many pending verifications.")
+            return self.respond(code=202, msg="")
+
         return self.subscribe(to_verify)
 
 
+class HubBulkSubscriber(Hub):
+    """
+    Processes many subscription requests at once. The request is a json
+    object with the verification mode and the list of subscription
+    requests:
+
+        {"verify": "sync",
+         "subscriptions": [{"mode": "subscribe", "topic": "http://...",
+                            "callback": "http://...",
+                            "lease_seconds": 86400}, ...]}
+
+    The callbacks are challenged concurrently, and the verified
+    requests are saved in a single write to the store. The response is
+    the list of the results of the requests, in order.
+    """
+
+    RESULTS = {VERIFIED: "verified", DECLINED: "declined",
+               FAILED: "failed"}
+
+    def __init__(self, env, start_response, context=None):
+        Hub.__init__(self, context=context)
+        self._env = env
+        self._start_response = start_response
+
+    @staticmethod
+    def parse_request(entry):
+        """
+        The subscription request of an entry of the list, or None if it
+        is not valid.
+        """
+
+        if not isinstance(entry, dict):
+            return None
+        request = {
+            'mode': entry.get('mode'),
+            'topic': entry.get('topic'),
+            'callback': entry.get('callback'),
+            'lease': entry.get('lease_seconds', 2678400),
+        }
+        if request['mode'] not in ['subscribe', 'unsubscribe'] or \
+                not isinstance(request['topic'], basestring) or \
+                not isinstance(request['callback'], basestring) or \
+                not request['topic'] or not request['callback'] or \
+                not valid_callback(request['callback']):
+            return None
+        request['lease'] = parse_lease(request['lease'])
+        if request['lease'] is None:
+            return None
+        for key in ['topic', 'callback']:
+            request[key] = request[key].encode("utf-8")
+        return request
+
+    def respond_json(self, code, data):
+        self._start_response("%s %s" % (code, HTTP_STATUS_CODE[code]),
+                             [('Content-Type', "application/json")])
+        return [json.dumps(data)]
+
+    def handle(self):
+        """
+        Verifies the subscription requests and saves the verified ones.
+        """
+
+        if not self._env.get('REQUEST_METHOD', None) == 'POST':
+            return self.respond(code=405, msg='Method Not Allowed.')
+
+        content_type = self._env.get('CONTENT_TYPE', "").lower()
+        if content_type.split(";")[0].strip() != "application/json":
+            return self.respond(code=406,
+                                msg="content-type header not recognised.")
+
+        try:
+            payload = read_body(self._env,
+                                max_size=self.config['max_body_size'],
+                                spool_size=self.config['spool_size'])
+        except BodyTooLarge:
+            return self.respond(code=413,
+                                msg="Payload larger than %s bytes." %
+                                self.config['max_body_size'])
+        try:
+            data = json.loads(str(payload))
+            entries = data['subscriptions']
+            verify = data.get('verify', "sync")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.respond(code=400, msg="Bad request: Expected a \
+                json object with a list of subscriptions.")
+        if not isinstance(entries, list):
+            return self.respond(code=400, msg="Bad request: Expected a \
+                list of subscriptions.")
+        if verify not in ['sync', 'async']:
+            return self.respond(code=400,
+                                msg="Bad request: \
+                                Unsupported verification mode")
+        if len(entries) > self.config['bulk_max_subscriptions']:
+            return self.respond(code=413,
+                                msg="More than %s subscriptions." %
+                                self.config['bulk_max_subscriptions'])
+
+        # a later request for the same topic and callback replaces an
+        # earlier one, each pair is challenged once.
+        results = []
+        requests = OrderedDict()
+        for num, entry in enumerate(entries):
+            request = self.parse_request(entry)
+            if not request or not self.valid_topic(request['topic']):
+                results.append("invalid")
+                continue
+            key = (request['topic'], request['callback'])
+            if key in requests:
+                results[requests[key][0]] = "replaced"
+                del requests[key]
+            requests[key] = (num, request)
+            results.append(None)
+
+        if verify == 'async':
+            for num, request in requests.values():
+                results[num] = "accepted" \
+                    if self.verifier.submit(request) else "rejected"
+            return self.respond_json(202, {'results': results})
+
+        pending = requests.values()
+        checked = self.verifier.check_all([request
+                                           for num, request in pending])
+        verified = []
+        for (num, request), result in zip(pending, checked):
+            results[num] = self.RESULTS[result]
+            if result == VERIFIED:
+                verified.append(request)
+
+        if not self.update_subscriptions(verified):
+            return self.respond(code=500,
+                                msg="Error saving subscribers to file.")
+        return self.respond_json(200, {'results': results})
+
+
 class HubRegister(Hub):
     """
     A HTML form for publishers to register at the hub. Expects a topic
@@ -357,8 +743,8 @@ class HubRegister(Hub):
     Accepts only resourcesync payload.
     """
 
-    def __init__(self, env, start_response):
-        Hub.__init__(self)
+    def __init__(self, env, start_response, context=None):
+        Hub.__init__(self, context=context)
         self._env = env
         self._start_response = start_response
 
@@ -384,13 +770,48 @@ class HubRegister(Hub):
             return self.respond(code=500, msg="Unexpected server error")
 
 
+class HubMetrics(Hub):
+    """
+    Exposes the metrics of the hub, merged across the worker processes,
+    in the Prometheus text format.
+    """
+
+    def __init__(self, env, start_response, context=None):
+        Hub.__init__(self, context=context)
+        self._env = env
+        self._start_response = start_response
+
+    def handle(self):
+        """
+        Renders the metrics.
+        """
+
+        if not self.config['metrics']:
+            return self.respond(code=404, msg="Metrics are disabled.")
+        if self._env.get('REQUEST_METHOD') not in ['GET', 'HEAD']:
+            return self.respond(code=405, msg="Method not supported.")
+
+        if self.queue:
+            metrics.set("delivery_queue_depth", self.queue.depth())
+        if self.metrics_writer:
+            snapshot = self.metrics_writer.read_all()
+        else:
+            snapshot = metrics.snapshot()
+
+        self._start_response("200 OK", [
+            ('Content-Type', "text/plain; version=0.0.4; charset=utf-8")])
+        if self._env.get('REQUEST_METHOD') == 'HEAD':
+            return [""]
+        return [render(snapshot)]
+
+
 class HubRegisterSuccess(Hub):
     """
     Displays the registration success page.
     """
 
-    def __init__(self, env, start_response):
-        Hub.__init__(self)
+    def __init__(self, env, start_response, context=None):
+        Hub.__init__(self, context=context)
         self._env = env
         self._start_response = start_response
 
@@ -432,34 +853,284 @@ class HubRegisterSuccess(Hub):
                                 msg="Unexpected server error: %s" % err)
 
 
-def application(env, start_response):
+class HubContext(AppContext):
     """
-    WSGI entry point to the hub.
+    The application context of the hub. Also holds the subscription
+    store, the shared index, the delivery engine and the background
+    threads of the worker.
     """
-    hub = Hub()
-    urlparse.urlparse(hub.config['server_path'])
-
-    req_path = env.get('PATH_INFO', "/")
-
-    # replace server path
-    if hub.config['server_path']:
-        req_path = req_path.replace(hub.config['server_path'], "")
-
-    if not req_path.startswith("/"):
-        req_path = "/" + req_path
-
-    if req_path == "/publish":
-        publisher = HubPublisher(env, start_response)
-        return publisher.handle()
-    elif req_path == "/subscribe":
-        subscriber = HubSubscriber(env, start_response)
-        return subscriber.handle()
-    elif req_path == "/register":
-        hubregister = HubRegister(env, start_response)
-        return hubregister.handle()
-    elif req_path == "/registersuccess":
-        hubregistersuccess = HubRegisterSuccess(env, start_response)
-        return hubregistersuccess.handle()
-    else:
+
+    store = None
+    index = None
+    queue = None
+    dispatcher = None
+    engine = None
+    fetcher = None
+    aggregator = None
+    duplicates = None
+    metrics_writer = None
+    verifier = None
+    patterns = None
+    buckets = None
+    inflight = None
+    sweeper = None
+    index_builder = None
+
+    def __init__(self, classname, config_files=None):
+        # the settings each background thread was started with
+        self._settings = {}
+        AppContext.__init__(self, classname, config_files=config_files)
+
+    def load(self):
+        """
+        Reads the config and reopens the subscription store if its
+        settings have changed. (Re)starts the background threads whose
+        settings have changed.
+        """
+
+        store_config = self.store_config()
+        queue_config = self.queue_config()
+        AppContext.load(self)
+        if not self.store or self.store_config() != store_config:
+            self.store = Hub.open_store(self.config)
+        if self.queue_config() != queue_config:
+            self.queue = Hub.open_queue(self.config)
+        if not self.inflight:
+            self.inflight = InflightBytes()
+        self.inflight.queue = self.queue
+
+        buckets = self.buckets
+        if not self.config['publisher_rate'] and \
+                not self.config['topic_rate']:
+            self.buckets = None
+        elif not self.buckets or \
+                self.buckets.filename != self.config['rate_limit_file'] or \
+                self.buckets.slots != self.config['rate_limit_slots']:
+            self.buckets = TokenBuckets(self.config['rate_limit_file'],
+                                        slots=self.config['rate_limit_slots'])
+        if buckets and buckets is not self.buckets:
+            # requests still holding the old buckets are not limited.
+            buckets.close()
+
+        self.restart("engine",
+                     (self.config['delivery_engine'],
+                      self.config['async_max_concurrency'],
+                      self.config['async_max_per_host'],
+                      self.config['transport']),
+                     lambda: open_engine(self.config))
+        send = self.engine.send if self.engine else self.send
+        if not self.dispatcher:
+            self.dispatcher = Dispatcher.from_config(self.config, send)
+        else:
+            # keeps the circuits and the retries across reloads
+            self.dispatcher.configure(self.config, send)
+        if not self.fetcher:
+            self.fetcher = FeedFetcher(self.send, self.publish_feed)
+        self.fetcher.max_pending = self.config['fetch_max_pending']
+        self.fetcher.cache.max_size = self.config['feed_cache_size']
+        self.fetcher.debounce = self.config['fetch_debounce']
+
+        if not self.config['aggregation_window']:
+            if self.aggregator:
+                # publishes the pending batches
+                self.aggregator.stop()
+            self.aggregator = None
+        elif not self.aggregator:
+            self.aggregator = Aggregator(self.publish_notification)
+        if self.aggregator:
+            self.aggregator.window = self.config['aggregation_window']
+            self.aggregator.max_urls = self.config['aggregation_max_urls']
+            self.aggregator.max_bytes = self.config['aggregation_max_bytes']
+
+        if not self.config['dedup_window']:
+            self.duplicates = None
+        elif not self.duplicates:
+            self.duplicates = DuplicateFilter()
+        if self.duplicates:
+            self.duplicates.window = self.config['dedup_window']
+            self.duplicates.max_size = self.config['dedup_cache_size']
+
+        self.restart("verifier", (self.config['verify_workers'],),
+                     lambda: Verifier(self.send, self.verified,
+                                      workers=self.config['verify_workers']))
+        self.verifier.max_pending = self.config['verify_max_pending']
+        self.verifier.timeout = self.config['verify_timeout']
+        self.verifier.max_attempts = self.config['verify_max_attempts']
+        self.verifier.retry_delay = self.config['verify_retry_delay']
+
+        self.restart("sweeper",
+                     (self.store, self.config['lease_sweep_interval']),
+                     lambda: LeaseSweeper(
+                         self.store,
+                         interval=self.config['lease_sweep_interval']))
+
+        self.restart("patterns",
+                     (self.store, self.config['pattern_subscriptions'],
+                      self.config['pattern_refresh_interval']),
+                     lambda: self.config['pattern_subscriptions'] and
+                     PatternIndex(
+                         self.store,
+                         interval=self.config['pattern_refresh_interval']))
+
+        if not self.config['shared_index']:
+            self.index = None
+        elif not self.index or \
+                self.index.filename != self.config['shared_index_file']:
+            self.index = SharedIndex(self.config['shared_index_file'])
+        self.restart("index_builder",
+                     (self.store, self.index,
+                      self.config['shared_index_interval']),
+                     lambda: self.index and IndexBuilder(
+                         self.index, self.store,
+                         interval=self.config['shared_index_interval']))
+
+        self.restart("metrics_writer",
+                     (self.config['metrics'], self.config['metrics_dir'],
+                      self.config['metrics_interval']),
+                     lambda: self.config['metrics'] and MetricsWriter(
+                         metrics, self.config['metrics_dir'],
+                         interval=self.config['metrics_interval'],
+                         collect=self.collect_metrics))
+
+    def collect_metrics(self):
+        """
+        Sets the gauges of the work pending in this worker.
+        """
+
+        metrics.set("fetches_pending", self.fetcher.pending(),
+                    aggregate="sum")
+        if self.aggregator:
+            metrics.set("aggregations_pending", self.aggregator.pending(),
+                        aggregate="sum")
+        if self.dispatcher.timer:
+            metrics.set("retries_pending", self.dispatcher.timer.pending(),
+                        aggregate="sum")
+        if self.engine:
+            metrics.set("deliveries_active", self.engine.active(),
+                        aggregate="sum")
+        metrics.set("verifications_pending", self.verifier.pending(),
+                    aggregate="sum")
+        metrics.set("inflight_bytes", self.inflight.sending(),
+                    aggregate="sum")
+
+    def publish_feed(self, topic, response):
+        """
+        Fans out a feed fetched by the fetcher, with the current store
+        and dispatcher.
+        """
+
+        return Hub(context=self).publish_feed(topic, response)
+
+    def publish_notification(self, topic, payload, headers):
+        """
+        Sends a notification merged by the aggregator, with the current
+        store and dispatcher.
+        """
+
+        return Hub(context=self).publish_notification(topic, payload,
+                                                      headers)
+
+    def verified(self, request):
+        """
+        Saves a subscription verified by the verifier, with the current
+        store.
+        """
+
+        return Hub(context=self).verified(request)
+
+    def restart(self, name, settings, factory):
+        """
+        Starts the background thread kept in the attribute name, made by
+        factory, or restarts it when the settings it depends on have
+        changed. The factory returns None if the thread is disabled.
+        """
+
+        thread = getattr(self, name)
+        if thread and self._settings.get(name) == settings:
+            return
+
+        if thread:
+            thread.stop()
+        thread = factory()
+        if thread:
+            thread.start()
+        setattr(self, name, thread)
+        self._settings[name] = settings
+
+    def close(self, timeout=5):
+        """
+        Stops the background threads of the context and waits for them
+        to exit. The pending aggregated batches are published first;
+        the pending retries and debounced fetches are dropped.
+        """
+
+        timers = []
+        if self.aggregator:
+            timers.append(self.aggregator.stop())
+        if self.fetcher:
+            timers.append(self.fetcher.stop())
+        if self.verifier:
+            timers.append(self.verifier.timer)
+        for name in ["engine", "verifier", "sweeper", "patterns",
+                     "index_builder", "metrics_writer"]:
+            thread = getattr(self, name)
+            if thread:
+                thread.stop()
+                if isinstance(thread, threading.Thread):
+                    thread.join(timeout)
+            setattr(self, name, None)
+        if self.dispatcher:
+            timers.append(self.dispatcher.stop())
+        for timer in timers:
+            if timer:
+                timer.join(timeout)
+        if self.buckets:
+            self.buckets.close()
+            self.buckets = None
+        self._settings = {}
+        AppContext.close(self)
+
+    def queue_config(self):
+        """
+        The config values the delivery queue depends on.
+        """
+
+        return (self.config.get('delivery'),
+                self.config.get('delivery_queue_file'),
+                self.config.get('delivery_visibility_timeout'))
+
+    def store_config(self):
+        """
+        The config values the subscription store depends on.
+        """
+
+        return (self.config.get('subscription_store'),
+                self.config.get('subscriptions_db'),
+                self.config.get('subscribers_file'))
+
+
+ROUTES = {
+    "/publish": HubPublisher,
+    "/subscribe": HubSubscriber,
+    "/subscribe/bulk": HubBulkSubscriber,
+    "/register": HubRegister,
+    "/registersuccess": HubRegisterSuccess,
+    "/metrics": HubMetrics,
+}
+
+
+def application(env, start_response, context=None):
+    """
+    WSGI entry point to the hub. Uses the hub context of the process
+    unless one is given.
+    """
+    context = context or HubContext.get("hub")
+
+    req_path = context.request_path(env)
+    handler = ROUTES.get(req_path)
+    if not handler:
         start_response("404 Not Found", [('Content-Type', 'text/html')])
         return ["Requested resource not found."]
+
+    with profiler.request(req_path):
+        return handler(env, start_response, context=context).handle()
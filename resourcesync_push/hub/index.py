@@ -0,0 +1,249 @@
+"""
+A read-only topic -> subscribers index shared by all the hub worker
+processes through a memory-mapped file.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+# magic, format version, number of topics
+HEADER = struct.Struct("<4sIQ")
+# offset and length of the topic, offset and length of its subscribers
+ENTRY = struct.Struct("<QIQI")
+GENERATION = struct.Struct("<Q")
+# lease and length of the callback of a subscriber, followed by the
+# callback
+SUBSCRIBER = struct.Struct("<dI")
+
+MAGIC = "RSPI"
+VERSION = 2
+
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class SharedIndex(object):
+    """
+    The index is written by a single process into a new file that is
+    renamed over the old one, after which the generation counter in the
+    .gen file is incremented. The other workers map both files read-only
+    and only map the new index when they see the generation change.
+
+    The index file holds a table of the topics, sorted, followed by the
+    topics and their length-prefixed subscribers. A lookup is a binary
+    search in the mapped table, and only reads the subscribers of its
+    topic.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.generation_file = filename + ".gen"
+        self.lock_file = filename + ".lock"
+        self._gen_map = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def generation(self):
+        """
+        The generation of the current index, or None if no index has
+        been written yet.
+        """
+
+        if not self._gen_map:
+            try:
+                with open(self.generation_file, "rb") as gen_file:
+                    self._gen_map = mmap.mmap(gen_file.fileno(),
+                                              GENERATION.size,
+                                              access=mmap.ACCESS_READ)
+            except (IOError, ValueError, mmap.error):
+                return None
+        return GENERATION.unpack_from(self._gen_map)[0]
+
+    def current(self):
+        """
+        Returns the (generation, number of topics, mapped file) of the
+        current index, mapping it again only if the generation changed.
+        """
+
+        generation = self.generation()
+        if not generation:
+            return None
+
+        index = self._index
+        if index and index[0] == generation:
+            return index
+
+        with self._lock:
+            if self._index and self._index[0] == generation:
+                return self._index
+            try:
+                with open(self.filename, "rb") as index_file:
+                    data = mmap.mmap(index_file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            except (IOError, ValueError, mmap.error) as err:
+                print(err)
+                return None
+            magic, version, count = HEADER.unpack_from(data)
+            if magic != MAGIC or version != VERSION:
+                return None
+            # the previous map is closed once no lookup is using it.
+            self._index = (generation, count, data)
+            return self._index
+
+    def get_subscribers(self, topic):
+        """
+        Returns the {callback: lease} dict of the active subscribers of
+        the topic, or None if there is no index or the topic is not in
+        it, as it may have been subscribed to since the index was
+        written.
+        """
+
+        index = self.current()
+        if not index:
+            return None
+        generation, count, data = index
+
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, value_offset, value_length = \
+                ENTRY.unpack_from(data, HEADER.size + middle * ENTRY.size)
+            key = data[key_offset:key_offset + key_length]
+            if key < topic:
+                low = middle + 1
+            elif key > topic:
+                high = middle
+            else:
+                current_time = time.time()
+                subscribers = {}
+                offset = value_offset
+                end = value_offset + value_length
+                while offset < end:
+                    lease, length = SUBSCRIBER.unpack_from(data, offset)
+                    offset += SUBSCRIBER.size
+                    if lease > current_time:
+                        subscribers[data[offset:offset + length]] = lease
+                    offset += length
+                return subscribers
+        return None
+
+    def write(self, subscriptions):
+        """
+        Writes a new index of the subscriptions dict and publishes it by
+        incrementing the generation.
+        """
+
+        topics = sorted(topic for topic in subscriptions if topic)
+        entries = []
+        chunks = []
+        offset = HEADER.size + len(topics) * ENTRY.size
+        for topic in topics:
+            value = []
+            for callback, lease in subscriptions[topic].items():
+                callback = encode(callback)
+                value.extend([SUBSCRIBER.pack(lease, len(callback)),
+                              callback])
+            value = "".join(value)
+            topic = encode(topic)
+            entries.append(ENTRY.pack(offset, len(topic),
+                                      offset + len(topic), len(value)))
+            chunks.extend([topic, value])
+            offset += len(topic) + len(value)
+
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, "wb") as index_file:
+            index_file.write(HEADER.pack(MAGIC, VERSION, len(topics)))
+            index_file.write("".join(entries))
+            index_file.write("".join(chunks))
+        os.rename(tmp_file, self.filename)
+
+        # written in place, the readers have the file mapped.
+        generation = (self.generation() or 0) + 1
+        gen_fd = os.open(self.generation_file, os.O_RDWR | os.O_CREAT,
+                         0o644)
+        try:
+            os.write(gen_fd, GENERATION.pack(generation))
+        finally:
+            os.close(gen_fd)
+        return generation
+
+
+class IndexBuilder(threading.Thread):
+    """
+    Rebuilds the shared index from the subscription store whenever the
+    store changes, checking every interval seconds. Every hub worker
+    runs one, but only the one holding the lock file writes the index;
+    the others take over if that worker exits.
+    """
+
+    def __init__(self, index, store, interval=1.0):
+        threading.Thread.__init__(self, name="IndexBuilder")
+        self.daemon = True
+        self.index = index
+        self.store = store
+        self.interval = interval
+        self.built = None
+        self._lock_fd = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            if self.is_writer():
+                self.build()
+
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+
+    def is_writer(self):
+        """
+        Tries to become the process writing the index.
+        """
+
+        if self._lock_fd is not None:
+            return True
+
+        lock_fd = os.open(self.index.lock_file, os.O_RDWR | os.O_CREAT,
+                          0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(lock_fd)
+            return False
+        self._lock_fd = lock_fd
+        return True
+
+    def build(self):
+        """
+        Writes a new index if the store has changed since the last one.
+        Returns True if an index was written.
+        """
+
+        generation = self.store.generation()
+        if self.built is not None and generation == self.built:
+            return False
+
+        subscriptions = self.store.read_all()
+        if subscriptions is None:
+            return False
+        try:
+            self.index.write(subscriptions)
+        except (IOError, OSError) as err:
+            print(err)
+            return False
+        self.built = generation
+        return True
+
+    def stop(self):
+        """
+        Stops the builder and gives up writing the index.
+        """
+
+        self._stopped.set()
@@ -0,0 +1,180 @@
+"""
+Wildcard topic subscriptions. A subscription to a topic ending with *
+is a subscription to all the topics starting with the rest of it, such
+as http://example.org/dataset/* for all the datasets.
+"""
+
+import threading
+import time
+
+
+WILDCARD = "*"
+
+
+def is_pattern(topic):
+    return topic.endswith(WILDCARD)
+
+
+def valid_topic(topic):
+    """
+    Whether the topic can be subscribed to: a wildcard may only end it.
+    """
+
+    return WILDCARD not in topic[:-1]
+
+
+class TopicTrie(object):
+    """
+    Maps prefixes to values in a character trie, so that finding the
+    prefixes of a topic takes one step per character of the topic,
+    whatever the number of prefixes.
+    """
+
+    # the key of the value in a node, never a character
+    VALUE = None
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def get(self, prefix, default=None):
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return default
+        return node.get(self.VALUE, default)
+
+    def insert(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        if self.VALUE not in node:
+            self.size += 1
+        node[self.VALUE] = value
+
+    def remove(self, prefix):
+        """
+        Removes a prefix and the nodes only it used.
+        """
+
+        path = [self.root]
+        for char in prefix:
+            node = path[-1].get(char)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].pop(self.VALUE, self) is self:
+            return
+        self.size -= 1
+        for char in reversed(prefix):
+            node = path.pop()
+            if node:
+                break
+            del path[-1][char]
+
+    def match(self, topic):
+        """
+        The (prefix, value) of the prefixes of the topic.
+        """
+
+        node = self.root
+        matches = []
+        for num, char in enumerate(topic):
+            if self.VALUE in node:
+                matches.append((topic[:num], node[self.VALUE]))
+            node = node.get(char)
+            if node is None:
+                return matches
+        if self.VALUE in node:
+            matches.append((topic, node[self.VALUE]))
+        return matches
+
+
+class PatternIndex(threading.Thread):
+    """
+    The wildcard subscriptions of the store, in a trie of their
+    prefixes. The trie is rebuilt whenever the wildcard subscriptions
+    of the store change, checking every interval seconds; the
+    subscriptions made by this process are added at once.
+    """
+
+    def __init__(self, store, interval=1.0):
+        threading.Thread.__init__(self, name="PatternIndex")
+        self.daemon = True
+        self.store = store
+        self.interval = interval
+        self.built = None
+        self.trie = TopicTrie()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        generation = self.store.pattern_generation()
+        if self.refresh():
+            self.built = generation
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            generation = self.store.pattern_generation()
+            if generation is not None and generation != self.built and \
+                    self.refresh():
+                self.built = generation
+
+    def refresh(self):
+        """
+        Rebuilds the trie from the store. Returns True on success.
+        """
+
+        patterns = self.store.read_patterns()
+        if patterns is None:
+            return False
+        trie = TopicTrie()
+        for pattern, subscribers in patterns.items():
+            trie.insert(pattern[:-len(WILDCARD)], subscribers)
+        with self._lock:
+            self.trie = trie
+        return True
+
+    def subscribe(self, pattern, callback, lease):
+        prefix = pattern[:-len(WILDCARD)]
+        with self._lock:
+            subscribers = self.trie.get(prefix)
+            if subscribers is None:
+                subscribers = {}
+                self.trie.insert(prefix, subscribers)
+            subscribers[callback] = lease
+
+    def unsubscribe(self, pattern, callback):
+        prefix = pattern[:-len(WILDCARD)]
+        with self._lock:
+            subscribers = self.trie.get(prefix)
+            if subscribers is None:
+                return
+            subscribers.pop(callback, None)
+            if not subscribers:
+                self.trie.remove(prefix)
+
+    def get_subscribers(self, topic):
+        """
+        The {callback: lease} dict of the active subscribers of the
+        patterns matching the topic.
+        """
+
+        current_time = time.time()
+        matched = {}
+        with self._lock:
+            for prefix, subscribers in self.trie.match(topic):
+                for callback, lease in subscribers.items():
+                    if lease > current_time and \
+                            lease > matched.get(callback, 0):
+                        matched[callback] = lease
+        return matched
+
+    def size(self):
+        """
+        The number of patterns.
+        """
+
+        return self.trie.size
+
+    def stop(self):
+        self._stopped.set()
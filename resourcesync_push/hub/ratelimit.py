@@ -0,0 +1,143 @@
+"""
+Admission control for the publish requests: token bucket rate limits
+shared by the hub worker processes, and the bytes of the notifications
+waiting to be delivered.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+# the tokens of a bucket and the time they were counted
+SLOT = struct.Struct("<dd")
+
+
+class TokenBuckets(object):
+    """
+    Token buckets kept in a memory-mapped file, so that all the workers
+    of the hub count the requests of a publisher together. A key is
+    hashed to one of slots buckets, locked with a byte range lock while
+    it is updated. Keys hashed to the same slot share their bucket.
+
+    Without a filename, or if the file cannot be opened, the buckets
+    are only shared by the threads of this process.
+    """
+
+    def __init__(self, filename=None, slots=65536):
+        self.filename = filename
+        self.slots = slots
+        self._file = None
+        self._map = None
+        self._lock = threading.Lock()
+        size = slots * SLOT.size
+        if filename:
+            try:
+                self._file = open(filename, "a+b")
+                if os.fstat(self._file.fileno()).st_size < size:
+                    os.ftruncate(self._file.fileno(), size)
+                self._map = mmap.mmap(self._file.fileno(), size)
+            except (IOError, OSError, mmap.error) as err:
+                print("Error opening %s: %s" % (filename, err))
+                self._close()
+        if not self._map:
+            self._map = mmap.mmap(-1, size)
+
+    def take(self, key, rate, burst, cost=1):
+        """
+        Takes cost tokens from the bucket of key, which holds up to
+        burst tokens and gains rate tokens per second. Returns 0 if
+        they were taken, or else the seconds until there are enough.
+        """
+
+        offset = (zlib.crc32(key) & 0xffffffff) % self.slots * SLOT.size
+        cost = min(cost, burst)
+        with self._lock:
+            if not self._map:
+                # closed
+                return 0
+            if self._file:
+                fcntl.lockf(self._file, fcntl.LOCK_EX, SLOT.size, offset)
+            try:
+                tokens, updated = SLOT.unpack_from(self._map, offset)
+                now = time.time()
+                # a new bucket is full.
+                tokens = min(burst, tokens + max(now - updated, 0) * rate)
+                wait = 0
+                if tokens >= cost:
+                    tokens -= cost
+                else:
+                    wait = (cost - tokens) / float(rate)
+                SLOT.pack_into(self._map, offset, tokens, now)
+            finally:
+                if self._file:
+                    fcntl.lockf(self._file, fcntl.LOCK_UN, SLOT.size,
+                                offset)
+        return wait
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class InflightBytes(object):
+    """
+    The bytes of the notifications accepted but not delivered yet: the
+    deliveries sent by this worker, and the payloads left in the
+    delivery queue if the hub has one. The queue is read at most every
+    interval seconds.
+    """
+
+    def __init__(self, queue=None, interval=1.0):
+        self.queue = queue
+        self.interval = interval
+        self._bytes = 0
+        self._queued = 0
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        with self._lock:
+            self._bytes += size
+
+    def release(self, size):
+        with self._lock:
+            self._bytes -= size
+
+    def done(self, delivery, delivered):
+        """
+        The done callback of the deliveries counted with add().
+        """
+
+        self.release(len(delivery.payload))
+
+    def sending(self):
+        """
+        The bytes of the deliveries sent by this worker.
+        """
+
+        return self._bytes
+
+    def value(self):
+        queue = self.queue
+        if not queue:
+            return self._bytes
+        now = time.time()
+        if now - self._checked >= self.interval:
+            self._checked = now
+            queued = queue.pending_bytes()
+            if queued is not None:
+                self._queued = queued
+        return self._bytes + self._queued
@@ -0,0 +1,678 @@
+"""
+The subscription stores of the hub. The subscriptions are kept as
+topic -> {callback url: lease expiry time} mappings.
+"""
+
+from resourcesync_push.metrics import metrics
+from resourcesync_push.hub.patterns import is_pattern
+
+from contextlib import contextmanager
+
+import cPickle
+import fcntl
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def verify_lease(subscriptions):
+    """
+    Returns a copy of the dict of subscribers without the subscriptions
+    that are past their lease time.
+    """
+
+    current_time = time.time()
+    subs = {}
+    for topic, subscribers in subscriptions.items():
+        subs[topic] = dict((subscriber, lease)
+                           for subscriber, lease in subscribers.items()
+                           if lease > current_time)
+    return subs
+
+
+class SubscriptionStore(object):
+    """
+    The base class for the subscription stores.
+    """
+
+    def get_subscribers(self, topic):
+        """
+        Returns the {callback: lease} dict of the active subscribers of
+        the topic, or None if the store could not be read.
+        """
+        raise NotImplementedError
+
+    def subscribe(self, topic, callback, lease):
+        """
+        Adds or renews a subscription. The lease is the expiry time of
+        the subscription. Returns True on success.
+        """
+        raise NotImplementedError
+
+    def unsubscribe(self, topic, callback):
+        """
+        Removes a subscription. Returns True on success.
+        """
+        raise NotImplementedError
+
+    def update(self, records):
+        """
+        Applies a list of changes at once: ("subscribe", topic,
+        callback, lease) and ("unsubscribe", topic, callback) records.
+        Returns True on success.
+        """
+        raise NotImplementedError
+
+    def read_all(self):
+        """
+        Returns all the active subscriptions as a dict, or None if the
+        store could not be read.
+        """
+        raise NotImplementedError
+
+    def read_patterns(self):
+        """
+        Returns the active subscriptions of the wildcard topics, the
+        ones ending with *, as a dict, or None if the store could not
+        be read.
+        """
+        raise NotImplementedError
+
+    def save_all(self, subscriptions):
+        """
+        Replaces all the subscriptions with the ones in the dict.
+        Returns True on success.
+        """
+        raise NotImplementedError
+
+    def purge_expired(self, limit):
+        """
+        Deletes up to limit subscriptions whose lease is over, oldest
+        first. Returns the number of deleted subscriptions.
+        """
+        raise NotImplementedError
+
+    def generation(self):
+        """
+        Returns a value that changes whenever the subscriptions are
+        changed, by this or another process.
+        """
+        raise NotImplementedError
+
+    def pattern_generation(self):
+        """
+        Returns a value that changes whenever the subscriptions of the
+        wildcard topics are changed, by this or another process.
+        """
+        return self.generation()
+
+
+class LeaseHeap(object):
+    """
+    A min-heap of (lease, topic, callback) entries, so the expired
+    subscriptions can be found without scanning all of them. Renewed and
+    removed subscriptions leave stale entries behind, which are skipped
+    when they reach the top of the heap.
+    """
+
+    def __init__(self, subscriptions=None):
+        self.heap = [(lease, topic, callback)
+                     for topic, subscribers in (subscriptions or {}).items()
+                     for callback, lease in subscribers.items()]
+        heapq.heapify(self.heap)
+
+    def push(self, topic, callback, lease):
+        """
+        Adds the lease of a new or renewed subscription.
+        """
+
+        heapq.heappush(self.heap, (lease, topic, callback))
+
+    def pop_expired(self, subscriptions, current_time, limit):
+        """
+        Pops up to limit (topic, callback) pairs of the subscriptions
+        whose lease is over.
+        """
+
+        expired = []
+        while self.heap and self.heap[0][0] <= current_time and \
+                len(expired) < limit:
+            lease, topic, callback = heapq.heappop(self.heap)
+            if subscriptions.get(topic, {}).get(callback) == lease:
+                expired.append((topic, callback))
+        return expired
+
+
+class PickleStore(SubscriptionStore):
+    """
+    Keeps the subscriptions in a pickled snapshot of the dict and appends
+    every change as a record to a journal file next to it, so a write
+    only appends one line. The journal is compacted into a new snapshot
+    once it grows past compact_size bytes. The snapshot is replaced by
+    an atomic rename, so that readers never see a partly written file.
+    A lock file serializes the writers of all the processes.
+
+    The dict is kept in memory; a read only replays the journal records
+    appended by other processes since the last read.
+    """
+
+    compact_size = 1024 * 1024
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.journal_file = filename + ".journal"
+        self.lock_file = filename + ".lock"
+        self._lock = threading.RLock()
+        self._lock_fd = None
+        self._data = None
+        self._snapshot = None
+        self._offset = 0
+        self._leases = None
+        # the wildcard topics, and the number of changes to them
+        self._patterns = set()
+        self._pattern_changes = 0
+
+    @contextmanager
+    def locked(self, mode=fcntl.LOCK_SH):
+        """
+        Holds the lock of the store, shared between the readers or
+        exclusive for a writer.
+        """
+
+        with self._lock:
+            if self._lock_fd is None:
+                self._lock_fd = os.open(self.lock_file,
+                                        os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._lock_fd, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def file_stat(filename):
+        """
+        The values that change when a file is replaced, or None if
+        there is no such file.
+        """
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def load(self):
+        """
+        Brings the dict in memory up to date with the snapshot and the
+        journal. The lock must be held. Returns the dict of all the
+        subscriptions, including the expired ones.
+        """
+
+        snapshot = self.file_stat(self.filename)
+        if self._data is None or snapshot != self._snapshot:
+            data = {}
+            if snapshot:
+                try:
+                    with open(self.filename, "rb") as sub_file:
+                        data = cPickle.load(sub_file)
+                except EOFError:
+                    # new, empty file
+                    pass
+            self._data = data
+            self._snapshot = snapshot
+            self._offset = 0
+            self._leases = LeaseHeap(data)
+            self.index_patterns(data)
+
+        try:
+            with open(self.journal_file, "rb") as journal:
+                if os.fstat(journal.fileno()).st_size < self._offset:
+                    # the journal was emptied without a new snapshot.
+                    self._data = None
+                    return self.load()
+                journal.seek(self._offset)
+                records = journal.read()
+        except IOError:
+            return self._data
+
+        # a record is complete once its line is.
+        end = records.rfind("\n") + 1
+        for line in records[:end].splitlines():
+            self.apply(line)
+        self._offset += end
+        return self._data
+
+    def apply(self, line):
+        """
+        Applies a journal record to the dict in memory.
+        """
+
+        try:
+            record = [value.encode("utf-8")
+                      if isinstance(value, unicode) else value
+                      for value in json.loads(line)]
+        except ValueError:
+            # the partly written record of a crashed writer.
+            return
+
+        if record[0] == "subscribe":
+            mode, topic, callback, lease = record
+            self._data.setdefault(topic, {})[callback] = lease
+            self._leases.push(topic, callback, lease)
+        elif record[0] == "unsubscribe":
+            mode, topic, callback = record
+            subscribers = self._data.get(topic, {})
+            subscribers.pop(callback, None)
+            if not subscribers:
+                self._data.pop(topic, None)
+        else:
+            return
+
+        if topic and is_pattern(topic):
+            if topic in self._data:
+                self._patterns.add(topic)
+            else:
+                self._patterns.discard(topic)
+            self._pattern_changes += 1
+
+    def index_patterns(self, data):
+        """
+        Finds the wildcard topics of a new dict.
+        """
+
+        self._patterns = set(topic for topic in data
+                             if topic and is_pattern(topic))
+        self._pattern_changes += 1
+
+    def append(self, records):
+        """
+        Appends records to the journal and applies them. The exclusive
+        lock must be held, and the dict loaded.
+        """
+
+        lines = "".join([json.dumps(record) + "\n" for record in records])
+        journal = os.open(self.journal_file,
+                          os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(journal).st_size
+            if size != self._offset:
+                # end the partly written record of a crashed writer.
+                lines = "\n" + lines
+            os.write(journal, lines)
+        finally:
+            os.close(journal)
+
+        for line in lines.splitlines():
+            self.apply(line)
+        self._offset = size + len(lines)
+
+        if self._offset > self.compact_size:
+            self.compact()
+
+    def compact(self):
+        """
+        Writes the dict to a new snapshot and empties the journal. The
+        exclusive lock must be held, and the dict loaded.
+        """
+
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, "wb") as sub_file:
+            cPickle.dump(self._data, sub_file, cPickle.HIGHEST_PROTOCOL)
+            sub_file.flush()
+            os.fsync(sub_file.fileno())
+        os.rename(tmp_file, self.filename)
+        open(self.journal_file, "wb").close()
+
+        self._snapshot = self.file_stat(self.filename)
+        self._offset = 0
+
+    def read_all(self):
+        try:
+            with self.locked():
+                return verify_lease(self.load())
+        except (IOError, OSError, cPickle.UnpicklingError) as err:
+            print(err)
+            return None
+
+    def read_patterns(self):
+        try:
+            with self.locked():
+                data = self.load()
+                patterns = verify_lease(dict((topic, data[topic])
+                                             for topic in self._patterns))
+        except (IOError, OSError, cPickle.UnpicklingError) as err:
+            print(err)
+            return None
+        return dict((topic, subscribers)
+                    for topic, subscribers in patterns.items() if subscribers)
+
+    def save_all(self, subscriptions):
+        try:
+            with self.locked(fcntl.LOCK_EX):
+                self._data = dict((topic, dict(subscribers))
+                                  for topic, subscribers
+                                  in subscriptions.items())
+                self._leases = LeaseHeap(self._data)
+                self.index_patterns(self._data)
+                self.compact()
+        except (IOError, OSError) as err:
+            print(err)
+            self._data = None
+            return None
+        return True
+
+    def get_subscribers(self, topic):
+        current_time = time.time()
+        try:
+            with self.locked():
+                return dict((callback, lease) for callback, lease
+                            in self.load().get(topic, {}).items()
+                            if lease > current_time)
+        except (IOError, OSError, cPickle.UnpicklingError) as err:
+            print(err)
+            return None
+
+    def update(self, records):
+        """
+        Appends the records of a change to the journal. Returns True on
+        success.
+        """
+
+        try:
+            with self.locked(fcntl.LOCK_EX):
+                self.load()
+                self.append(records)
+        except (IOError, OSError, cPickle.UnpicklingError) as err:
+            print(err)
+            self._data = None
+            return None
+        return True
+
+    def subscribe(self, topic, callback, lease):
+        return self.update([("subscribe", topic, callback, lease)])
+
+    def unsubscribe(self, topic, callback):
+        return self.update([("unsubscribe", topic, callback)])
+
+    def purge_expired(self, limit):
+        try:
+            with self.locked(fcntl.LOCK_EX):
+                data = self.load()
+                expired = self._leases.pop_expired(data, time.time(), limit)
+                if expired:
+                    self.append([("unsubscribe", topic, callback)
+                                 for topic, callback in expired])
+        except (IOError, OSError, cPickle.UnpicklingError) as err:
+            print(err)
+            self._data = None
+            return 0
+        return len(expired)
+
+    def generation(self):
+        return (self.file_stat(self.filename),
+                self.file_stat(self.journal_file))
+
+    def pattern_generation(self):
+        try:
+            with self.locked():
+                self.load()
+                return self._snapshot, self._pattern_changes
+        except (IOError, OSError, cPickle.UnpicklingError) as err:
+            print(err)
+            return None
+
+
+class SQLiteStore(SubscriptionStore):
+    """
+    Keeps the subscriptions in an SQLite database in WAL mode, one row
+    per subscription, indexed by topic. A publish reads only the rows of
+    its topic and a subscription writes a single row. The rows of the
+    wildcard topics have an index of their own, and triggers count
+    their changes. The subscriptions in the pickle file of the
+    PickleStore are imported on first use.
+    """
+
+    def __init__(self, filename, pickle_file=None):
+        self.filename = filename
+        self._local = threading.local()
+        self.setup(pickle_file)
+
+    @property
+    def connection(self):
+        """
+        The connection of the current thread. Connections can not be
+        shared between threads.
+        """
+
+        conn = getattr(self._local, 'connection', None)
+        if not conn:
+            # autocommit mode, transactions are started explicitly.
+            conn = sqlite3.connect(self.filename, timeout=30,
+                                   isolation_level=None)
+            # the topics and callbacks are utf-8 str, as in the other
+            # stores, and are read back as str.
+            conn.text_factory = str
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = conn
+        return conn
+
+    def setup(self, pickle_file=None):
+        """
+        Creates the tables and migrates the subscriptions from the
+        pickle file if they were not migrated yet.
+        """
+
+        conn = self.connection
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS subscriptions (
+            topic TEXT NOT NULL,
+            callback TEXT NOT NULL,
+            lease REAL NOT NULL,
+            PRIMARY KEY (topic, callback))""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS subscriptions_lease
+            ON subscriptions (lease)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS subscriptions_patterns
+            ON subscriptions (lease) WHERE topic LIKE '%*'""")
+        conn.execute("INSERT OR IGNORE INTO meta VALUES (?, ?)",
+                     ("pattern_changes", 0))
+        for event, row in [("INSERT", "NEW"), ("DELETE", "OLD")]:
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS patterns_%s
+                AFTER %s ON subscriptions WHEN %s.topic LIKE '%%*'
+                BEGIN
+                    UPDATE meta SET value = value + 1
+                    WHERE key = 'pattern_changes';
+                END""" % (event.lower(), event, row))
+
+        if not pickle_file or not os.path.isfile(pickle_file) or \
+                not os.path.getsize(pickle_file):
+            return
+
+        # the other workers wait here until the migration is done.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migrated = conn.execute("SELECT value FROM meta WHERE key = ?",
+                                    ("migrated_from",)).fetchone()
+            if not migrated:
+                subscriptions = PickleStore(pickle_file).read_all() or {}
+                conn.executemany(
+                    "INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?)",
+                    [(topic, callback, lease)
+                     for topic, subscribers in subscriptions.items()
+                     if topic
+                     for callback, lease in subscribers.items()])
+                conn.execute("INSERT INTO meta VALUES (?, ?)",
+                             ("migrated_from", pickle_file))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_subscribers(self, topic):
+        try:
+            rows = self.connection.execute(
+                "SELECT callback, lease FROM subscriptions \
+                WHERE topic = ? AND lease > ?", (topic, time.time()))
+            return dict(rows)
+        except sqlite3.Error as err:
+            print(err)
+            return None
+
+    def subscribe(self, topic, callback, lease):
+        try:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?)",
+                (topic, callback, lease))
+        except sqlite3.Error as err:
+            print(err)
+            return None
+        return True
+
+    def unsubscribe(self, topic, callback):
+        try:
+            self.connection.execute(
+                "DELETE FROM subscriptions WHERE topic = ? AND callback = ?",
+                (topic, callback))
+        except sqlite3.Error as err:
+            print(err)
+            return None
+        return True
+
+    def update(self, records):
+        conn = self.connection
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for record in records:
+                    if record[0] == "subscribe":
+                        conn.execute("INSERT OR REPLACE INTO subscriptions \
+                            VALUES (?, ?, ?)", record[1:])
+                    elif record[0] == "unsubscribe":
+                        conn.execute("DELETE FROM subscriptions \
+                            WHERE topic = ? AND callback = ?", record[1:])
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as err:
+            print(err)
+            return None
+        return True
+
+    def read_all(self):
+        subscriptions = {}
+        try:
+            rows = self.connection.execute(
+                "SELECT topic, callback, lease FROM subscriptions \
+                WHERE lease > ?", (time.time(),))
+            for topic, callback, lease in rows:
+                subscriptions.setdefault(topic, {})[callback] = lease
+        except sqlite3.Error as err:
+            print(err)
+            return None
+        return subscriptions
+
+    def read_patterns(self):
+        subscriptions = {}
+        try:
+            rows = self.connection.execute(
+                "SELECT topic, callback, lease FROM subscriptions \
+                WHERE topic LIKE '%*' AND lease > ?", (time.time(),))
+            for topic, callback, lease in rows:
+                subscriptions.setdefault(topic, {})[callback] = lease
+        except sqlite3.Error as err:
+            print(err)
+            return None
+        return subscriptions
+
+    def save_all(self, subscriptions):
+        conn = self.connection
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM subscriptions")
+                conn.executemany(
+                    "INSERT INTO subscriptions VALUES (?, ?, ?)",
+                    [(topic, callback, lease)
+                     for topic, subscribers in subscriptions.items()
+                     for callback, lease in subscribers.items()])
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as err:
+            print(err)
+            return None
+        return True
+
+    def purge_expired(self, limit):
+        try:
+            cursor = self.connection.execute(
+                "DELETE FROM subscriptions WHERE rowid IN \
+                (SELECT rowid FROM subscriptions WHERE lease <= ? \
+                ORDER BY lease LIMIT ?)", (time.time(), limit))
+        except sqlite3.Error as err:
+            print(err)
+            return 0
+        return cursor.rowcount
+
+    def generation(self):
+        # changes when another connection commits; the connection of
+        # the calling thread must not be used for writes.
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def pattern_generation(self):
+        try:
+            return self.connection.execute(
+                "SELECT value FROM meta WHERE key = ?",
+                ("pattern_changes",)).fetchone()[0]
+        except sqlite3.Error as err:
+            print(err)
+            return None
+
+
+class LeaseSweeper(threading.Thread):
+    """
+    Deletes the expired subscriptions of a store in the background,
+    every interval seconds and batch_size subscriptions at a time, so
+    that reads and writes never have to scan for them.
+    """
+
+    def __init__(self, store, interval=60, batch_size=1000):
+        threading.Thread.__init__(self, name="LeaseSweeper")
+        self.daemon = True
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.sweep()
+
+    def sweep(self):
+        """
+        Deletes all the expired subscriptions. Returns their number.
+        """
+
+        total = 0
+        while not self._stopped.is_set():
+            purged = self.store.purge_expired(self.batch_size)
+            metrics.incr("lease_expirations", purged)
+            total += purged
+            if purged < self.batch_size:
+                break
+        return total
+
+    def stop(self):
+        """
+        Stops the sweeper after the current batch.
+        """
+
+        self._stopped.set()
@@ -0,0 +1,221 @@
+"""
+Verifies the intent of the subscribers in the background, so that an
+asynchronous subscription request is answered without waiting for the
+challenge of its callback.
+"""
+
+from resourcesync_push.hub.delivery import RetryTimer
+from resourcesync_push.metrics import metrics
+
+from concurrent.futures import Future
+import binascii
+import os
+import Queue
+import threading
+import time
+import urllib
+
+
+# the results of a challenge
+VERIFIED, DECLINED, FAILED = range(3)
+
+
+def make_challenge():
+    return binascii.hexlify(os.urandom(16))
+
+
+class Verifier(object):
+    """
+    Verifies subscription requests from a pool of worker threads. A
+    request is a dict of its mode, topic, callback and lease. It is
+    verified with a GET to the callback with a challenge, which the
+    callback must echo; then update(request) saves or removes the
+    subscription.
+
+    A challenge that fails with an error, a timeout or a 5xx status is
+    retried after retry_delay seconds, doubled at each attempt, up to
+    max_attempts attempts. A callback that does not echo the challenge
+    has declined the request, which is dropped. At most max_pending
+    requests are waiting to be verified.
+
+    The workers are started with the first request.
+    """
+
+    def __init__(self, send, update, workers=4, max_pending=10000,
+                 timeout=10, max_attempts=3, retry_delay=5):
+        self.send = send
+        self.update = update
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timer = None
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._pending = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads or self._stopped:
+                return
+            for num in range(self.workers):
+                thread = threading.Thread(target=self.run,
+                                          name="Verifier-%s" % num)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, request):
+        """
+        Queues a subscription request for verification. Returns False if
+        too many requests are pending.
+        """
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                metrics.incr("verifications_rejected")
+                return False
+            self._pending += 1
+        request['attempts'] = 0
+        self.start()
+        self.enqueue(request)
+        return True
+
+    def enqueue(self, request):
+        if self._stopped:
+            # a retry that was due while the verifier stopped.
+            return self.verify(request)
+        self._queue.put(request)
+
+    def run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            try:
+                self.verify(request)
+            except Exception as err:
+                print("Error verifying %s: %s" % (request['callback'], err))
+                self.done(request, "failed")
+
+    def challenge(self, request):
+        """
+        Sends a challenge to the callback of the request. Returns the
+        challenge and the future of the response, or of the error.
+        """
+
+        challenge = make_challenge()
+        query = {
+            'hub.mode': request['mode'],
+            'hub.topic': request['topic'],
+            'hub.challenge': challenge,
+        }
+        if request['mode'] == "subscribe":
+            query['hub.lease_seconds'] = request['lease']
+        separator = "&" if "?" in request['callback'] else "?"
+        url = separator.join([request['callback'], urllib.urlencode(query)])
+
+        try:
+            future = self.send(url, method='GET')
+        except Exception as err:
+            future = Future()
+            future.set_exception(err)
+        return challenge, future
+
+    def result(self, request, challenge, future, timeout):
+        """
+        Waits up to timeout seconds for the answer to a challenge.
+        Returns VERIFIED if the callback echoed it, DECLINED if it did
+        not, or FAILED if the callback could not be reached.
+        """
+
+        try:
+            response = future.result(timeout=max(timeout, 0))
+        except Exception as err:
+            print("Error verifying %s: %s" % (request['callback'], err))
+            return FAILED
+
+        if response.status_code >= 500:
+            return FAILED
+        if 200 <= response.status_code < 300 and \
+                challenge in response.content:
+            return VERIFIED
+        return DECLINED
+
+    def check(self, request):
+        """
+        Challenges the callback of the request, see result().
+        """
+
+        challenge, future = self.challenge(request)
+        return self.result(request, challenge, future, self.timeout)
+
+    def check_all(self, requests):
+        """
+        Challenges the callbacks of the requests at once. Returns the
+        result of each request, after at most timeout seconds in all.
+        """
+
+        end = time.time() + self.timeout
+        challenges = [self.challenge(request) for request in requests]
+        return [self.result(request, challenge, future, end - time.time())
+                for request, (challenge, future)
+                in zip(requests, challenges)]
+
+    def verify(self, request):
+        """
+        Verifies a queued request, and retries it later if the callback
+        could not be reached.
+        """
+
+        result = self.check(request)
+        if result == VERIFIED:
+            if self.update(request):
+                return self.done(request, "verified")
+            result = FAILED
+        if result == DECLINED:
+            return self.done(request, "declined")
+
+        request['attempts'] += 1
+        if request['attempts'] >= self.max_attempts:
+            return self.done(request, "failed")
+
+        metrics.incr("verifications", labels={'result': "retried"})
+        with self._lock:
+            if not self.timer:
+                self.timer = RetryTimer(self.enqueue)
+                self.timer.start()
+        self.timer.schedule(request, self.retry_delay *
+                            2 ** (request['attempts'] - 1))
+
+    def done(self, request, result):
+        metrics.incr("verifications", labels={'result': result})
+        with self._lock:
+            self._pending -= 1
+
+    def pending(self):
+        """
+        The number of requests queued, being verified or waiting for a
+        retry.
+        """
+
+        return self._pending
+
+    def stop(self):
+        """
+        Stops the workers once they have verified the queued requests.
+        The requests waiting for a retry are given up.
+        """
+
+        with self._lock:
+            self._stopped = True
+            threads = self._threads
+            timer = self.timer
+        for thread in threads:
+            self._queue.put(None)
+        if timer:
+            for request in timer.stop():
+                self.done(request, "failed")
@@ -0,0 +1,593 @@
+"""
+An end-to-end load generator for the hub. Serves a fleet of stand-in
+subscribers from local http servers, subscribes them through
+/subscribe, publishes change notifications at a target rate and reports
+the publish-to-delivery latency and the throughput.
+
+    resourcesync_loadgen --subscribers 100000 --topics 10 --rate 20
+
+The hub runs in this process, called directly or behind a local http
+server, with a config in a temporary directory; or it is the hub at
+--hub-url, started separately.
+"""
+
+from resourcesync_push.hub import hub as hub_app
+from resourcesync_push.hub.hub import HubContext
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import make_server, WSGIServer, \
+    WSGIRequestHandler
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+import requests
+
+
+HUB_CONFIG = """[general]
+log_mode=
+log_topic_rate=1
+log_sample_rate=0
+
+[hub]
+url=%(hub_url)s
+mimetypes=application/xml
+subscribers_file=%(directory)s/subscriptions.pk
+subscriptions_db=%(directory)s/subscriptions.db
+shared_index_file=%(directory)s/subscriptions.idx
+delivery_queue_file=%(directory)s/delivery.db
+dead_letter_file=%(directory)s/dead_letters.log
+metrics_dir=%(directory)s/metrics
+rate_limit_file=%(directory)s/ratelimit.bin
+"""
+
+URLSET = """<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"
+ xmlns:rs="http://www.openarchives.org/rs/terms/">
+%s
+</urlset>
+"""
+
+URL = """<url>
+<loc>http://loadgen.example.org/publish/%s/%s</loc>
+<lastmod>2014-05-01T00:00:00Z</lastmod>
+<rs:md change="updated" />
+</url>"""
+
+PUBLISH_ID = re.compile(r"/publish/(\d+)/")
+
+
+def topic_url(num):
+    return "http://loadgen.example.org/topic/%s" % num
+
+
+def changelist(publish_id, urls):
+    """
+    The payload of a publish, whose urls carry the publish id.
+    """
+
+    return URLSET % "\n".join(URL % (publish_id, num) for num in range(urls))
+
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    """
+    The nearest-rank percentiles of the values, and their max.
+    """
+
+    values = sorted(values)
+    result = dict(("p%s" % point, None) for point in points)
+    result['max'] = None
+    if not values:
+        return result
+    for point in points:
+        rank = int(math.ceil(point / 100.0 * len(values))) - 1
+        result["p%s" % point] = values[min(max(rank, 0), len(values) - 1)]
+    result['max'] = values[-1]
+    return result
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # the hub opens many connections at once during a fan-out.
+    request_queue_size = 1024
+
+
+class StandInServer(object):
+    """
+    Local http servers, as many as servers, that answer the
+    verification challenges of the hub, and its notifications with the
+    status returned by notified().
+    """
+
+    def __init__(self, servers=1):
+        self.lock = threading.Lock()
+        self.challenges = 0
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+                challenge = query.get('hub.challenge', [""])[0]
+                with stand_in.lock:
+                    stand_in.challenges += 1
+                self.respond(200, challenge)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                self.respond(stand_in.notified(self, body))
+
+            def respond(self, status, body=""):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.servers = []
+        for num in range(max(servers, 1)):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers.append(server)
+
+    def notified(self, request, body):
+        """
+        The status to answer the notification body posted by the
+        request handler with.
+        """
+
+        return 204
+
+    def close(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+class StandInSubscribers(StandInServer):
+    """
+    count stand-in subscribers, whose callback urls are spread over
+    servers local http servers. A notification is answered after
+    latency seconds, or slow_latency seconds for the slow_rate fraction
+    of slow subscribers. An error_rate fraction of the notifications is
+    answered with a 500.
+    """
+
+    def __init__(self, count, servers=1, latency=0, error_rate=0,
+                 slow_rate=0, slow_latency=1.0, seed=0):
+        self.count = count
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_latency = slow_latency
+        self.random = random.Random(seed)
+        self.slow = set(self.random.sample(range(count),
+                                           int(count * slow_rate)))
+        # publish id -> times the notification was received
+        self.received = {}
+        self.delivered = 0
+        self.errors = 0
+        StandInServer.__init__(self, servers)
+
+    def callback(self, num):
+        server = self.servers[num % len(self.servers)]
+        return "http://127.0.0.1:%s/callback/%s" % (server.server_port, num)
+
+    def notified(self, request, body):
+        """
+        Records a notification posted to a callback and returns the
+        status to answer with.
+        """
+
+        try:
+            num = int(request.path.rsplit("/", 1)[-1])
+        except ValueError:
+            return 404
+
+        time.sleep(self.slow_latency if num in self.slow else self.latency)
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return 500
+            now = time.time()
+            for publish_id in set(PUBLISH_ID.findall(body)):
+                self.received.setdefault(int(publish_id), []).append(now)
+            self.delivered += 1
+        return 204
+
+
+class WSGIClient(object):
+    """
+    Sends the requests to a WSGI application in this process.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body="", headers=None):
+        status = []
+
+        def start_response(response_status, response_headers):
+            status.append(int(response_status.split(" ", 1)[0]))
+
+        env = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'SERVER_NAME': "localhost",
+            'SERVER_PORT': "80",
+            'CONTENT_TYPE': (headers or {}).get('Content-Type', ""),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+        }
+        for name, value in (headers or {}).items():
+            env["HTTP_" + name.upper().replace("-", "_")] = value
+        "".join(self.app(env, start_response))
+        return status[0]
+
+
+class HTTPClient(object):
+    """
+    Sends the requests to the hub at base_url.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=100)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, path, body="", headers=None):
+        response = self.session.request(method, self.base_url + path,
+                                        data=body, headers=headers or {})
+        return response.status_code
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class LocalHub(object):
+    """
+    A hub in this process, with its store and queue in a temporary
+    directory. Called directly, or served on a local port if serve is
+    set. The settings of config_files override the default ones.
+    """
+
+    def __init__(self, serve=False, config_files=None):
+        self.directory = tempfile.mkdtemp(prefix="resourcesync_loadgen")
+        self.server = None
+        if serve:
+            self.server = make_server("127.0.0.1", 0, self.application,
+                                      server_class=ThreadingWSGIServer,
+                                      handler_class=QuietHandler)
+            self.url = "http://127.0.0.1:%s" % self.server.server_port
+        else:
+            self.url = "http://localhost"
+
+        config_file = os.path.join(self.directory, "hub.ini")
+        with open(config_file, "w") as cnf_file:
+            cnf_file.write(HUB_CONFIG % {'hub_url': self.url + "/",
+                                         'directory': self.directory})
+        self.context = HubContext("hub", config_files=[config_file] +
+                                  list(config_files or []))
+
+        if self.server:
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.client = HTTPClient(self.url)
+        else:
+            self.client = WSGIClient(self.application)
+
+    def application(self, env, start_response):
+        if self.server:
+            # unlike uWSGI, wsgiref does not end wsgi.input at the end
+            # of the body.
+            length = int(env.get('CONTENT_LENGTH') or 0)
+            env['wsgi.input'] = StringIO(env['wsgi.input'].read(length))
+        return hub_app.application(env, start_response, context=self.context)
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        self.context.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class LoadGenerator(object):
+    """
+    Subscribes the stand-in subscribers to topics topics, round robin,
+    and publishes a changelist of urls urls to the topics in turn, rate
+    times per second, from concurrency threads.
+    """
+
+    def __init__(self, client, subscribers, hub_url, topics=1, rate=10,
+                 urls=1, concurrency=16, lease_seconds=86400):
+        self.client = client
+        self.subscribers = subscribers
+        self.hub_url = hub_url
+        self.topics = topics
+        self.rate = rate
+        self.urls = urls
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        # topic number -> subscribers
+        self.subscribed = {}
+        self.subscribe_statuses = {}
+        # publish id -> (time sent, seconds to respond, status)
+        self.published = {}
+
+    def subscribe_one(self, num):
+        topic = num % self.topics
+        body = urllib.urlencode({
+            'hub.mode': "subscribe",
+            'hub.callback': self.subscribers.callback(num),
+            'hub.topic': topic_url(topic),
+            'hub.verify': "sync",
+            'hub.lease_seconds': self.lease_seconds,
+        })
+        try:
+            status = self.client.request(
+                "POST", "/subscribe", body,
+                {'Content-Type': "application/x-www-form-urlencoded"})
+        except Exception as err:
+            status = self.request_error("subscribe", err)
+        return topic, status
+
+    @staticmethod
+    def request_error(request, err):
+        """
+        Reports a request that got no response, on stderr as stdout may
+        be silenced. Returns the status it is counted under in the
+        report.
+        """
+
+        sys.stderr.write("Error sending the %s request: %s\n" %
+                         (request, err))
+        return "error"
+
+    def subscribe(self):
+        """
+        Subscribes all the stand-in subscribers. Returns the seconds it
+        took.
+        """
+
+        start = time.time()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        for topic, status in executor.map(self.subscribe_one,
+                                          range(self.subscribers.count)):
+            self.subscribe_statuses[status] = \
+                self.subscribe_statuses.get(status, 0) + 1
+            if status in (202, 204):
+                self.subscribed[topic] = self.subscribed.get(topic, 0) + 1
+        executor.shutdown()
+        return time.time() - start
+
+    def publish_one(self, publish_id):
+        topic = publish_id % self.topics
+        headers = {
+            'Content-Type': "application/xml",
+            'Link': "<%s>;rel=self, <%s>;rel=hub" % (topic_url(topic),
+                                                     self.hub_url),
+        }
+        body = changelist(publish_id, self.urls)
+        sent = time.time()
+        try:
+            status = self.client.request("POST", "/publish", body, headers)
+        except Exception as err:
+            status = self.request_error("publish", err)
+        self.published[publish_id] = (sent, time.time() - sent, status)
+
+    def publish(self, count):
+        """
+        Publishes count changelists at the target rate. Returns the
+        seconds it took.
+        """
+
+        start = time.time()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        for publish_id in range(count):
+            delay = start + publish_id / float(self.rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(self.publish_one, publish_id)
+        executor.shutdown()
+        return time.time() - start
+
+    def expected(self):
+        """
+        The number of deliveries the publishes accepted by the hub
+        should make.
+        """
+
+        return sum(self.subscribed.get(publish_id % self.topics, 0)
+                   for publish_id, (sent, seconds, status)
+                   in self.published.items()
+                   if status in (202, 204))
+
+    def drain(self, timeout):
+        """
+        Waits until the expected deliveries are received, for at most
+        timeout seconds. Returns the seconds it took.
+        """
+
+        start = time.time()
+        expected = self.expected()
+        while time.time() - start < timeout:
+            with self.subscribers.lock:
+                received = sum(len(times) for times
+                               in self.subscribers.received.values())
+            if received >= expected:
+                break
+            time.sleep(0.05)
+        return time.time() - start
+
+    def report(self, subscribe_seconds, publish_seconds, drain_seconds):
+        publish_statuses = {}
+        for sent, seconds, status in self.published.values():
+            publish_statuses[status] = publish_statuses.get(status, 0) + 1
+
+        latencies = []
+        last = None
+        with self.subscribers.lock:
+            for publish_id, times in self.subscribers.received.items():
+                if publish_id not in self.published:
+                    continue
+                sent = self.published[publish_id][0]
+                latencies.extend(received - sent for received in times)
+                last = max([last] + times)
+            errors = self.subscribers.errors
+
+        first = min([sent for sent, seconds, status
+                     in self.published.values()] or [None])
+        delivery_seconds = last - first if last and first else None
+        return {
+            'subscribers': self.subscribers.count,
+            'topics': self.topics,
+            'subscribe': {
+                'seconds': subscribe_seconds,
+                'statuses': by_status(self.subscribe_statuses),
+                'per_second': self.subscribers.count / subscribe_seconds
+                if subscribe_seconds else None,
+            },
+            'publish': {
+                'count': len(self.published),
+                'target_rate': self.rate,
+                'rate': len(self.published) / publish_seconds
+                if publish_seconds else None,
+                'statuses': by_status(publish_statuses),
+                'response_seconds': percentiles(
+                    [seconds for sent, seconds, status
+                     in self.published.values()]),
+            },
+            'delivery': {
+                'expected': self.expected(),
+                'delivered': len(latencies),
+                'errors_answered': errors,
+                'drain_seconds': drain_seconds,
+                'per_second': len(latencies) / delivery_seconds
+                if delivery_seconds else None,
+                'latency_seconds': percentiles(latencies),
+            },
+        }
+
+
+def by_status(statuses):
+    return dict((str(status), count) for status, count in statuses.items())
+
+
+def main(argv=None):
+    """
+    Entry point of the load generator.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="resourcesync_loadgen",
+        description="Drives publishes through a hub to local stand-in "
+        "subscribers and reports the delivery latency.")
+    parser.add_argument("--subscribers", type=int, default=100)
+    parser.add_argument("--topics", type=int, default=1)
+    parser.add_argument("--servers", type=int, default=1,
+                        help="local http servers of the subscribers")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds a subscriber takes to answer")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of the notifications answered "
+                        "with a 500")
+    parser.add_argument("--slow-rate", type=float, default=0,
+                        help="fraction of slow subscribers")
+    parser.add_argument("--slow-latency", type=float, default=1.0,
+                        help="seconds a slow subscriber takes to answer")
+    parser.add_argument("--rate", type=float, default=10,
+                        help="publishes per second")
+    parser.add_argument("--publishes", type=int, default=100)
+    parser.add_argument("--urls", type=int, default=1,
+                        help="urls per changelist")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="threads sending the requests to the hub")
+    parser.add_argument("--hub", choices=["inprocess", "local"],
+                        default="inprocess",
+                        help="call the hub directly or over http")
+    parser.add_argument("--hub-url",
+                        help="load a hub started separately instead")
+    parser.add_argument("--config", action="append", default=[],
+                        help="hub config file overriding the defaults")
+    parser.add_argument("--drain", type=float, default=60,
+                        help="seconds to wait for the deliveries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", "-o", default="-",
+                        help="file to write the json report to")
+    args = parser.parse_args(argv)
+
+    subscribers = StandInSubscribers(
+        args.subscribers, servers=args.servers, latency=args.latency,
+        error_rate=args.error_rate, slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency, seed=args.seed)
+    hub = None
+    stdout = sys.stdout
+    try:
+        if args.hub_url:
+            client = HTTPClient(args.hub_url)
+            hub_url = args.hub_url
+        else:
+            # the log records of the hub would mix with the report.
+            sys.stdout = open(os.devnull, "w")
+            hub = LocalHub(serve=args.hub == "local",
+                           config_files=args.config)
+            client = hub.client
+            hub_url = hub.url
+
+        generator = LoadGenerator(
+            client, subscribers, hub_url.rstrip("/") + "/publish",
+            topics=args.topics, rate=args.rate, urls=args.urls,
+            concurrency=args.concurrency)
+        sys.stderr.write("Subscribing %s subscribers\n" % args.subscribers)
+        subscribe_seconds = generator.subscribe()
+        sys.stderr.write("Publishing %s changelists\n" % args.publishes)
+        publish_seconds = generator.publish(args.publishes)
+        drain_seconds = generator.drain(args.drain)
+        report = generator.report(subscribe_seconds, publish_seconds,
+                                  drain_seconds)
+    finally:
+        subscribers.close()
+        if hub:
+            hub.close()
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    data = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if args.output == "-":
+        sys.stdout.write(data)
+    else:
+        with open(args.output, "w") as report_file:
+            report_file.write(data)
+    return report
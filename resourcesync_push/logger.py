@@ -0,0 +1,186 @@
+"""
+Ships the log records of the requests in batches from a background
+thread, so that logging neither copies whole payloads nor makes a
+request per log record.
+"""
+
+from resourcesync_push.metrics import metrics
+
+import collections
+import hashlib
+import json
+import random
+import threading
+import time
+
+
+def make_record(log_msg, payload_max=256):
+    """
+    A copy of the log_msg of a request, with the payload replaced by
+    its size, its sha1 and at most its first payload_max bytes.
+    """
+
+    record = dict(log_msg)
+    record['msg'] = list(log_msg.get('msg', []))
+    record['time'] = time.time()
+    payload = record.pop('payload', None) or ""
+    if payload:
+        record['payload_size'] = len(payload)
+        record['payload_sha1'] = hashlib.sha1(payload).hexdigest()
+        if payload_max:
+            record['payload'] = payload[:payload_max].decode("utf-8",
+                                                             "replace")
+            record['payload_truncated'] = len(payload) > payload_max
+    return record
+
+
+class TopicSampler(object):
+    """
+    Keeps all the records of a topic up to rate records per second,
+    and a sample_rate fraction of the records beyond that.
+    """
+
+    def __init__(self, rate=10, sample_rate=0.01):
+        self.rate = rate
+        self.sample_rate = sample_rate
+        # topic -> (second, records in that second)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def keep(self, topic):
+        if not self.rate or not topic:
+            return True
+
+        second = int(time.time())
+        with self._lock:
+            if len(self._counts) > 10000:
+                self._counts = {}
+            start, count = self._counts.get(topic, (second, 0))
+            if start != second:
+                start, count = second, 0
+            self._counts[topic] = (start, count + 1)
+        if count < self.rate:
+            return True
+        return random.random() < self.sample_rate
+
+
+class LogShipper(object):
+    """
+    Queues the log records and writes them in batches of up to
+    batch_size from a background thread, at least every flush_interval
+    seconds. The records are printed as json lines, or posted as a json
+    list to the demo hub when post is set. The queue holds at most
+    queue_size records; the records logged while it is full are
+    dropped and counted in the log_records_dropped metric.
+    """
+
+    def __init__(self, post=None, queue_size=10000, batch_size=100,
+                 flush_interval=1.0, payload_max=256, sampler=None):
+        self.post = post
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.payload_max = payload_max
+        self.sampler = sampler or TopicSampler(rate=0)
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    @staticmethod
+    def from_config(config, post=None):
+        """
+        Creates a shipper with the log settings of the config.
+        """
+
+        return LogShipper(
+            post=post,
+            queue_size=config['log_queue_size'],
+            batch_size=config['log_batch_size'],
+            flush_interval=config['log_flush_interval'],
+            payload_max=config['log_payload_max'],
+            sampler=TopicSampler(rate=config['log_topic_rate'],
+                                 sample_rate=config['log_sample_rate']))
+
+    def ship(self, log_msg):
+        """
+        Queues the record of a log_msg. Returns False if it was sampled
+        out or dropped.
+        """
+
+        if not self.sampler.keep(log_msg.get('topic')):
+            metrics.incr("log_records_sampled_out")
+            return False
+
+        record = make_record(log_msg, payload_max=self.payload_max)
+        with self._cond:
+            if len(self._queue) >= self.queue_size:
+                metrics.incr("log_records_dropped")
+                return False
+            self._queue.append(record)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+            stopped = self._stopped
+            if not stopped and not self._thread:
+                self._thread = threading.Thread(target=self.run,
+                                                name="LogShipper")
+                self._thread.daemon = True
+                self._thread.start()
+        if stopped:
+            # logged by a request that started before a config reload.
+            self.flush()
+        return True
+
+    def run(self):
+        while True:
+            with self._cond:
+                if not self._stopped and len(self._queue) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                stopped = self._stopped
+            while self.flush() == self.batch_size:
+                pass
+            if stopped:
+                return
+
+    def flush(self):
+        """
+        Writes a batch of the queued records. Returns the number of
+        records written.
+        """
+
+        with self._cond:
+            batch = [self._queue.popleft()
+                     for num in range(min(self.batch_size,
+                                          len(self._queue)))]
+        if not batch:
+            return 0
+
+        try:
+            if self.post:
+                self.post(json.dumps(batch))
+            else:
+                for record in batch:
+                    print(json.dumps(record))
+        except Exception as err:
+            print("Error shipping %s log records: %s" % (len(batch), err))
+            metrics.incr("log_records_dropped", len(batch))
+            return len(batch)
+        metrics.incr("log_records_shipped", len(batch))
+        return len(batch)
+
+    def pending(self):
+        return len(self._queue)
+
+    def stop(self):
+        """
+        Stops the background thread once it has written the queued
+        records.
+        """
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread = self._thread
+        if not thread:
+            while self.flush():
+                pass
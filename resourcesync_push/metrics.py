@@ -0,0 +1,381 @@
+"""
+Counters, gauges and histograms of the events of a process, such as
+publishes, deliveries and failed fetches. Each worker process writes a
+snapshot of its metrics to a directory shared by the workers, and the
+snapshots are merged when the metrics are read.
+"""
+
+from contextlib import contextmanager
+
+import errno
+import glob
+import json
+import os
+import threading
+import time
+
+
+# histogram buckets for durations, in seconds
+SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# label value of the series over the max number of series of a metric
+OTHER = "_other"
+
+
+def alive(pid):
+    """
+    Whether a process with the pid is running.
+    """
+
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+class Metrics(object):
+    """
+    Named counters, gauges and histograms, safe to update from any
+    thread. A metric can have labels, given as a dict; each set of
+    label values is a series. At most max_series series are kept per
+    metric, the others are counted under the label value _other.
+
+    The metrics are reset in a forked process, so that the workers do
+    not count the events of their parent.
+    """
+
+    def __init__(self, max_series=1000):
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.pid = os.getpid()
+            # name -> {labels: value}
+            self._counters = {}
+            # name -> {labels: (value, time, aggregate)}
+            self._gauges = {}
+            # name -> {labels: (buckets, counts)}, the counts per bucket
+            # and above the last bucket, then the sum and the count
+            self._histograms = {}
+
+    def check_fork(self):
+        """
+        Resets the metrics in a forked process, the events of the parent
+        are counted there. Called with the lock held.
+        """
+
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+
+    def series(self, metric, labels):
+        """
+        The key of the labels in the series of a metric. Called with
+        the lock held.
+        """
+
+        key = tuple(sorted((labels or {}).items()))
+        if key in metric or len(metric) < self.max_series:
+            return key
+        return tuple((name, OTHER) for name, value in key)
+
+    def incr(self, name, value=1, labels=None):
+        """
+        Adds value to the counter name.
+        """
+
+        with self._lock:
+            self.check_fork()
+            metric = self._counters.setdefault(name, {})
+            key = self.series(metric, labels)
+            metric[key] = metric.get(key, 0) + value
+
+    def set(self, name, value, labels=None, aggregate="last"):
+        """
+        Sets the gauge name. The gauges of the workers are merged by
+        keeping the last value set, or by adding them up if aggregate
+        is "sum".
+        """
+
+        with self._lock:
+            self.check_fork()
+            metric = self._gauges.setdefault(name, {})
+            metric[self.series(metric, labels)] = (value, time.time(),
+                                                   aggregate)
+
+    def observe(self, name, value, labels=None, buckets=SECONDS):
+        """
+        Adds a value to the histogram name.
+        """
+
+        with self._lock:
+            self.check_fork()
+            metric = self._histograms.setdefault(name, {})
+            key = self.series(metric, labels)
+            if key not in metric:
+                metric[key] = (buckets, [0] * (len(buckets) + 3))
+            buckets, counts = metric[key]
+            for num, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[num] += 1
+                    break
+            else:
+                counts[len(buckets)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """
+        Adds the duration of the with block to the histogram name.
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, labels=labels)
+
+    def get(self, name, labels=None):
+        """
+        The value of the counter name.
+        """
+
+        key = tuple(sorted((labels or {}).items()))
+        return self._counters.get(name, {}).get(key, 0)
+
+    def counters(self):
+        """
+        A copy of the counters without labels.
+        """
+
+        with self._lock:
+            return dict((name, series[()])
+                        for name, series in self._counters.items()
+                        if () in series)
+
+    def snapshot(self):
+        """
+        All the metrics, as a json serializable dict.
+        """
+
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value]
+                             for name, series in self._counters.items()
+                             for labels, value in series.items()],
+                'gauges': [[name, list(labels)] + list(value)
+                           for name, series in self._gauges.items()
+                           for labels, value in series.items()],
+                'histograms': [[name, list(labels), list(buckets),
+                                list(counts)]
+                               for name, series in self._histograms.items()
+                               for labels, (buckets, counts)
+                               in series.items()],
+            }
+
+
+def merge(snapshots):
+    """
+    Merges the snapshots of several processes. Counters and histograms
+    are added up, gauges are merged as they were set.
+    """
+
+    counters = {}
+    gauges = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot.get('counters', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+
+        for name, labels, value, set_time, aggregate in \
+                snapshot.get('gauges', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            if key not in gauges:
+                gauges[key] = (value, set_time, aggregate)
+            elif aggregate == "sum":
+                gauges[key] = (gauges[key][0] + value, set_time, aggregate)
+            elif set_time > gauges[key][1]:
+                gauges[key] = (value, set_time, aggregate)
+
+        for name, labels, buckets, counts in snapshot.get('histograms', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            if key not in histograms:
+                histograms[key] = (buckets, list(counts))
+            elif histograms[key][0] == buckets:
+                merged = histograms[key][1]
+                for num, count in enumerate(counts):
+                    merged[num] += count
+
+    return {
+        'counters': [[name, [list(label) for label in labels], value]
+                     for (name, labels), value in counters.items()],
+        'gauges': [[name, [list(label) for label in labels]] + list(value)
+                   for (name, labels), value in gauges.items()],
+        'histograms': [[name, [list(label) for label in labels], buckets,
+                        counts]
+                       for (name, labels), (buckets, counts)
+                       in histograms.items()],
+    }
+
+
+def format_labels(labels, extra=None):
+    labels = list(labels) + list(extra or [])
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, unicode(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels)
+
+
+def render(snapshot, prefix="resourcesync_"):
+    """
+    The metrics of a snapshot, in the Prometheus text format.
+    """
+
+    lines = []
+    for kind, metric_type in [('counters', "counter"), ('gauges', "gauge")]:
+        typed = set()
+        for series in sorted(snapshot[kind]):
+            name, labels, value = series[:3]
+            name = prefix + name
+            if name not in typed:
+                lines.append("# TYPE %s %s" % (name, metric_type))
+                typed.add(name)
+            lines.append("%s%s %r" % (name, format_labels(labels), value))
+
+    typed = set()
+    for name, labels, buckets, counts in sorted(snapshot['histograms']):
+        name = prefix + name
+        if name not in typed:
+            lines.append("# TYPE %s histogram" % name)
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(list(buckets) + ["+Inf"], counts[:-2]):
+            cumulative += count
+            lines.append("%s_bucket%s %s" % (
+                name, format_labels(labels, [("le", bound)]), cumulative))
+        lines.append("%s_sum%s %r" % (name, format_labels(labels),
+                                      counts[-2]))
+        lines.append("%s_count%s %s" % (name, format_labels(labels),
+                                        counts[-1]))
+    return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+
+class MetricsWriter(threading.Thread):
+    """
+    Writes the snapshot of the metrics of this process to directory
+    every interval seconds, for the other workers to merge. collect() is
+    called before each write, to set the gauges of the process. The
+    snapshot is kept once the writer stops, until retention.
+    """
+
+    # the snapshots not written for this many intervals, or of processes
+    # that are gone, are merged without their gauges
+    stale_intervals = 3
+
+    def __init__(self, metrics, directory, interval=5.0, collect=None,
+                 retention=86400):
+        threading.Thread.__init__(self, name="MetricsWriter")
+        self.daemon = True
+        self.metrics = metrics
+        self.directory = directory
+        self.interval = interval
+        self.collect = collect
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def filename(self):
+        return os.path.join(self.directory, "%s.json" % os.getpid())
+
+    def write(self):
+        """
+        Writes the snapshot of this process.
+        """
+
+        if self.collect:
+            try:
+                self.collect()
+            except Exception as err:
+                print("Error collecting metrics: %s" % err)
+
+        filename = self.filename()
+        tmp_file = "%s.tmp" % filename
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                with open(tmp_file, "w") as snapshot_file:
+                    json.dump(self.metrics.snapshot(), snapshot_file)
+                os.rename(tmp_file, filename)
+            except (IOError, OSError) as err:
+                print("Error writing metrics: %s" % err)
+
+    def read_all(self):
+        """
+        Merges the snapshots of all the workers, after writing the one
+        of this process. The gauges of the stale snapshots are left out,
+        as they no longer hold; the snapshots of processes gone for
+        longer than retention seconds are deleted.
+        """
+
+        self.write()
+        snapshots = []
+        now = time.time()
+        for filename in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                age = now - os.path.getmtime(filename)
+                if age > self.retention:
+                    os.remove(filename)
+                    continue
+                with open(filename) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (IOError, OSError, ValueError) as err:
+                # written or removed meanwhile
+                print(err)
+                continue
+            if self.stale(filename, age):
+                snapshot['gauges'] = []
+            snapshots.append(snapshot)
+        return merge(snapshots)
+
+    def stale(self, filename, age):
+        """
+        Whether the snapshot in filename, written age seconds ago, is
+        stale.
+        """
+
+        if age > self.stale_intervals * self.interval:
+            return True
+        try:
+            pid = int(os.path.basename(filename).split(".")[0])
+        except ValueError:
+            return False
+        return pid != os.getpid() and not alive(pid)
+
+    def stop(self):
+        """
+        Stops writing. The snapshot is kept, so that the counters of
+        the process are still merged until retention.
+        """
+
+        with self._lock:
+            self._stopped.set()
+
+
+# the metrics of this process
+metrics = Metrics()
@@ -0,0 +1,230 @@
+"""
+Opt-in profiling of the hot paths. Records timing spans of the steps of
+the requests, such as reading the payload or the subscriptions, to a
+rotating file, and a cProfile dump of one request in every N.
+"""
+
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+import cProfile
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+
+# set to 1 to profile whatever the config says
+PROFILING_ENV = "RESOURCESYNC_PUSH_PROFILING"
+
+
+class Span(object):
+    """
+    Records the duration of a with block.
+    """
+
+    __slots__ = ["profiler", "name", "attrs", "start"]
+
+    def __init__(self, profiler, name, attrs):
+        self.profiler = profiler
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start,
+                             time.time() - self.start, self.attrs)
+        return False
+
+
+class NullSpan(object):
+    """
+    The span used while profiling is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler(object):
+    """
+    Writes the spans as json lines to a rotating file per process,
+    filename.<pid>. Every profile_every requests, a request is run under
+    cProfile and its stats are dumped to profile_dir. Does nothing
+    until enabled by configure().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.filename = None
+        self.max_bytes = 0
+        self.backups = 0
+        self.profile_every = 0
+        self.profile_dir = None
+        self._logger = None
+        self._pid = None
+        self._requests = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        """
+        Applies the profiling settings of the config. The environment
+        variable RESOURCESYNC_PUSH_PROFILING=1 enables profiling too.
+        """
+
+        enabled = config.get('profiling') or \
+            os.environ.get(PROFILING_ENV, "").lower() in ["1", "true", "yes"]
+        settings = (config.get('profiling_file'),
+                    config.get('profiling_max_bytes'),
+                    config.get('profiling_backups'))
+        with self._lock:
+            if settings != (self.filename, self.max_bytes, self.backups):
+                self.filename, self.max_bytes, self.backups = settings
+                self.close()
+            self.profile_every = config.get('profile_every') or 0
+            self.profile_dir = config.get('profile_dir')
+            self.enabled = bool(enabled and self.filename)
+
+    def logger(self):
+        """
+        The logger writing the spans of this process.
+        """
+
+        pid = os.getpid()
+        if self._logger and self._pid == pid:
+            return self._logger
+
+        with self._lock:
+            if self._logger and self._pid == pid:
+                return self._logger
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            handler = RotatingFileHandler("%s.%s" % (self.filename, pid),
+                                          maxBytes=self.max_bytes,
+                                          backupCount=self.backups)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("resourcesync_push.profiling")
+            for old in list(logger.handlers):
+                logger.removeHandler(old)
+                old.close()
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            self._logger = logger
+            self._pid = pid
+            return logger
+
+    def close(self):
+        """
+        Closes the span file, called with the lock held.
+        """
+
+        if self._logger:
+            for handler in list(self._logger.handlers):
+                self._logger.removeHandler(handler)
+                handler.close()
+        self._logger = None
+
+    def span(self, name, **attrs):
+        """
+        A span timing a with block.
+        """
+
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attrs)
+
+    def track(self, name, future, **attrs):
+        """
+        Records a span from now until the future is done.
+        """
+
+        if not self.enabled or future is None:
+            return future
+        start = time.time()
+        request = getattr(self._local, "request", None)
+        future.add_done_callback(
+            lambda future: self.record(name, start, time.time() - start,
+                                       attrs, request=request))
+        return future
+
+    def record(self, name, start, duration, attrs=None, request=None):
+        """
+        Writes a span.
+        """
+
+        if not self.enabled:
+            return
+        span = {
+            'span': name,
+            'start': start,
+            'duration': duration,
+            'pid': os.getpid(),
+            'request': request or getattr(self._local, "request", None),
+        }
+        if attrs:
+            span.update(attrs)
+        try:
+            self.logger().info(json.dumps(span))
+        except (IOError, OSError) as err:
+            print("Error writing profiling span: %s" % err)
+
+    @contextmanager
+    def request(self, path):
+        """
+        Profiles a request: its spans are tagged with a request id, and
+        one request in every profile_every runs under cProfile.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        number = next(self._requests)
+        self._local.request = "%s-%s" % (os.getpid(), number)
+        profile = None
+        if self.profile_every and number % self.profile_every == 0:
+            profile = cProfile.Profile()
+            profile.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                self.dump(profile, number)
+            self.record("request", start, time.time() - start,
+                        {'path': path})
+            self._local.request = None
+
+    def dump(self, profile, number):
+        """
+        Writes the stats of a profiled request.
+        """
+
+        filename = os.path.join(self.profile_dir, "%s-%s.prof" %
+                                (os.getpid(), number))
+        try:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            profile.dump_stats(filename)
+        except (IOError, OSError) as err:
+            print("Error writing profile: %s" % err)
+
+
+# the profiler of this process
+profiler = Profiler()
@@ -3,7 +3,8 @@ A REST API for ResourceSync Publisher/Source.
 """
 
 from resourcesync_push import ResourceSyncPuSH
-import urlparse
+from resourcesync_push.context import AppContext
+from resourcesync_push.spool import read_body, BodyTooLarge
 
 
 class Publisher(ResourceSyncPuSH):
@@ -11,11 +12,12 @@ class Publisher(ResourceSyncPuSH):
     The ResourceSync Publisher.
     """
 
-    def __init__(self, env, start_response):
-        ResourceSyncPuSH.__init__(self)
+    def __init__(self, env, start_response, context=None):
+        ResourceSyncPuSH.__init__(self, context=context)
         self._env = env
         self._start_response = start_response
-        self.get_config()
+        if not context:
+            self.get_config()
 
     def handle_topic(self):
         """
@@ -111,7 +113,16 @@ class Publisher(ResourceSyncPuSH):
         already be configured in the config file.
         """
 
-        payload = self._env['wsgi.input'].read().strip()
+        try:
+            payload = read_body(self._env,
+                                max_size=self.config['max_body_size'],
+                                spool_size=self.config['spool_size'])
+        except BodyTooLarge:
+            return self.respond(code=413,
+                                msg="Payload larger than %s bytes." %
+                                self.config['max_body_size'])
+        if isinstance(payload, str):
+            payload = payload.strip()
 
         if not self.config['hub_url'] or\
                 not self.config['topic_url'] or\
@@ -123,8 +134,11 @@ class Publisher(ResourceSyncPuSH):
         link_header = self.make_link_header(topic_url=self.config['topic_url'],
                                             hub_url=self.config['hub_url'])
 
-        self.log_msg['payload'] = payload
+        if isinstance(payload, str):
+            # spooled payloads are not copied into the log.
+            self.log_msg['payload'] = payload
         self.log_msg['link_header'] = link_header
+        self.log_msg['topic'] = self.config['topic_url']
         self.log_msg['msg'].append("Payload size: %s bytes." %
                                    str(len(payload)))
 
@@ -145,27 +159,13 @@ def application(env, start_response):
     The WSGI entry point. Also responds to topic urls specified in the config.
     """
 
-    publisher = Publisher(env, start_response)
-
-    urlparts = urlparse.urlparse(publisher.config['topic_url'])
-    topic_path = urlparts.path.replace(publisher.config['server_path'], "")
-
-    req_path = env.get('PATH_INFO', "/")
-
-    # server path
-    if publisher.config['server_path']:
-        req_path = req_path.replace(publisher.config['server_path'], "")
-
-    if not req_path.startswith("/"):
-        req_path = "/" + req_path
-
-    if not topic_path.startswith("/"):
-        topic_path = "/" + topic_path
+    context = AppContext.get("publisher")
+    req_path = context.request_path(env)
 
     if req_path == "/":
-        return publisher.handle()
-    elif req_path == topic_path:
-        return publisher.handle_topic()
+        return Publisher(env, start_response, context=context).handle()
+    elif req_path == context.topic_path:
+        return Publisher(env, start_response, context=context).handle_topic()
     else:
         start_response("404 Not Found", [('Content-Type', 'text/html')])
         return ["Requested resource not found."]
@@ -0,0 +1,148 @@
+"""
+Reading request bodies in bounded memory. Large bodies are spooled to a
+temporary file that is memory-mapped once and shared by every request
+that sends them on.
+"""
+
+from resourcesync_push.profiling import profiler
+
+import mmap
+import tempfile
+
+
+# size of the blocks read from the request
+BLOCK_SIZE = 65536
+
+
+class BodyTooLarge(Exception):
+    """
+    The request body is larger than the max body size.
+    """
+    pass
+
+
+class SpooledBody(object):
+    """
+    A body spooled to an anonymous temporary file, mapped read-only.
+    The requests sending it each read it through their own reader(),
+    without copying it. The mapping is released with the last
+    reference to the body.
+    """
+
+    def __init__(self, spool_file, length):
+        spool_file.flush()
+        self.data = mmap.mmap(spool_file.fileno(), length,
+                              access=mmap.ACCESS_READ)
+        # the mapping stays valid once the file is closed and deleted.
+        spool_file.close()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __str__(self):
+        return self.data[:]
+
+    def reader(self):
+        """
+        A file-like object reading the body from the start.
+        """
+
+        return BodyReader(self.data)
+
+
+class BodyReader(object):
+    """
+    Reads a mapped body, with a position of its own.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def read(self, size=-1):
+        end = len(self.data)
+        if size is not None and size >= 0:
+            end = min(end, self.pos + size)
+        block = self.data[self.pos:end]
+        self.pos = end
+        return block
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += len(self.data)
+        self.pos = max(0, min(pos, len(self.data)))
+
+
+def body_data(body):
+    """
+    The data of a body, as a str or a buffer.
+    """
+
+    if isinstance(body, SpooledBody):
+        return body.data
+    return body
+
+
+def read_body(env, max_size=None, spool_size=1048576):
+    """
+    Reads the body of a WSGI request in blocks. Returns it as a str if
+    it is at most spool_size bytes, or as a SpooledBody. Raises
+    BodyTooLarge as soon as the body is known to be larger than
+    max_size bytes.
+    """
+
+    with profiler.span("read_payload"):
+        return spool_body(env, max_size, spool_size)
+
+
+def spool_body(env, max_size, spool_size):
+    """
+    Reads the body for read_body.
+    """
+
+    try:
+        remaining = int(env.get('CONTENT_LENGTH') or -1)
+    except ValueError:
+        remaining = -1
+    if max_size and remaining > max_size:
+        raise BodyTooLarge(remaining)
+
+    wsgi_input = env['wsgi.input']
+    chunks = []
+    size = 0
+    spool_file = None
+    while remaining:
+        block_size = BLOCK_SIZE
+        if remaining > 0:
+            block_size = min(block_size, remaining)
+        block = wsgi_input.read(block_size)
+        if not block:
+            break
+        if remaining > 0:
+            remaining -= len(block)
+        size += len(block)
+        if max_size and size > max_size:
+            if spool_file:
+                spool_file.close()
+            raise BodyTooLarge(size)
+
+        if spool_file:
+            spool_file.write(block)
+            continue
+        chunks.append(block)
+        if size > spool_size:
+            spool_file = tempfile.TemporaryFile(prefix="rspush-")
+            spool_file.write("".join(chunks))
+            chunks = None
+
+    if spool_file:
+        return SpooledBody(spool_file, size)
+    return "".join(chunks)
@@ -3,6 +3,7 @@ A ResourceSync Subscriber.
 """
 
 from resourcesync_push import ResourceSyncPuSH
+from resourcesync_push.context import AppContext
 import urlparse
 
 
@@ -13,11 +14,12 @@ class Subscriber(ResourceSyncPuSH):
     tasks with the payload.
     """
 
-    def __init__(self, env, start_response):
-        ResourceSyncPuSH.__init__(self)
+    def __init__(self, env, start_response, context=None):
+        ResourceSyncPuSH.__init__(self, context=context)
         self._env = env
         self._start_response = start_response
-        self.get_config()
+        if not context:
+            self.get_config()
 
     def process_subscription(self):
         """
@@ -115,20 +117,10 @@ def application(env, start_response):
     WSGI entry point.
     """
 
-    subscriber = Subscriber(env, start_response)
-    urlparse.urlparse(subscriber.config['server_path'])
+    context = AppContext.get("subscriber")
 
-    req_path = env.get('PATH_INFO', "/")
-
-    # replace server path
-    if subscriber.config['server_path']:
-        req_path = req_path.replace(subscriber.config['server_path'], "")
-
-    if not req_path.startswith("/"):
-        req_path = "/" + req_path
-
-    if req_path == "/":
-        return subscriber.handle()
+    if context.request_path(env) == "/":
+        return Subscriber(env, start_response, context=context).handle()
     else:
         start_response("404 Not Found", [('Content-Type', 'text/html')])
         return ["Requested resource not found."]
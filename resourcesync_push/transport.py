@@ -0,0 +1,92 @@
+"""
+The pooled http transport used for all the outbound requests of the
+publisher, hub and subscriber.
+"""
+
+from requests_futures.sessions import FuturesSession
+from requests.adapters import HTTPAdapter
+
+from resourcesync_push.spool import SpooledBody
+from resourcesync_push.profiling import profiler
+
+
+class Transport(object):
+    """
+    A Futures-Requests session with a thread pool of max_workers, and
+    keep-alive connection pools for both http and https. The pool size
+    can be set per host, so that the hosts receiving most of the
+    callbacks can keep more connections open.
+    """
+
+    def __init__(self, max_workers=10, max_retries=3,
+                 pool_connections=10, pool_maxsize=None,
+                 host_pool_maxsize=None,
+                 connect_timeout=None, read_timeout=None,
+                 keep_alive=True):
+
+        if not pool_maxsize:
+            # one connection per worker thread to the same host.
+            pool_maxsize = max_workers
+
+        self.max_workers = max_workers
+        self.timeout = None
+        if connect_timeout or read_timeout:
+            self.timeout = (connect_timeout, read_timeout)
+
+        self.session = FuturesSession(max_workers=max_workers)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+        adapter = HTTPAdapter(max_retries=max_retries,
+                              pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # requests picks the adapter with the longest matching prefix.
+        for host, maxsize in (host_pool_maxsize or {}).items():
+            adapter = HTTPAdapter(max_retries=max_retries,
+                                  pool_connections=1,
+                                  pool_maxsize=maxsize)
+            self.session.mount("http://%s" % host, adapter)
+            self.session.mount("https://%s" % host, adapter)
+
+    def send(self, url, method='POST',
+             data=None,
+             callback=None,
+             headers=None):
+        """
+        Performs http post, get and head requests in the thread pool.
+        Returns the future of the request. A spooled body is streamed
+        from its mapping.
+        """
+
+        if isinstance(data, SpooledBody):
+            data = data.reader()
+
+        if method == 'POST':
+            future = self.session.post(url,
+                                       data=data,
+                                       background_callback=callback,
+                                       headers=headers,
+                                       timeout=self.timeout)
+        elif method == 'GET':
+            future = self.session.get(url,
+                                      headers=headers,
+                                      timeout=self.timeout)
+        elif method == 'HEAD':
+            future = self.session.head(url,
+                                       headers=headers,
+                                       timeout=self.timeout)
+        else:
+            return
+
+        return profiler.track("send", future, url=url, method=method)
+
+    def close(self):
+        """
+        Stops the thread pool once the pending requests are done. The
+        connection pools are closed when the session is collected.
+        """
+
+        self.session.executor.shutdown(wait=False)
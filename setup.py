@@ -35,7 +35,9 @@ setup(name='resourcesync_push',
       test_suite='test',
       scripts=['bin/resourcesync_hub',
                'bin/resourcesync_sub',
-               'bin/resourcesync_pub'],
+               'bin/resourcesync_pub',
+               'bin/resourcesync_delivery',
+               'bin/resourcesync_loadgen'],
       include_package_data=True,
       zip_safe=False,
       data_files=[('/etc/resourcesync_push', ['conf/resourcesync_push.ini',
@@ -11,9 +11,27 @@ class ResourceSyncPuSHTest(unittest.TestCase):
 
 testmodules = [
     'test_resourcesync_push',
+    'test_context',
     'test_subscriber',
     'test_publisher',
-    'test_hub'
+    'test_hub',
+    'test_store',
+    'test_index',
+    'test_delivery',
+    'test_evloop',
+    'test_fetcher',
+    'test_aggregator',
+    'test_dedup',
+    'test_spool',
+    'test_logger',
+    'test_metrics',
+    'test_profiling',
+    'test_benchmarks',
+    'test_loadgen',
+    'test_verifier',
+    'test_patterns',
+    'test_allowlist',
+    'test_ratelimit'
 ]
 
 suite = unittest.TestSuite()
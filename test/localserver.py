@@ -0,0 +1,54 @@
+"""
+Local stand-in subscribers and hubs for the tests, so that the delivery
+tests do not need the network. They reuse the stand-ins of the load
+generator.
+"""
+
+from resourcesync_push.loadgen import StandInServer, LocalHub
+
+import threading
+import time
+
+
+class LocalSubscriber(StandInServer):
+    """
+    An http server on localhost that records the notifications posted
+    to it. Responds with status, after waiting delay seconds.
+    """
+
+    def __init__(self, status=204, delay=0):
+        self.status = status
+        self.delay = delay
+        self.received = []
+        # concurrent requests, and the client ports they came from
+        self.active = 0
+        self.max_active = 0
+        self.peers = set()
+        self.cond = threading.Condition()
+        StandInServer.__init__(self)
+        self.url = "http://127.0.0.1:%s" % self.servers[0].server_port
+
+    def notified(self, request, body):
+        with self.cond:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.peers.add(request.client_address)
+        if self.delay:
+            time.sleep(self.delay)
+        with self.cond:
+            self.active -= 1
+            self.received.append((request.path, request.headers, body))
+            self.cond.notify_all()
+        return self.status
+
+    def wait(self, count, timeout=10):
+        """
+        Waits until count notifications are received. Returns the
+        notifications.
+        """
+
+        end = time.time() + timeout
+        with self.cond:
+            while len(self.received) < count and time.time() < end:
+                self.cond.wait(end - time.time())
+            return list(self.received)
@@ -0,0 +1,89 @@
+from resourcesync_push.hub.aggregator import Aggregator, split_urlset
+
+import threading
+import unittest
+
+
+def changelist(locs, until="2013-01-03T00:00:00Z"):
+    urls = "".join(["<url><loc>%s</loc><rs:md change=\"updated\"/></url>\n"
+                    % loc for loc in locs])
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"
+        xmlns:rs="http://www.openarchives.org/rs/terms/">
+  <rs:md capability="changelist" from="2013-01-02T00:00:00Z"
+         until="%s"/>
+  %s</urlset>""" % (until, urls)
+
+
+class TestAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.published = []
+        self.event = threading.Event()
+        self.headers = {'Content-Type': "application/xml", 'Link': "<t>"}
+
+    def publish(self, topic, payload, headers):
+        self.published.append((topic, payload, headers))
+        self.event.set()
+        return True
+
+    def test_split_urlset(self):
+        head, entries, tail = split_urlset(changelist(["http://e/1"]))
+        assert head.endswith("  ")
+        assert entries.startswith("<url><loc>http://e/1</loc>")
+        assert tail == "\n</urlset>"
+        assert split_urlset('{"url": "http://e/1"}') is None
+        assert split_urlset("<urlset></urlset>") is None
+
+    def test_window(self):
+        aggregator = Aggregator(self.publish, window=0.1)
+        assert aggregator.add("http://topic", changelist(["http://e/1"]),
+                              self.headers)
+        assert aggregator.add("http://topic", changelist(
+            ["http://e/2", "http://e/3"], until="2013-01-04T00:00:00Z"),
+            self.headers)
+        assert not aggregator.add("http://topic", "{}", self.headers)
+        assert self.published == []
+
+        assert self.event.wait(5)
+        assert len(self.published) == 1
+        topic, payload, headers = self.published[0]
+        assert topic == "http://topic"
+        assert headers['Link'] == "<t>"
+        assert headers['Content-Length'] == str(len(payload))
+        assert payload.count("<url>") == 3
+        assert 'until="2013-01-04T00:00:00Z"' in payload
+        assert split_urlset(payload)
+        assert aggregator.pending() == 0
+
+    def test_stop(self):
+        aggregator = Aggregator(self.publish, window=60)
+        assert aggregator.add("http://topic", changelist(["http://e/1"]),
+                              self.headers)
+        timer = aggregator.stop()
+        timer.join(5)
+        assert not timer.is_alive()
+        # published at once
+        assert len(self.published) == 1
+        assert aggregator.pending() == 0
+
+    def test_max_size(self):
+        aggregator = Aggregator(self.publish, window=60, max_urls=3)
+        for num in range(7):
+            aggregator.add("http://topic", changelist(["http://e/%s" % num]),
+                           self.headers)
+        assert [payload.count("<url>")
+                for topic, payload, headers in self.published] == [3, 3]
+
+        payload = changelist(["http://e/%s" % num for num in range(2)])
+        aggregator.max_bytes = len(payload) + 10
+        aggregator.add("http://other", payload, self.headers)
+        aggregator.add("http://other", payload, self.headers)
+        assert len(self.published) == 3
+        assert aggregator.pending() == 2
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAggregator))
+    return suite
@@ -0,0 +1,72 @@
+from resourcesync_push.hub.allowlist import TopicList, AddressList, \
+    parse_list, parse_address
+
+import socket
+import unittest
+
+
+class TestAllowlist(unittest.TestCase):
+
+    def test_parse_list(self):
+        assert parse_list("") == []
+        assert parse_list(None) == []
+        assert parse_list(" a, b ,,c") == ["a", "b", "c"]
+        assert parse_list(["a ", ""]) == ["a"]
+
+    def test_parse_address(self):
+        assert parse_address("10.0.0.1") == (socket.AF_INET, 0x0a000001)
+        assert parse_address("::ffff:10.0.0.1") == (socket.AF_INET,
+                                                    0x0a000001)
+        assert parse_address("::1") == (socket.AF_INET6, 1)
+        assert parse_address("example.org") is None
+
+    def test_topic_list(self):
+        topics = TopicList("http://a/topic, http://b/*")
+        assert topics.configured
+        assert "http://a/topic" in topics
+        assert "http://a/topic/1" not in topics
+        assert "http://a/" not in topics
+        assert "http://b/" in topics
+        assert "http://b/topic" in topics
+        assert not TopicList("").configured
+
+        # invalid entries are kept out, but the list is still configured
+        topics = TopicList("http://*/topic")
+        assert topics.configured
+        assert topics.invalid == ["http://*/topic"]
+        assert "http://a/topic" not in topics
+
+    def test_address_list(self):
+        addresses = AddressList("127.0.0.1, 10.1.0.0/16, fd00::/8, "
+                                "192.168.0.1/33, 10.0.0.0/x")
+        assert addresses.configured
+        assert addresses.invalid == ["192.168.0.1/33", "10.0.0.0/x"]
+        assert "127.0.0.1" in addresses
+        assert "::ffff:127.0.0.1" in addresses
+        assert "127.0.0.2" not in addresses
+        assert "10.1.255.3" in addresses
+        assert "10.2.0.1" not in addresses
+        assert "fd12::1" in addresses
+        assert "fe80::1" not in addresses
+        assert "192.168.0.1" not in addresses
+        assert "" not in addresses
+        assert None not in addresses
+        assert not AddressList("").configured
+
+    def test_address_list_invalid(self):
+        # a configured list with no valid entry allows no address
+        addresses = AddressList("10.0.0.0/x, host.invalid")
+        assert addresses.configured
+        assert addresses.invalid == ["10.0.0.0/x", "host.invalid"]
+        assert "10.0.0.1" not in addresses
+        assert "127.0.0.1" not in addresses
+
+    def test_address_list_host_name(self):
+        addresses = AddressList("localhost")
+        assert "127.0.0.1" in addresses
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAllowlist))
+    return suite
@@ -0,0 +1,64 @@
+from benchmarks import datasets
+from benchmarks.harness import Result, measure, report, compare
+from benchmarks.suite import run
+
+import json
+import unittest
+
+
+class TestDatasets(unittest.TestCase):
+
+    def test_subscriptions(self):
+        subscriptions = datasets.subscriptions(100, now=1000)
+        assert len(subscriptions) == 100 // datasets.TOPIC_SIZE
+        assert sum(len(subs) for subs in subscriptions.values()) == 100
+        assert subscriptions == datasets.subscriptions(100, now=1000)
+
+    def test_changelist(self):
+        changelist = datasets.changelist(10)
+        assert changelist.count("<url>") == 10
+        assert changelist == datasets.changelist(10)
+
+
+class TestHarness(unittest.TestCase):
+
+    def test_measure(self):
+        number, times = measure(lambda: None, repeat=3, min_time=0.001)
+        assert number > 1
+        assert len(times) == 3
+
+    def test_compare(self):
+        baseline = report([Result("bench", {'size': 1}, 1, 1, [1.0]),
+                           Result("gone", {}, 1, 1, [1.0])])
+        current = report([Result("bench", {'size': 1}, 1, 1, [2.0]),
+                          Result("new", {}, 1, 1, [1.0])])
+        rows, regressions = compare(baseline, current, threshold=1.5)
+        assert rows == [("bench[size=1]", 1.0, 2.0, 2.0)]
+        assert regressions == ["bench[size=1]"]
+
+
+class TestSuite(unittest.TestCase):
+
+    def test_run(self):
+        results = run({'subscriptions': [20], 'changelists': [2]},
+                      repeat=1, min_time=0.001)
+        names = set(result.name for result in results)
+        assert names == set([
+            "save_subscriptions", "read_subscriptions", "verify_lease",
+            "get_topic_hub_url", "make_link_header",
+            "create_change_notification", "hub_application"])
+        data = json.loads(json.dumps(report(results)))
+        assert all(result['min'] > 0 for result in data['results'])
+
+    def test_run_filter(self):
+        results = run({'subscriptions': [20], 'changelists': [2]},
+                      names=["link_header"], repeat=1, min_time=0.001)
+        assert [result.name for result in results] == ["make_link_header"]
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestDatasets))
+    suite.addTest(unittest.makeSuite(TestHarness))
+    suite.addTest(unittest.makeSuite(TestSuite))
+    return suite
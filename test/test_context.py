@@ -0,0 +1,70 @@
+from resourcesync_push.context import AppContext
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+CONFIG = """
+[hub]
+url=%s
+"""
+
+
+class TestAppContext(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cnf_file = os.path.join(self.tmp_dir, "resourcesync_push.ini")
+        with open(self.cnf_file, "w") as cnf:
+            cnf.write(CONFIG % "http://localhost:8000/")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_context_reused(self):
+        context = AppContext.get("hub")
+        assert AppContext.get("hub") is context
+        assert context.config['my_url'] is not None
+
+    def test_request_path(self):
+        context = AppContext.get("hub")
+        assert context.request_path({}) == "/"
+        assert context.request_path({'PATH_INFO': "publish"}) == "/publish"
+
+    def test_config_reload(self):
+        context = AppContext("hub", config_files=[self.cnf_file])
+        assert context.config['my_url'] == "http://localhost:8000/"
+        transport = context.transport
+
+        with open(self.cnf_file, "w") as cnf:
+            cnf.write(CONFIG % "http://localhost:8001/")
+        mtime = os.stat(self.cnf_file).st_mtime + 10
+        os.utime(self.cnf_file, (mtime, mtime))
+
+        context.refresh()
+        assert context.config['my_url'] == "http://localhost:8000/"
+
+        context._checked = 0
+        context.refresh()
+        assert context.config['my_url'] == "http://localhost:8001/"
+        assert context.transport is transport
+
+        with open(self.cnf_file, "w") as cnf:
+            cnf.write(CONFIG % "http://localhost:8001/" + "max_workers=20\n")
+        mtime += 10
+        os.utime(self.cnf_file, (mtime, mtime))
+
+        context._checked = 0
+        context.refresh()
+        assert context.transport is not transport
+        assert context.transport.max_workers == 20
+        # still usable by the handlers that hold on to it
+        assert not transport.session.executor._shutdown
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAppContext))
+    return suite
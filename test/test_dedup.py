@@ -0,0 +1,39 @@
+from resourcesync_push.hub.dedup import DuplicateFilter
+from resourcesync_push.metrics import metrics
+
+import time
+import unittest
+
+
+class TestDuplicateFilter(unittest.TestCase):
+
+    def test_duplicates(self):
+        duplicates = DuplicateFilter(window=60)
+        suppressed = metrics.get("duplicates_suppressed")
+        assert duplicates.add("http://topic", "<urlset/>")
+        assert not duplicates.add("http://topic", "<urlset/>")
+        assert duplicates.add("http://other", "<urlset/>")
+        assert duplicates.add("http://topic", "<urlset></urlset>")
+        assert metrics.get("duplicates_suppressed") == suppressed + 1
+
+        # not published
+        duplicates.discard("http://topic", "<urlset/>")
+        assert duplicates.add("http://topic", "<urlset/>")
+
+    def test_expiry(self):
+        duplicates = DuplicateFilter(window=0.05, max_size=2)
+        assert duplicates.add("http://topic", "1")
+        time.sleep(0.1)
+        assert duplicates.add("http://topic", "1")
+
+        assert duplicates.add("http://topic", "2")
+        assert duplicates.add("http://topic", "3")
+        assert duplicates.size() == 2
+        # forgotten, the cache is full
+        assert duplicates.add("http://topic", "1")
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestDuplicateFilter))
+    return suite
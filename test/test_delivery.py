@@ -0,0 +1,234 @@
+from resourcesync_push.hub.delivery import DeliveryQueue, DeliveryWorker, \
+    Backoff, CircuitBreaker, DeadLetters, Delivery, Dispatcher, RetryTimer
+from resourcesync_push.transport import Transport
+from localserver import LocalSubscriber
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class TestDeliveryQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = DeliveryQueue(os.path.join(self.tmp_dir, "delivery.db"),
+                                   visibility_timeout=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_enqueue_claim_complete(self):
+        headers = {'Content-Type': "application/xml"}
+        assert self.queue.enqueue([], "<urlset/>", headers) == 0
+        assert self.queue.enqueue(["http://cb1", "http://cb2"],
+                                  "<urlset/>", headers) == 2
+        assert self.queue.depth() == 2
+        assert self.queue.pending_bytes() == 2 * len("<urlset/>")
+
+        jobs = self.queue.claim(10)
+        assert sorted(job.callback for job in jobs) == ["http://cb1",
+                                                        "http://cb2"]
+        assert jobs[0].payload == "<urlset/>"
+        # a single copy of the payload for all its jobs
+        assert jobs[0].payload is jobs[1].payload
+        assert jobs[0].headers == headers
+        # claimed jobs are not handed out twice
+        assert self.queue.claim(10) == []
+
+        for job in jobs:
+            assert self.queue.complete(job)
+        assert self.queue.depth() == 0
+        assert self.queue.pending_bytes() == 0
+        count = self.queue.connection.execute(
+            "SELECT COUNT(*) FROM payloads").fetchone()[0]
+        assert count == 0
+
+    def test_visibility_timeout(self):
+        self.queue.visibility_timeout = -1
+        self.queue.enqueue(["http://cb1"], "<urlset/>", {})
+        assert len(self.queue.claim(10)) == 1
+        # the worker died, the job is claimed again
+        assert len(self.queue.claim(10)) == 1
+
+
+class TestDeliveryWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = DeliveryQueue(os.path.join(self.tmp_dir, "delivery.db"))
+        self.subscriber = LocalSubscriber()
+
+    def tearDown(self):
+        self.subscriber.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_once(self):
+        callbacks = ["%s/%s" % (self.subscriber.url, num)
+                     for num in range(5)]
+        self.queue.enqueue(callbacks, "<urlset/>",
+                           {'Content-Type': "application/xml"})
+
+        worker = DeliveryWorker(queue=self.queue)
+        assert worker.run_once() == 5
+        received = self.subscriber.wait(5)
+        assert sorted(path for path, headers, body in received) == \
+            ["/%s" % num for num in range(5)]
+        assert received[0][2] == "<urlset/>"
+
+        end = time.time() + 5
+        while self.queue.depth() and time.time() < end:
+            time.sleep(0.01)
+        assert self.queue.depth() == 0
+
+    def test_retry_failed_job(self):
+        self.subscriber.status = 500
+        self.queue.enqueue([self.subscriber.url], "<urlset/>", {})
+
+        worker = DeliveryWorker(queue=self.queue)
+        worker.dispatcher.backoff = Backoff(max_attempts=2, base_delay=0)
+        assert worker.run_once() == 1
+        self.subscriber.wait(1)
+
+        end = time.time() + 5
+        jobs = []
+        while not jobs and time.time() < end:
+            jobs = self.queue.claim(10)
+            time.sleep(0.01)
+        assert len(jobs) == 1
+        assert jobs[0].attempts == 1
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.subscriber = LocalSubscriber()
+        self.transport = Transport()
+        self.dead_letters = DeadLetters(os.path.join(self.tmp_dir,
+                                                     "dead_letters.log"))
+        self.done = []
+
+    def tearDown(self):
+        self.subscriber.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def dispatch(self, dispatcher, callback):
+        dispatcher.dispatch(Delivery(
+            callback, "<urlset/>", {},
+            done=lambda delivery, delivered: self.done.append(delivered)))
+        end = time.time() + 5
+        while not self.done and time.time() < end:
+            time.sleep(0.01)
+        return self.done.pop()
+
+    def test_backoff(self):
+        backoff = Backoff(base_delay=1, max_delay=10)
+        for attempts in range(10):
+            assert 0 <= backoff.delay(attempts) <= min(10, 2 ** attempts)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.failure("http://cb")
+        assert breaker.allow("http://cb")
+        breaker.failure("http://cb")
+        assert not breaker.allow("http://cb")
+        assert breaker.remaining("http://cb") > 0
+
+        breaker.reset_timeout = 0
+        # a single trial once the timeout is over
+        assert breaker.allow("http://cb")
+        breaker.reset_timeout = 60
+        assert not breaker.allow("http://cb")
+        breaker.success("http://cb")
+        assert breaker.allow("http://cb")
+
+    def test_retry_timer_stop(self):
+        timer = RetryTimer(self.done.append)
+        timer.start()
+        timer.schedule("later", 60)
+        timer.schedule("sooner", 30)
+        assert timer.stop() == ["sooner", "later"]
+        timer.join(5)
+        assert not timer.is_alive()
+        assert self.done == []
+
+    def test_configure(self):
+        config = {
+            'retry_max_attempts': 3,
+            'retry_base_delay': 0.5,
+            'retry_max_delay': 10,
+            'circuit_failure_threshold': 1,
+            'circuit_reset_timeout': 60,
+            'dead_letter_file': self.dead_letters.filename,
+        }
+        dispatcher = Dispatcher.from_config(config, self.transport.send)
+        dispatcher.breaker.failure("http://cb")
+        dead_letters = dispatcher.dead_letters
+
+        config['retry_max_attempts'] = 5
+        config['circuit_reset_timeout'] = 30
+        dispatcher.configure(config, self.transport.send)
+        assert dispatcher.backoff.max_attempts == 5
+        assert dispatcher.breaker.reset_timeout == 30
+        # the circuits are kept
+        assert not dispatcher.breaker.allow("http://cb")
+        assert dispatcher.dead_letters is dead_letters
+
+        config['dead_letter_file'] = ""
+        dispatcher.configure(config, self.transport.send)
+        assert dispatcher.dead_letters is None
+
+    def test_delivered(self):
+        dispatcher = Dispatcher(self.transport.send)
+        assert self.dispatch(dispatcher, self.subscriber.url)
+        assert len(self.subscriber.received) == 1
+
+    def test_retries_and_dead_letters(self):
+        self.subscriber.status = 503
+        dispatcher = Dispatcher(self.transport.send,
+                                backoff=Backoff(max_attempts=3,
+                                                base_delay=0.01),
+                                dead_letters=self.dead_letters)
+        assert not self.dispatch(dispatcher, self.subscriber.url)
+        assert len(self.subscriber.received) == 3
+
+        with open(self.dead_letters.filename) as dead_letters:
+            record = json.loads(dead_letters.readline())
+        assert record['callback'] == self.subscriber.url
+        assert record['attempts'] == 3
+        assert record['payload'] == "<urlset/>"
+
+    def test_not_retried(self):
+        self.subscriber.status = 404
+        dispatcher = Dispatcher(self.transport.send)
+        assert not self.dispatch(dispatcher, self.subscriber.url)
+        assert len(self.subscriber.received) == 1
+
+    def test_open_circuit(self):
+        self.subscriber.status = 500
+        dispatcher = Dispatcher(self.transport.send,
+                                backoff=Backoff(max_attempts=5,
+                                                base_delay=0.01),
+                                breaker=CircuitBreaker(failure_threshold=2))
+        dispatcher.dispatch(Delivery(self.subscriber.url, "<urlset/>", {}))
+        self.subscriber.wait(2)
+        end = time.time() + 5
+        while dispatcher.breaker.allow(self.subscriber.url) and \
+                time.time() < end:
+            time.sleep(0.01)
+        # not sent once the circuit is open, until it lets a trial through
+        time.sleep(0.1)
+        assert len(self.subscriber.received) == 2
+        assert dispatcher.timer.pending() == 1
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestDeliveryQueue))
+    suite.addTest(unittest.makeSuite(TestDeliveryWorker))
+    suite.addTest(unittest.makeSuite(TestDispatcher))
+    return suite
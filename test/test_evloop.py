@@ -0,0 +1,144 @@
+from resourcesync_push.hub import evloop
+from resourcesync_push.hub.evloop import EventLoopTransport, DeliveryError, \
+    parse_response
+from resourcesync_push.hub.delivery import Backoff, CircuitBreaker, \
+    Delivery, Dispatcher
+from localserver import LocalSubscriber
+
+import socket
+import threading
+import unittest
+
+
+class TestEventLoopTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.subscribers = []
+        self.engine = EventLoopTransport(max_concurrency=6, max_per_host=2,
+                                         connect_timeout=2, read_timeout=2)
+
+    def tearDown(self):
+        self.engine.stop()
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+    def subscriber(self, **kwargs):
+        subscriber = LocalSubscriber(**kwargs)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def test_fan_out(self):
+        subscribers = [self.subscriber(delay=0.02) for num in range(4)]
+        futures = []
+        for num in range(20):
+            for subscriber in subscribers:
+                futures.append(self.engine.send(
+                    subscriber.url + "/cb%s" % num, data="<urlset/>",
+                    headers={'Content-Type': "application/xml"}))
+
+        for future in futures:
+            assert future.result(timeout=10).status_code == 204
+        for subscriber in subscribers:
+            received = subscriber.wait(20)
+            assert len(received) == 20
+            assert received[0][2] == "<urlset/>"
+            assert received[0][1]['Content-Type'] == "application/xml"
+            # the per host limit is kept, and the connections reused
+            assert subscriber.max_active <= 2
+            assert len(subscriber.peers) <= 2
+        assert self.engine.active() == 0
+
+    def test_errors(self):
+        slow = self.subscriber(delay=1)
+        self.engine.read_timeout = 0.2
+        with self.assertRaises(DeliveryError):
+            self.engine.send(slow.url, data="x").result(timeout=10)
+
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with self.assertRaises(socket.error):
+            self.engine.send("http://127.0.0.1:%s/" % port,
+                             data="x").result(timeout=10)
+
+        with self.assertRaises(DeliveryError):
+            self.engine.send("ftp://example.org/", data="x").result()
+
+    def test_resolver(self):
+        subscriber = self.subscriber()
+        lookups = []
+        release = threading.Event()
+        getaddrinfo = evloop.getaddrinfo
+
+        def lookup(host, *args):
+            lookups.append(host)
+            if host == "slow.invalid":
+                release.wait(10)
+            if host.endswith(".invalid"):
+                raise socket.gaierror(socket.EAI_NONAME, "Unknown host")
+            return getaddrinfo(host, *args)
+
+        evloop.getaddrinfo = lookup
+        try:
+            slow = self.engine.send("http://slow.invalid/", data="x")
+            # a slow lookup does not hold up the other hosts
+            response = self.engine.send(subscriber.url,
+                                        data="x").result(timeout=10)
+            assert response.status_code == 204
+            assert not slow.done()
+            release.set()
+            with self.assertRaises(socket.gaierror):
+                slow.result(timeout=10)
+
+            # failed lookups are cached too
+            for num in range(2):
+                with self.assertRaises(socket.gaierror):
+                    self.engine.send("http://bad.invalid/",
+                                     data="x").result(timeout=10)
+            assert lookups.count("bad.invalid") == 1
+            assert self.engine.active() == 0
+        finally:
+            release.set()
+            evloop.getaddrinfo = getaddrinfo
+
+    def test_dispatcher(self):
+        failing = self.subscriber(status=503)
+        done = []
+        event = threading.Event()
+
+        def delivered(delivery, success):
+            done.append(success)
+            event.set()
+
+        dispatcher = Dispatcher(self.engine.send,
+                                backoff=Backoff(max_attempts=2,
+                                                base_delay=0.01),
+                                breaker=CircuitBreaker())
+        dispatcher.dispatch(Delivery(failing.url, "<urlset/>", {},
+                                     done=delivered))
+        assert event.wait(10)
+        assert done == [False]
+        assert len(failing.wait(2)) == 2
+
+    def test_parse_response(self):
+        data = "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" \
+            "3\r\nabc\r\n"
+        assert parse_response(data, "POST", False) == (None, False)
+        response, keep_alive = parse_response(data + "0\r\n\r\n", "POST",
+                                              False)
+        assert response.status_code == 200
+        assert response.content == "abc"
+        assert keep_alive
+
+        data = "HTTP/1.0 200 OK\r\n\r\nabc"
+        assert parse_response(data, "POST", False) == (None, False)
+        response, keep_alive = parse_response(data, "POST", True)
+        assert response.content == "abc"
+        assert not keep_alive
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestEventLoopTransport))
+    return suite
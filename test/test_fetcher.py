@@ -0,0 +1,120 @@
+from resourcesync_push.hub.fetcher import FeedFetcher
+from resourcesync_push.metrics import metrics
+
+from concurrent.futures import Future
+import threading
+import unittest
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, content="<feed/>", etag=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {'content-type': "application/atom+xml"}
+        if etag:
+            self.headers['etag'] = etag
+
+
+class TestFeedFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.published = []
+        self.futures = []
+        self.fetcher = FeedFetcher(self.send, self.publish, max_pending=2)
+
+    def send(self, url, method='POST', headers=None, **kwargs):
+        assert method == 'GET'
+        future = Future()
+        self.futures.append(future)
+        self.headers = headers
+        return future
+
+    def publish(self, url, response):
+        self.published.append((url, response.content))
+        return True
+
+    def test_fetch(self):
+        fetches = metrics.get("fetches")
+        assert self.fetcher.submit("http://example.com/feed")
+        assert self.fetcher.pending() == 1
+        assert self.published == []
+
+        self.futures[0].set_result(FakeResponse())
+        assert self.published == [("http://example.com/feed", "<feed/>")]
+        assert self.fetcher.pending() == 0
+        assert metrics.get("fetches") == fetches + 1
+
+    def test_fetch_failures(self):
+        failures = metrics.get("fetch_failures")
+        assert self.fetcher.submit("http://example.com/feed")
+        assert self.fetcher.submit("http://example.com/gone")
+        # too many pending fetches
+        assert not self.fetcher.submit("http://example.com/other")
+
+        self.futures[0].set_exception(IOError("Connection refused"))
+        self.futures[1].set_result(FakeResponse(status_code=404))
+        assert self.published == []
+        assert self.fetcher.pending() == 0
+        assert metrics.get("fetch_failures") == failures + 2
+
+    def test_conditional_fetch(self):
+        url = "http://example.com/feed"
+        self.fetcher.submit(url)
+        assert self.headers == {}
+        self.futures[-1].set_result(FakeResponse(etag='"v1"'))
+
+        not_modified = metrics.get("fetch_not_modified")
+        self.fetcher.submit(url)
+        assert self.headers == {'If-None-Match': '"v1"'}
+        self.futures[-1].set_result(FakeResponse(status_code=304))
+        assert metrics.get("fetch_not_modified") == not_modified + 1
+
+        # the same content is not published again
+        unchanged = metrics.get("fetch_unchanged")
+        self.fetcher.submit(url)
+        self.futures[-1].set_result(FakeResponse(etag='"v2"'))
+        assert metrics.get("fetch_unchanged") == unchanged + 1
+
+        self.fetcher.submit(url)
+        self.futures[-1].set_result(FakeResponse(content="<feed>1</feed>"))
+        assert self.published == [(url, "<feed/>"), (url, "<feed>1</feed>")]
+
+    def test_coalesce(self):
+        url = "http://example.com/feed"
+        coalesced = metrics.get("fetch_coalesced")
+        for num in range(3):
+            assert self.fetcher.submit(url)
+        # a single fetch, fetched again for the pings during the fetch
+        assert len(self.futures) == 1
+        assert metrics.get("fetch_coalesced") == coalesced + 2
+        self.futures[0].set_result(FakeResponse())
+        assert len(self.futures) == 2
+        self.futures[1].set_result(FakeResponse(content="<feed>1</feed>"))
+        assert len(self.futures) == 2
+        assert self.fetcher.pending() == 0
+        assert self.published == [(url, "<feed/>"), (url, "<feed>1</feed>")]
+
+    def test_debounce(self):
+        fetched = threading.Event()
+
+        def send(url, method='POST', **kwargs):
+            future = self.send(url, method=method, **kwargs)
+            fetched.set()
+            return future
+
+        self.fetcher.send = send
+        self.fetcher.debounce = 0.1
+        for num in range(5):
+            assert self.fetcher.submit("http://example.com/feed")
+        assert self.futures == []
+        assert fetched.wait(5)
+        self.futures[0].set_result(FakeResponse())
+        assert len(self.futures) == 1
+        assert len(self.published) == 1
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestFeedFetcher))
+    return suite
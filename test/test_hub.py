@@ -1,48 +1,71 @@
-from resourcesync_push.hub.hub import application
+from resourcesync_push.hub.hub import Hub
+from resourcesync_push.hub.delivery import Delivery
+from resourcesync_push.hub.allowlist import AddressList, TopicList
+from resourcesync_push.hub.index import SharedIndex
 
+from localserver import LocalSubscriber, LocalHub
 from webtest import TestApp
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
-app = TestApp(application)
 
+class HubTestCase(unittest.TestCase):
+    """
+    Runs the tests against a hub with its files in a temporary
+    directory.
+    """
 
-class TestHubPublisher(unittest.TestCase):
+    def setUp(self):
+        self.hub = LocalHub()
+        self.app = TestApp(self.hub.application)
+
+    def tearDown(self):
+        self.hub.close()
+
+
+class TestHubPublisher(HubTestCase):
 
     def test_publish_unknown(self):
-        app.get("/heythere", status=404)
+        self.app.get("/heythere", status=404)
 
     def test_publish_get(self):
-        app.get("/publish", status=405)
+        self.app.get("/publish", status=405)
 
     def test_publish_invalid_content_type(self):
-        app.post("/publish", content_type="", status=400)
-        app.post("/publish", content_type="application/pdf", status=406)
+        self.app.post("/publish", content_type="", status=400)
+        self.app.post("/publish", content_type="application/pdf", status=406)
 
     def test_publish_handle_invalid_push_request(self):
         data = "hub.mode=publish"
-        app.post("/publish", content_type="application/x-www-form-urlencoded",
-                 params=data, status=400)
+        self.app.post("/publish",
+                      content_type="application/x-www-form-urlencoded",
+                      params=data, status=400)
 
     def test_publish_handle_push_request(self):
         data = "hub.mode=publish&hub.url=http://httpbin.org/get"
-        app.post("/publish", content_type="application/x-www-form-urlencoded",
-                 params=data, status=204)
+        self.app.post("/publish",
+                      content_type="application/x-www-form-urlencoded",
+                      params=data, status=202)
 
     def test_publish_handle_invalid_resourcesync_request(self):
         data = ""
-        app.post("/publish", content_type="application/xml",
-                 params=data, status=400)
+        self.app.post("/publish", content_type="application/xml",
+                      params=data, status=400)
         # no link header
         data = "<url></url>"
-        app.post("/publish", content_type="application/xml",
-                 params=data, status=400)
+        self.app.post("/publish", content_type="application/xml",
+                      params=data, status=400)
         # bad link header
         data = "<url></url>"
         link = '<http://example.com/dataset1/change/>;rel="timegate",\
             <http://hub.example.org/pubsubhubbub/>;rel="memento"'
-        app.post("/publish", content_type="application/xml",
-                 params=data, status=400,
-                 headers={'Link': link})
+        self.app.post("/publish", content_type="application/xml",
+                      params=data, status=400,
+                      headers={'Link': link})
 
     def test_publish_handle_resourcesync_request(self):
         payload = """<?xml version="1.0" encoding="UTF-8"?>
@@ -64,55 +87,325 @@ class TestHubPublisher(unittest.TestCase):
 </urlset>"""
         link = '<http://example.com/dataset1/change/>;rel="self",\
             <http://hub.example.org/pubsubhubbub/>;rel="hub"'
-        app.post("/publish", content_type="application/xml",
-                 params=payload, status=204,
-                 headers={'Link': link})
+        self.app.post("/publish", content_type="application/xml",
+                      params=payload, status=204,
+                      headers={'Link': link})
+
+
+class TestHubMetrics(HubTestCase):
+
+    def test_metrics(self):
+        data = "hub.mode=publish&hub.url=http://example.com/feed"
+        self.app.post("/publish",
+                      content_type="application/x-www-form-urlencoded",
+                      params=data, status=202)
+        response = self.app.get("/metrics", status=200)
+        assert response.content_type == "text/plain"
+        assert 'resourcesync_publishes{mode="push",\
+topic="http://example.com/feed"}' in response.body
+
+    def test_post(self):
+        self.app.post("/metrics", status=405)
 
 
-class TestHubSubscriber(unittest.TestCase):
+class TestHubSubscriber(HubTestCase):
 
     def test_subscribe_get(self):
-        app.get("/subscribe", status=405)
+        self.app.get("/subscribe", status=405)
 
     def test_subscribe_invalid_content_type(self):
-        app.post("/subscribe", content_type="", status=400)
+        self.app.post("/subscribe", content_type="", status=400)
 
     def test_subscribe_handle_invalid_push_request(self):
+        data = "hub.mode=subscribe&hub.verify=sync&\
+            hub.topic=http://localhost/test&hub.callback=http://localhost"
+        self.app.post("/subscribe",
+                      content_type="application/x-www-form-urlencoded",
+                      params=data, status=409)
+
+    def test_subscribe_async(self):
+        # verified in the background
         data = "hub.mode=subscribe&hub.verify=async&\
             hub.topic=http://localhost/test&hub.callback=http://localhost"
-        app.post("/subscribe",
-                 content_type="application/x-www-form-urlencoded",
-                 params=data, status=409)
+        self.app.post("/subscribe",
+                      content_type="application/x-www-form-urlencoded",
+                      params=data, status=202)
+
+    def test_subscribe_callback_newline(self):
+        for verify in ["sync", "async"]:
+            data = "hub.mode=subscribe&hub.verify=%s&\
+hub.topic=http://localhost/test&\
+hub.callback=http://localhost/x%%0A9999999999.0%%20http://victim.example/" % \
+                verify
+            self.app.post("/subscribe",
+                          content_type="application/x-www-form-urlencoded",
+                          params=data, status=400)
+
+    def test_subscribe_unsupported_verify(self):
+        data = "hub.mode=subscribe&hub.verify=later&\
+            hub.topic=http://localhost/test&hub.callback=http://localhost"
+        self.app.post("/subscribe",
+                      content_type="application/x-www-form-urlencoded",
+                      params=data, status=400)
+
+    def test_subscribe_invalid_lease(self):
+        subscriber = LocalSubscriber()
+        try:
+            for verify in ["sync", "async"]:
+                for lease in ["abc", "0", "-10", "inf"]:
+                    data = "hub.mode=subscribe&hub.verify=%s&\
+hub.topic=http://localhost/test&hub.callback=%s&hub.lease_seconds=%s" % \
+                        (verify, subscriber.url, lease)
+                    self.app.post(
+                        "/subscribe",
+                        content_type="application/x-www-form-urlencoded",
+                        params=data, status=400)
+            # rejected before any challenge
+            assert self.hub.context.verifier.pending() == 0
+            assert subscriber.challenges == 0
+        finally:
+            subscriber.close()
+
+
+class TestHubBulkSubscriber(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = LocalHub()
+        self.app = TestApp(self.hub.application)
+        self.subscriber = LocalSubscriber()
+
+    def tearDown(self):
+        self.subscriber.close()
+        self.hub.close()
+
+    def post(self, data, status=200):
+        return self.app.post("/subscribe/bulk", params=json.dumps(data),
+                             content_type="application/json", status=status)
+
+    def test_bulk_subscribe(self):
+        topic = "http://localhost/topic"
+        callback = self.subscriber.url + "/cb"
+        response = self.post({'subscriptions': [
+            {'mode': "subscribe", 'topic': topic, 'callback': callback,
+             'lease_seconds': 10},
+            {'mode': "subscribe", 'topic': "http://localhost/other",
+             'callback': callback},
+            {'mode': "subscribe", 'topic': topic},
+            {'mode': "subscribe", 'topic': topic, 'callback': callback,
+             'lease_seconds': 60},
+            # nothing listens on port 9
+            {'mode': "subscribe", 'topic': topic,
+             'callback': "http://127.0.0.1:9/cb"},
+            {'mode': "subscribe", 'topic': topic, 'callback': callback,
+             'lease_seconds': -1},
+        ]})
+        assert json.loads(response.body)['results'] == [
+            "replaced", "verified", "invalid", "verified", "failed",
+            "invalid"]
+        store = self.hub.context.store
+        assert store.get_subscribers(topic).keys() == [callback]
+        assert store.get_subscribers("http://localhost/other").keys() == \
+            [callback]
+
+        response = self.post({'subscriptions': [
+            {'mode': "unsubscribe", 'topic': topic, 'callback': callback}]})
+        assert json.loads(response.body)['results'] == ["verified"]
+        assert store.get_subscribers(topic) == {}
+
+    def test_bulk_async(self):
+        response = self.post({'verify': "async", 'subscriptions': [
+            {'mode': "subscribe", 'topic': "http://localhost/topic",
+             'callback': self.subscriber.url}]}, status=202)
+        assert json.loads(response.body)['results'] == ["accepted"]
+        verifier = self.hub.context.verifier
+        end = time.time() + 5
+        while verifier.pending() and time.time() < end:
+            time.sleep(0.01)
+        assert self.hub.context.store.get_subscribers(
+            "http://localhost/topic").keys() == [self.subscriber.url]
+
+    def test_bulk_wildcard(self):
+        callback = self.subscriber.url + "/cb"
+        response = self.post({'subscriptions': [
+            {'mode': "subscribe", 'topic': "http://localhost/dataset/*",
+             'callback': callback},
+            {'mode': "subscribe", 'topic': "http://localhost/*/topic",
+             'callback': callback}]})
+        assert json.loads(response.body)['results'] == [
+            "verified", "invalid"]
+        hub = Hub(context=self.hub.context)
+        assert hub.get_subscribers("http://localhost/dataset/1").keys() == \
+            [callback]
+        assert hub.get_subscribers("http://localhost/other") == {}
+
+    def test_bulk_invalid(self):
+        self.app.get("/subscribe/bulk", status=405)
+        self.app.post("/subscribe/bulk", params="{}",
+                      content_type="application/x-www-form-urlencoded",
+                      status=406)
+        self.app.post("/subscribe/bulk", params="[",
+                      content_type="application/json", status=400)
+        self.post({'subscriptions': "all"}, status=400)
+        self.post({'verify': "later", 'subscriptions': []}, status=400)
+        self.post({'subscriptions': [{}] * 1001}, status=413)
+
+
+class TestHubContext(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = LocalHub()
+
+    def tearDown(self):
+        self.hub.close()
+
+    def test_index_miss(self):
+        context = self.hub.context
+        index = SharedIndex(os.path.join(self.hub.directory, "test.idx"))
+        index.write({})
+        lease = time.time() + 60
+        context.store.subscribe("http://localhost/topic", "http://cb", lease)
+        hub = Hub(context=context)
+        hub.index = index
+        # subscribed since the index was written
+        assert hub.get_subscribers("http://localhost/topic") == {
+            "http://cb": lease}
+
+    def test_reload_keeps_dispatcher(self):
+        context = self.hub.context
+        dispatcher = context.dispatcher
+        dispatcher.breaker.failure_threshold = 1
+        dispatcher.breaker.failure("http://cb")
+        context.load()
+        assert context.dispatcher is dispatcher
+        assert not dispatcher.breaker.allow("http://cb")
+
+    def test_close_stops_timers(self):
+        context = self.hub.context
+        context.dispatcher.retry(Delivery("http://cb", "", {}), 60)
+        timer = context.dispatcher.timer
+        context.close()
+        timer.join(5)
+        assert not timer.is_alive()
+
+
+class TestHubTrusted(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        config_file = os.path.join(self.tmp_dir, "trusted.ini")
+        with open(config_file, "w") as cnf_file:
+            cnf_file.write("[hub]\n"
+                           "trusted_publishers=127.0.0.1, 10.0.0.0/8\n"
+                           "trusted_topics=http://localhost/dataset/*\n")
+        self.hub = LocalHub(config_files=[config_file])
+        self.app = TestApp(self.hub.application)
+
+    def tearDown(self):
+        self.hub.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def publish(self, remote_addr, topic, status):
+        link = '<%s>; rel="self", <http://localhost/publish>; rel="hub"' % \
+            topic
+        self.app.post("/publish", params="<urlset/>",
+                      content_type="application/xml; charset=utf-8",
+                      headers={'Link': link}, status=status,
+                      extra_environ={'REMOTE_ADDR': remote_addr})
+
+    def test_trusted(self):
+        self.publish("127.0.0.1", "http://localhost/dataset/1", 204)
+        self.publish("10.2.3.4", "http://localhost/dataset/2", 204)
+        self.publish("192.168.0.1", "http://localhost/dataset/1", 403)
+        self.publish("127.0.0.1", "http://localhost/other", 403)
+
+    def test_no_valid_entry(self):
+        # a configured list does not fall back to allowing anything
+        config = self.hub.context.config
+        config['trusted_publishers'] = AddressList("10.0.0.0/x")
+        self.publish("127.0.0.1", "http://localhost/dataset/1", 403)
+        config['trusted_publishers'] = AddressList("")
+        config['trusted_topics'] = TopicList("http://*/dataset")
+        self.publish("127.0.0.1", "http://localhost/dataset/1", 403)
+
+
+class TestHubAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        config_file = os.path.join(self.tmp_dir, "admission.ini")
+        with open(config_file, "w") as cnf_file:
+            cnf_file.write("[hub]\n"
+                           "publisher_rate=0.1\n"
+                           "publisher_burst=3\n"
+                           "topic_rate=0.1\n"
+                           "topic_burst=1\n"
+                           "max_inflight_bytes=100\n"
+                           "overload_retry_after=3\n")
+        self.hub = LocalHub(config_files=[config_file])
+        self.app = TestApp(self.hub.application)
+
+    def tearDown(self):
+        self.hub.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def publish(self, remote_addr, topic, status):
+        link = '<%s>; rel="self", <http://localhost/publish>; rel="hub"' % \
+            topic
+        return self.app.post("/publish", params="<urlset/>",
+                             content_type="application/xml",
+                             headers={'Link': link}, status=status,
+                             extra_environ={'REMOTE_ADDR': remote_addr})
+
+    def test_rate_limits(self):
+        self.publish("10.0.0.1", "http://localhost/topic/1", 204)
+        response = self.publish("10.0.0.1", "http://localhost/topic/1", 429)
+        assert 0 < int(response.headers['Retry-After']) <= 10
+        self.publish("10.0.0.1", "http://localhost/topic/2", 204)
+        response = self.publish("10.0.0.1", "http://localhost/topic/3", 429)
+        assert 0 < int(response.headers['Retry-After']) <= 10
+        self.publish("10.0.0.2", "http://localhost/topic/3", 204)
+
+    def test_overloaded(self):
+        self.hub.context.inflight.add(100)
+        response = self.publish("10.0.0.1", "http://localhost/topic/1", 503)
+        assert response.headers['Retry-After'] == "3"
+        self.hub.context.inflight.release(100)
+        self.publish("10.0.0.1", "http://localhost/topic/1", 204)
 
 
-class TestHubRegister(unittest.TestCase):
+class TestHubRegister(HubTestCase):
 
     def test_post(self):
-        app.post("/register", status=405)
+        self.app.post("/register", status=405)
 
     def test_register(self):
-        app.get("/register")
+        self.app.get("/register")
 
 
-class TestHubRegisterSuccess(unittest.TestCase):
+class TestHubRegisterSuccess(HubTestCase):
 
     def test_post(self):
-        app.get("/registersuccess", status=405)
+        self.app.get("/registersuccess", status=405)
 
     def test_invalid_register_success(self):
-        app.post("/registersuccess", status=400)
+        self.app.post("/registersuccess", status=400)
 
     def test_register_success(self):
         data = "topic_url=http://localhost"
-        app.post("/registersuccess",
-                 content_type="application/x-www-form-urlencoded",
-                 params=data)
+        self.app.post("/registersuccess",
+                      content_type="application/x-www-form-urlencoded",
+                      params=data)
 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestHubPublisher))
+    suite.addTest(unittest.makeSuite(TestHubMetrics))
     suite.addTest(unittest.makeSuite(TestHubSubscriber))
+    suite.addTest(unittest.makeSuite(TestHubBulkSubscriber))
+    suite.addTest(unittest.makeSuite(TestHubContext))
+    suite.addTest(unittest.makeSuite(TestHubTrusted))
+    suite.addTest(unittest.makeSuite(TestHubAdmission))
     suite.addTest(unittest.makeSuite(TestHubRegister))
     suite.addTest(unittest.makeSuite(TestHubRegisterSuccess))
     return suite
@@ -0,0 +1,76 @@
+from resourcesync_push.hub.index import SharedIndex, IndexBuilder
+from resourcesync_push.hub.store import SQLiteStore
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class TestSharedIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.tmp_dir, "subscriptions.idx")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_no_index(self):
+        index = SharedIndex(self.index_file)
+        assert index.get_subscribers("http://topic") is None
+
+    def test_get_subscribers(self):
+        lease = time.time() + 60
+        writer = SharedIndex(self.index_file)
+        reader = SharedIndex(self.index_file)
+        subscriptions = dict(("http://topic%s" % num,
+                              {"http://cb%s" % num: lease,
+                               "http://expired": time.time() - 1})
+                             for num in range(100))
+        assert writer.write(subscriptions) == 1
+        for num in range(100):
+            assert reader.get_subscribers("http://topic%s" % num) == \
+                {"http://cb%s" % num: lease}
+        # not in the index, left to the store
+        assert reader.get_subscribers("http://topic") is None
+        assert reader.get_subscribers("http://topic999") is None
+
+        # the readers pick up a new generation
+        assert writer.write({"http://topic": {"http://cb": lease}}) == 2
+        assert reader.get_subscribers("http://topic") == {"http://cb": lease}
+        assert reader.get_subscribers("http://topic1") is None
+
+    def test_callback_newlines(self):
+        lease = time.time() + 60
+        index = SharedIndex(self.index_file)
+        callbacks = {"http://sub/x\nnot-a-lease-line": lease,
+                     "http://sub/y\n9999999999.0 http://victim.example/":
+                     lease}
+        index.write({"http://topic": callbacks})
+        assert index.get_subscribers("http://topic") == callbacks
+
+    def test_index_builder(self):
+        store = SQLiteStore(os.path.join(self.tmp_dir, "subscriptions.db"))
+        index = SharedIndex(self.index_file)
+        builder = IndexBuilder(index, store)
+        other = IndexBuilder(SharedIndex(self.index_file), store)
+        assert builder.is_writer()
+        assert not other.is_writer()
+
+        lease = time.time() + 60
+        assert builder.build()
+        assert not builder.build()
+        assert index.get_subscribers("http://topic") is None
+
+        SQLiteStore(store.filename).subscribe("http://topic", "http://cb",
+                                              lease)
+        assert builder.build()
+        assert index.get_subscribers("http://topic") == {"http://cb": lease}
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSharedIndex))
+    return suite
@@ -0,0 +1,89 @@
+from resourcesync_push.loadgen import StandInSubscribers, LocalHub, \
+    LoadGenerator, changelist, percentiles, main
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestLoadGenerator(unittest.TestCase):
+
+    def setUp(self):
+        self.subscribers = StandInSubscribers(6, servers=2)
+
+    def tearDown(self):
+        self.subscribers.close()
+
+    def test_percentiles(self):
+        result = percentiles(range(1, 101))
+        assert result['p50'] == 50
+        assert result['p99'] == 99
+        assert result['max'] == 100
+        assert percentiles([])['p50'] is None
+
+    def test_changelist(self):
+        payload = changelist(7, 3)
+        assert payload.count("<url>") == 3
+        assert "/publish/7/2</loc>" in payload
+
+    def check_run(self, hub):
+        generator = LoadGenerator(hub.client, self.subscribers,
+                                  hub.url + "/publish", topics=2, rate=100)
+        generator.subscribe()
+        assert generator.subscribed == {0: 3, 1: 3}
+        generator.publish(4)
+        generator.drain(10)
+        report = generator.report(1, 1, 1)
+        assert report['publish']['statuses'] == {'204': 4}
+        assert report['delivery']['expected'] == 12
+        assert report['delivery']['delivered'] == 12
+        assert report['delivery']['latency_seconds']['max'] > 0
+
+    def test_inprocess(self):
+        hub = LocalHub()
+        try:
+            self.check_run(hub)
+        finally:
+            hub.close()
+
+    def test_local_server(self):
+        hub = LocalHub(serve=True)
+        try:
+            self.check_run(hub)
+        finally:
+            hub.close()
+
+    def test_request_errors(self):
+        class FailingClient(object):
+            def request(self, *args):
+                raise IOError("Connection refused")
+
+        generator = LoadGenerator(FailingClient(), self.subscribers,
+                                  "http://localhost/publish", rate=1000)
+        generator.subscribe()
+        generator.publish(2)
+        report = generator.report(1, 1, 0)
+        # counted in the report, not lost with stdout
+        assert report['subscribe']['statuses'] == {'error': 6}
+        assert report['publish']['statuses'] == {'error': 2}
+        assert report['delivery']['expected'] == 0
+
+    def test_main(self):
+        tmp_dir = tempfile.mkdtemp()
+        output = os.path.join(tmp_dir, "report.json")
+        try:
+            main(["--subscribers", "3", "--publishes", "2", "--rate", "100",
+                  "--drain", "10", "--output", output])
+            with open(output) as report_file:
+                report = json.load(report_file)
+        finally:
+            shutil.rmtree(tmp_dir)
+        assert report['delivery']['delivered'] == 6
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestLoadGenerator))
+    return suite
@@ -0,0 +1,75 @@
+from resourcesync_push.logger import LogShipper, TopicSampler, make_record
+from resourcesync_push.metrics import metrics
+
+import hashlib
+import json
+import threading
+import time
+import unittest
+
+
+class TestLogShipper(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.posted = threading.Event()
+
+    def post(self, data):
+        self.batches.append(json.loads(data))
+        self.posted.set()
+
+    def test_make_record(self):
+        payload = "<urlset>%s</urlset>" % ("x" * 1000)
+        log_msg = {'payload': payload, 'msg': ["Payload size"],
+                   'link_header': "<t>", 'module': "hub"}
+        record = make_record(log_msg, payload_max=8)
+        assert record['payload'] == "<urlset>"
+        assert record['payload_truncated']
+        assert record['payload_size'] == len(payload)
+        assert record['payload_sha1'] == hashlib.sha1(payload).hexdigest()
+        assert record['msg'] == ["Payload size"]
+        # the log_msg is left as is
+        assert log_msg['payload'] == payload
+
+        assert 'payload' not in make_record(log_msg, payload_max=0)
+        assert 'payload_size' not in make_record({'payload': ""})
+
+    def test_batches(self):
+        shipper = LogShipper(post=self.post, batch_size=3, flush_interval=60)
+        for num in range(3):
+            assert shipper.ship({'msg': [str(num)], 'payload': "p"})
+        assert self.posted.wait(5)
+        assert [record['msg'] for record in self.batches[0]] == [
+            ["0"], ["1"], ["2"]]
+
+        # the rest is written on stop
+        assert shipper.ship({'msg': ["3"]})
+        shipper.stop()
+        end = time.time() + 5
+        while len(self.batches) < 2 and time.time() < end:
+            time.sleep(0.01)
+        assert [record['msg'] for record in self.batches[1]] == [["3"]]
+
+    def test_queue_full(self):
+        dropped = metrics.get("log_records_dropped")
+        shipper = LogShipper(post=self.post, queue_size=2, batch_size=10,
+                             flush_interval=60)
+        assert shipper.ship({'msg': []})
+        assert shipper.ship({'msg': []})
+        assert not shipper.ship({'msg': []})
+        assert metrics.get("log_records_dropped") == dropped + 1
+        assert shipper.pending() == 2
+
+    def test_sampling(self):
+        sampler = TopicSampler(rate=5, sample_rate=0)
+        kept = [sampler.keep("http://topic") for num in range(10)]
+        assert kept.count(True) in [5, 10]
+        assert sampler.keep("http://other")
+        assert sampler.keep(None)
+        assert TopicSampler(rate=0).keep("http://topic")
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestLogShipper))
+    return suite
@@ -0,0 +1,134 @@
+from resourcesync_push.metrics import Metrics, MetricsWriter, merge, \
+    render
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_counters(self):
+        metrics = Metrics(max_series=2)
+        metrics.incr("fetches")
+        metrics.incr("fetches", 2)
+        metrics.incr("publishes", labels={'topic': "http://t1"})
+        metrics.incr("publishes", labels={'topic': "http://t2"})
+        metrics.incr("publishes", labels={'topic': "http://t3"})
+        metrics.incr("publishes", labels={'topic': "http://t4"})
+        assert metrics.get("fetches") == 3
+        assert metrics.get("publishes", labels={'topic': "http://t1"}) == 1
+        # over max_series
+        assert metrics.get("publishes", labels={'topic': "_other"}) == 2
+        assert metrics.counters() == {"fetches": 3}
+
+        # reset in a forked process
+        metrics.pid = -1
+        metrics.incr("fetches")
+        assert metrics.get("fetches") == 1
+
+    def test_histograms(self):
+        metrics = Metrics()
+        metrics.observe("delivery_seconds", 0.002)
+        metrics.observe("delivery_seconds", 0.3)
+        metrics.observe("delivery_seconds", 60)
+        with metrics.timer("delivery_seconds"):
+            pass
+        name, labels, buckets, counts = metrics.snapshot()['histograms'][0]
+        assert counts[-1] == 4
+        assert sum(counts[:-2]) == 4
+        # over the last bucket
+        assert counts[-3] == 1
+
+        text = render(metrics.snapshot())
+        assert "# TYPE resourcesync_delivery_seconds histogram" in text
+        assert 'resourcesync_delivery_seconds_bucket{le="+Inf"} 4' in text
+        assert "resourcesync_delivery_seconds_count 4" in text
+
+    def test_merge(self):
+        first = Metrics()
+        second = Metrics()
+        for metrics in [first, second]:
+            metrics.incr("deliveries", labels={'host': "cb", 'status': "204"})
+            metrics.observe("fanout_seconds", 0.01)
+            metrics.set("fetches_pending", 2, aggregate="sum")
+        first.set("topic_subscribers", 5, labels={'topic': "http://t"})
+        second.set("topic_subscribers", 3, labels={'topic': "http://t"})
+
+        text = render(merge([json.loads(json.dumps(first.snapshot())),
+                             second.snapshot()]))
+        assert 'resourcesync_deliveries{host="cb",status="204"} 2' in text
+        assert "resourcesync_fanout_seconds_count 2" in text
+        assert "resourcesync_fetches_pending 4" in text
+        # the last value set
+        assert 'resourcesync_topic_subscribers{topic="http://t"} 3' in text
+
+    def test_writer(self):
+        other = Metrics()
+        other.incr("fetches", 2)
+        with open(os.path.join(self.tmp_dir, "1.json"), "w") as other_file:
+            json.dump(other.snapshot(), other_file)
+
+        metrics = Metrics()
+        metrics.incr("fetches")
+        writer = MetricsWriter(metrics, self.tmp_dir,
+                               collect=lambda: metrics.set("pending", 1))
+        text = render(writer.read_all())
+        assert "resourcesync_fetches 3" in text
+        assert "resourcesync_pending 1" in text
+        assert os.path.exists(writer.filename())
+
+        # the snapshot of a stopped writer is kept for the other workers
+        # to merge, and no longer written
+        writer.stop()
+        metrics.incr("fetches")
+        writer.write()
+        with open(writer.filename()) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        assert "resourcesync_fetches 1" in render(merge([snapshot]))
+
+    def test_stale_gauges(self):
+        other = Metrics()
+        other.incr("fetches", 2)
+        other.set("pending", 5, aggregate="sum")
+        filename = os.path.join(self.tmp_dir, "1.json")
+        with open(filename, "w") as other_file:
+            json.dump(other.snapshot(), other_file)
+
+        metrics = Metrics()
+        metrics.set("pending", 1, aggregate="sum")
+        writer = MetricsWriter(metrics, self.tmp_dir, interval=5)
+        assert "resourcesync_pending 6" in render(writer.read_all())
+
+        # not written for more than stale_intervals intervals
+        written = time.time() - 20
+        os.utime(filename, (written, written))
+        text = render(writer.read_all())
+        assert "resourcesync_pending 1" in text
+        assert "resourcesync_fetches 2" in text
+
+        # written by a process that is gone
+        process = subprocess.Popen(["true"])
+        process.wait()
+        os.rename(filename, os.path.join(self.tmp_dir,
+                                         "%s.json" % process.pid))
+        os.utime(os.path.join(self.tmp_dir, "%s.json" % process.pid), None)
+        text = render(writer.read_all())
+        assert "resourcesync_pending 1" in text
+        assert "resourcesync_fetches 2" in text
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestMetrics))
+    return suite
@@ -0,0 +1,110 @@
+from resourcesync_push.hub.patterns import TopicTrie, PatternIndex, \
+    is_pattern, valid_topic
+from resourcesync_push.hub.store import SQLiteStore
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class TestTopicTrie(unittest.TestCase):
+
+    def test_match(self):
+        trie = TopicTrie()
+        trie.insert("http://example.org/", 1)
+        trie.insert("http://example.org/dataset/", 2)
+        trie.insert("http://example.org/other/", 3)
+        trie.insert("", 4)
+        assert trie.size == 4
+        assert trie.match("http://example.org/dataset/1") == [
+            ("", 4), ("http://example.org/", 1),
+            ("http://example.org/dataset/", 2)]
+        assert trie.match("http://example.org/dataset/") == [
+            ("", 4), ("http://example.org/", 1),
+            ("http://example.org/dataset/", 2)]
+        assert trie.match("http://example.com/") == [("", 4)]
+
+    def test_remove(self):
+        trie = TopicTrie()
+        trie.insert("http://a/", 1)
+        trie.insert("http://a/b/", 2)
+        trie.remove("http://a/b/")
+        trie.remove("http://a/c/")
+        assert trie.size == 1
+        assert trie.get("http://a/b/") is None
+        assert trie.match("http://a/b/c") == [("http://a/", 1)]
+        trie.remove("http://a/")
+        assert trie.size == 0
+        assert trie.root == {}
+
+    def test_topics(self):
+        assert is_pattern("http://a/*")
+        assert not is_pattern("http://a/")
+        assert valid_topic("http://a/*")
+        assert valid_topic("http://a/")
+        assert not valid_topic("http://*/b")
+
+
+class TestPatternIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, "subscriptions.db")
+        self.store = SQLiteStore(self.db_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_subscribers(self):
+        lease = time.time() + 60
+        self.store.subscribe("http://a/*", "http://cb1", lease)
+        self.store.subscribe("http://a/b/*", "http://cb2", lease)
+        self.store.subscribe("http://a/b/c", "http://cb3", lease)
+        self.store.subscribe("http://a/c/*", "http://cb3", time.time() - 1)
+        index = PatternIndex(self.store)
+        assert index.size() == 2
+        assert index.get_subscribers("http://a/b/c") == {
+            "http://cb1": lease, "http://cb2": lease}
+        assert index.get_subscribers("http://a/c/d") == {"http://cb1": lease}
+        assert index.get_subscribers("http://b/") == {}
+
+    def test_subscribe(self):
+        lease = time.time() + 60
+        index = PatternIndex(self.store)
+        index.subscribe("http://a/*", "http://cb1", lease)
+        index.subscribe("http://a/*", "http://cb2", lease)
+        index.subscribe("http://b/*", "http://cb1", time.time() - 1)
+        assert index.get_subscribers("http://a/b") == {
+            "http://cb1": lease, "http://cb2": lease}
+        assert index.get_subscribers("http://b/c") == {}
+        index.unsubscribe("http://a/*", "http://cb1")
+        index.unsubscribe("http://a/*", "http://cb2")
+        index.unsubscribe("http://c/*", "http://cb2")
+        assert index.get_subscribers("http://a/b") == {}
+        assert index.size() == 1
+
+    def test_refresh(self):
+        lease = time.time() + 60
+        index = PatternIndex(self.store, interval=0.01)
+        index.start()
+        try:
+            # the subscription of another worker
+            SQLiteStore(self.db_file).subscribe("http://a/*", "http://cb1",
+                                                lease)
+            end = time.time() + 5
+            while not index.size() and time.time() < end:
+                time.sleep(0.01)
+            assert index.get_subscribers("http://a/b") == {
+                "http://cb1": lease}
+        finally:
+            index.stop()
+            index.join(5)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTopicTrie))
+    suite.addTest(unittest.makeSuite(TestPatternIndex))
+    return suite
@@ -0,0 +1,72 @@
+from resourcesync_push.profiling import Profiler, NULL_SPAN, PROFILING_ENV
+
+from concurrent.futures import Future
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {
+            'profiling': True,
+            'profiling_file': os.path.join(self.tmp_dir, "profiling.log"),
+            'profiling_max_bytes': 1000000,
+            'profiling_backups': 1,
+            'profile_every': 1,
+            'profile_dir': os.path.join(self.tmp_dir, "profiles"),
+        }
+        self.profiler = Profiler()
+
+    def tearDown(self):
+        self.profiler.configure({})
+        shutil.rmtree(self.tmp_dir)
+
+    def spans(self):
+        filename = "%s.%s" % (self.config['profiling_file'], os.getpid())
+        with open(filename) as spans_file:
+            return [json.loads(line) for line in spans_file]
+
+    def test_disabled(self):
+        self.profiler.configure(dict(self.config, profiling=False))
+        assert self.profiler.span("read_payload") is NULL_SPAN
+        with self.profiler.request("/publish"):
+            pass
+        assert not os.path.exists(self.config['profile_dir'])
+
+        os.environ[PROFILING_ENV] = "1"
+        try:
+            self.profiler.configure(dict(self.config, profiling=False))
+            assert self.profiler.enabled
+        finally:
+            del os.environ[PROFILING_ENV]
+
+    def test_spans(self):
+        self.profiler.configure(self.config)
+        future = Future()
+        with self.profiler.request("/publish"):
+            with self.profiler.span("read_payload", size=10):
+                pass
+            self.profiler.track("send", future, url="http://cb")
+        future.set_result(None)
+
+        spans = self.spans()
+        assert [span['span'] for span in spans] == ["read_payload",
+                                                    "request", "send"]
+        assert spans[0]['size'] == 10
+        assert spans[1]['path'] == "/publish"
+        assert spans[2]['url'] == "http://cb"
+        # the spans of a request share its id
+        assert spans[0]['request'] == spans[1]['request'] == \
+            spans[2]['request']
+        assert len(os.listdir(self.config['profile_dir'])) == 1
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestProfiler))
+    return suite
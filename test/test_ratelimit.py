@@ -0,0 +1,85 @@
+from resourcesync_push.hub.ratelimit import TokenBuckets, InflightBytes
+from resourcesync_push.hub.delivery import Delivery
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class FakeQueue(object):
+
+    def __init__(self, size):
+        self.size = size
+
+    def pending_bytes(self):
+        return self.size
+
+
+class TestTokenBuckets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "ratelimit.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_take(self):
+        buckets = TokenBuckets(slots=16)
+        assert buckets.take("a", 1, 2) == 0
+        assert buckets.take("a", 1, 2) == 0
+        wait = buckets.take("a", 1, 2)
+        assert 0 < wait <= 1
+        # the cost is capped to the burst
+        assert 0 < buckets.take("a", 1, 2, cost=5) <= 2
+
+    def test_refill(self):
+        buckets = TokenBuckets(slots=16)
+        assert buckets.take("a", 100, 1) == 0
+        assert buckets.take("a", 100, 1)
+        time.sleep(0.02)
+        assert buckets.take("a", 100, 1) == 0
+
+    def test_shared(self):
+        # the buckets of two workers
+        first = TokenBuckets(self.filename, slots=16)
+        second = TokenBuckets(self.filename, slots=16)
+        try:
+            assert first.take("a", 0.1, 1) == 0
+            assert second.take("a", 0.1, 1)
+            assert os.path.getsize(self.filename) == 16 * 16
+        finally:
+            first.close()
+            second.close()
+
+    def test_unwritable(self):
+        buckets = TokenBuckets(os.path.join(self.tmp_dir, "no", "file"),
+                               slots=16)
+        assert buckets.take("a", 1, 1) == 0
+        assert buckets.take("a", 1, 1)
+
+
+class TestInflightBytes(unittest.TestCase):
+
+    def test_value(self):
+        inflight = InflightBytes()
+        inflight.add(30)
+        inflight.done(Delivery("http://cb", "0123456789", {}), True)
+        assert inflight.value() == 20
+
+    def test_queue(self):
+        inflight = InflightBytes(queue=FakeQueue(100), interval=60)
+        inflight.add(10)
+        assert inflight.value() == 110
+        inflight.queue.size = 200
+        # until the next interval
+        assert inflight.value() == 110
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTokenBuckets))
+    suite.addTest(unittest.makeSuite(TestInflightBytes))
+    return suite
@@ -1,3 +1,4 @@
+import ConfigParser
 import unittest
 from resourcesync_push import ResourceSyncPuSH
 
@@ -60,6 +61,28 @@ class TestResourceSyncPuSH(unittest.TestCase):
         assert resourcesync_push.config.get('topic_url') is not None
         assert resourcesync_push.config.get('hub_url') is not None
 
+    def test_transport_config(self):
+        conf = ConfigParser.ConfigParser()
+        conf.add_section("general")
+        conf.set("general", "max_workers", "20")
+        conf.set("general", "read_timeout", "")
+        conf.add_section("hub")
+        conf.set("hub", "max_workers", "50")
+        conf.set("hub", "connect_timeout", "2.5")
+        conf.set("hub", "host_pool_maxsize", "a.org:30, b.org:8080:5")
+        resourcesync_push = ResourceSyncPuSH()
+        resourcesync_push.get_transport_config(conf, "hub")
+        transport = resourcesync_push.config['transport']
+        assert transport['max_workers'] == 50
+        assert transport['connect_timeout'] == 2.5
+        assert 'read_timeout' not in transport
+        assert transport['host_pool_maxsize'] == {'a.org': 30,
+                                                  'b.org:8080': 5}
+        assert resourcesync_push.transport.timeout == (2.5, None)
+        adapter = resourcesync_push.transport.session.get_adapter(
+            "https://a.org/callback")
+        assert adapter._pool_maxsize == 30
+
     def test_subscriber_config(self):
         resourcesync_push.get_config("subscriber")
         assert resourcesync_push.config.get('my_url') is not None
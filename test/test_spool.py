@@ -0,0 +1,73 @@
+from resourcesync_push.spool import read_body, BodyTooLarge, SpooledBody
+from resourcesync_push.transport import Transport
+from resourcesync_push.hub.evloop import EventLoopTransport
+from localserver import LocalSubscriber
+
+from StringIO import StringIO
+import unittest
+
+
+def environ(body, content_length=True):
+    env = {'wsgi.input': StringIO(body)}
+    if content_length:
+        env['CONTENT_LENGTH'] = str(len(body))
+    return env
+
+
+class TestSpool(unittest.TestCase):
+
+    def test_read_body(self):
+        assert read_body(environ("<urlset/>")) == "<urlset/>"
+        assert read_body(environ("")) == ""
+
+        body = "x" * 200000
+        spooled = read_body(environ(body), spool_size=1000)
+        assert isinstance(spooled, SpooledBody)
+        assert len(spooled) == 200000
+        assert str(spooled) == body
+        spooled = read_body(environ(body, content_length=False),
+                            spool_size=1000)
+        assert str(spooled) == body
+
+    def test_max_size(self):
+        body = "x" * 200000
+        with self.assertRaises(BodyTooLarge):
+            read_body(environ(body), max_size=1000)
+        # checked while reading a body of unknown length
+        with self.assertRaises(BodyTooLarge):
+            read_body(environ(body, content_length=False), max_size=1000)
+
+    def test_reader(self):
+        spooled = read_body(environ("0123456789"), spool_size=5)
+        reader = spooled.reader()
+        other = spooled.reader()
+        assert reader.read(4) == "0123"
+        assert other.read() == "0123456789"
+        assert reader.read() == "456789"
+        reader.seek(2)
+        assert reader.tell() == 2
+        assert reader.read(3) == "234"
+
+    def test_send(self):
+        subscriber = LocalSubscriber()
+        transport = Transport(max_workers=2)
+        engine = EventLoopTransport()
+        try:
+            body = "<urlset>%s</urlset>" % ("x" * 300000)
+            spooled = read_body(environ(body), spool_size=1000)
+            for send in [transport.send, engine.send]:
+                response = send(subscriber.url, data=spooled,
+                                headers={'Content-Length': str(len(body))})
+                assert response.result(timeout=10).status_code == 204
+            assert [received[2] for received
+                    in subscriber.wait(2)] == [body, body]
+        finally:
+            engine.stop()
+            transport.close()
+            subscriber.close()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSpool))
+    return suite
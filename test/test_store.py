@@ -0,0 +1,173 @@
+from resourcesync_push.hub.store import PickleStore, SQLiteStore, \
+    LeaseSweeper
+
+import cPickle
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class TestSubscriptionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pickle_file = os.path.join(self.tmp_dir, "subscriptions.pk")
+        self.db_file = os.path.join(self.tmp_dir, "subscriptions.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_store(self, store):
+        lease = time.time() + 60
+        assert store.get_subscribers("http://topic") == {}
+        assert store.subscribe("http://topic", "http://cb1", lease)
+        assert store.subscribe("http://topic", "http://cb2", lease)
+        assert store.subscribe("http://other", "http://cb1", lease)
+        # expired
+        assert store.subscribe("http://topic", "http://cb3", time.time() - 1)
+        assert store.get_subscribers("http://topic") == {
+            "http://cb1": lease, "http://cb2": lease}
+
+        assert store.unsubscribe("http://topic", "http://cb1")
+        assert store.get_subscribers("http://topic") == {"http://cb2": lease}
+        assert store.read_all() == {"http://topic": {"http://cb2": lease},
+                                    "http://other": {"http://cb1": lease}}
+
+        assert store.save_all({"http://new": {"http://cb4": lease}})
+        assert store.read_all() == {"http://new": {"http://cb4": lease}}
+
+        assert store.update([("subscribe", "http://new", "http://cb5", lease),
+                             ("subscribe", "http://bulk", "http://cb5", lease),
+                             ("unsubscribe", "http://new", "http://cb4")])
+        assert store.read_all() == {"http://new": {"http://cb5": lease},
+                                    "http://bulk": {"http://cb5": lease}}
+
+        assert store.read_patterns() == {}
+        assert store.subscribe("http://new/*", "http://cb6", lease)
+        assert store.subscribe("http://old/*", "http://cb6", time.time() - 1)
+        assert store.read_patterns() == {"http://new/*": {"http://cb6": lease}}
+
+        # changed by the wildcard subscriptions only
+        generation = store.pattern_generation()
+        assert store.subscribe("http://plain", "http://cb7", lease)
+        assert store.pattern_generation() == generation
+        assert store.unsubscribe("http://new/*", "http://cb6")
+        assert store.pattern_generation() != generation
+        assert store.read_patterns() == {}
+
+    def test_pickle_store(self):
+        open(self.pickle_file, "a").close()
+        store = PickleStore(self.pickle_file)
+        self.check_store(store)
+
+    def test_pickle_store_reload(self):
+        open(self.pickle_file, "a").close()
+        store = PickleStore(self.pickle_file)
+        other = PickleStore(self.pickle_file)
+        lease = time.time() + 60
+        assert store.get_subscribers("http://topic") == {}
+        other.subscribe("http://topic", "http://cb1", lease)
+        assert store.get_subscribers("http://topic") == {"http://cb1": lease}
+
+    def test_pickle_store_journal(self):
+        open(self.pickle_file, "a").close()
+        store = PickleStore(self.pickle_file)
+        other = PickleStore(self.pickle_file)
+        other.compact_size = 300
+        lease = time.time() + 60
+        for num in range(5):
+            assert other.subscribe("http://topic", "http://cb%s" % num,
+                                   lease)
+            # each write appends to the journal and is seen by the others
+            assert len(store.get_subscribers("http://topic")) == num + 1
+        # compacted into the snapshot
+        assert os.path.getsize(self.pickle_file) > 0
+        assert os.path.getsize(other.journal_file) < 300
+        other.unsubscribe("http://topic", "http://cb0")
+
+        # a partly written record is skipped
+        with open(store.journal_file, "ab") as journal:
+            journal.write('["subscribe", "http://topic", "http://cb9"')
+        assert len(store.get_subscribers("http://topic")) == 4
+        assert store.subscribe("http://topic", "http://cb8", lease)
+        assert len(PickleStore(self.pickle_file).get_subscribers(
+            "http://topic")) == 5
+
+    def test_sqlite_store(self):
+        store = SQLiteStore(self.db_file)
+        self.check_store(store)
+        plan = store.connection.execute(
+            "EXPLAIN QUERY PLAN SELECT topic, callback, lease \
+            FROM subscriptions WHERE topic LIKE '%*' AND lease > ?",
+            (time.time(),)).fetchall()
+        assert "subscriptions_patterns" in str(plan)
+
+    def test_sqlite_migration(self):
+        lease = time.time() + 60
+        with open(self.pickle_file, "wb") as sub_file:
+            cPickle.dump({"http://topic": {"http://cb1": lease,
+                                           "http://cb2": time.time() - 1},
+                          None: {"http://cb3": lease}}, sub_file)
+
+        store = SQLiteStore(self.db_file, pickle_file=self.pickle_file)
+        assert store.read_all() == {"http://topic": {"http://cb1": lease}}
+
+        # not migrated a second time
+        store.unsubscribe("http://topic", "http://cb1")
+        store = SQLiteStore(self.db_file, pickle_file=self.pickle_file)
+        assert store.read_all() == {}
+
+    def test_sqlite_non_ascii(self):
+        store = SQLiteStore(self.db_file)
+        lease = time.time() + 60
+        topic = "http://example.org/caf\xc3\xa9"
+        callback = "http://cb/\xe2\x98\x83"
+        assert store.subscribe(topic, callback, lease)
+        assert store.update([("subscribe", topic, "http://cb2", lease)])
+        assert store.get_subscribers(topic) == {callback: lease,
+                                                "http://cb2": lease}
+        assert store.read_all() == {topic: {callback: lease,
+                                            "http://cb2": lease}}
+
+    def test_sqlite_migration_non_ascii(self):
+        lease = time.time() + 60
+        with open(self.pickle_file, "wb") as sub_file:
+            cPickle.dump({"http://caf\xc3\xa9": {"http://cb1": lease},
+                          u"http://na\xefve": {u"http://cb\xe9": lease + 1}},
+                         sub_file)
+
+        store = SQLiteStore(self.db_file, pickle_file=self.pickle_file)
+        assert store.read_all() == {
+            "http://caf\xc3\xa9": {"http://cb1": lease},
+            "http://na\xc3\xafve": {"http://cb\xc3\xa9": lease + 1}}
+
+    def check_purge_expired(self, store):
+        lease = time.time() + 60
+        for num in range(5):
+            store.subscribe("http://topic", "http://cb%s" % num,
+                            time.time() - num - 1)
+        store.subscribe("http://topic", "http://cb9", lease)
+        # renewed
+        store.subscribe("http://topic", "http://cb0", lease)
+
+        sweeper = LeaseSweeper(store, batch_size=2)
+        assert store.purge_expired(1) == 1
+        assert sweeper.sweep() == 3
+        assert sweeper.sweep() == 0
+        assert store.read_all() == {"http://topic": {"http://cb0": lease,
+                                                     "http://cb9": lease}}
+
+    def test_pickle_purge_expired(self):
+        open(self.pickle_file, "a").close()
+        self.check_purge_expired(PickleStore(self.pickle_file))
+
+    def test_sqlite_purge_expired(self):
+        self.check_purge_expired(SQLiteStore(self.db_file))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSubscriptionStore))
+    return suite
@@ -0,0 +1,105 @@
+from resourcesync_push.hub.verifier import Verifier, VERIFIED, DECLINED, \
+    FAILED
+from resourcesync_push.metrics import metrics
+
+from concurrent.futures import Future
+import time
+import unittest
+import urlparse
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, content=""):
+        self.status_code = status_code
+        self.content = content
+
+
+class TestVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.updated = []
+        # callback -> list of the answers to its next challenges
+        self.answers = {}
+        self.verifier = Verifier(self.send, self.update, workers=2,
+                                 max_pending=3, timeout=1, max_attempts=3,
+                                 retry_delay=0.01)
+
+    def tearDown(self):
+        self.verifier.stop()
+
+    def send(self, url, method='POST', **kwargs):
+        assert method == 'GET'
+        callback, query = url.split("?", 1)
+        query = urlparse.parse_qs(query)
+        future = Future()
+        answer = self.answers.get(callback, ["echo"]).pop(0)
+        if answer == "echo":
+            future.set_result(FakeResponse(
+                content=query['hub.challenge'][0]))
+        elif answer == "error":
+            future.set_exception(IOError("Connection refused"))
+        else:
+            future.set_result(answer)
+        return future
+
+    def update(self, request):
+        self.updated.append((request['mode'], request['callback']))
+        return True
+
+    def request(self, callback, mode="subscribe"):
+        return {'mode': mode, 'topic': "http://example.com/topic",
+                'callback': callback, 'lease': 60}
+
+    def wait(self, timeout=5):
+        end = time.time() + timeout
+        while self.verifier.pending() and time.time() < end:
+            time.sleep(0.01)
+
+    def test_check(self):
+        self.answers["http://cb2"] = [FakeResponse(content="no")]
+        self.answers["http://cb3"] = [FakeResponse(status_code=503)]
+        self.answers["http://cb4"] = ["error"]
+        assert self.verifier.check(self.request("http://cb1")) == VERIFIED
+        assert self.verifier.check(self.request("http://cb2")) == DECLINED
+        assert self.verifier.check(self.request("http://cb3")) == FAILED
+        assert self.verifier.check(self.request("http://cb4")) == FAILED
+
+    def test_submit(self):
+        declined = metrics.get("verifications", {'result': "declined"})
+        self.answers["http://cb2"] = [FakeResponse(status_code=404)]
+        assert self.verifier.submit(self.request("http://cb1"))
+        assert self.verifier.submit(self.request("http://cb2",
+                                                 mode="unsubscribe"))
+        self.wait()
+        assert self.updated == [("subscribe", "http://cb1")]
+        assert metrics.get("verifications",
+                           {'result': "declined"}) == declined + 1
+
+    def test_retry(self):
+        failed = metrics.get("verifications", {'result': "failed"})
+        self.answers["http://cb1"] = ["error", FakeResponse(status_code=500),
+                                      "echo"]
+        self.answers["http://cb2"] = ["error", "error", "error"]
+        assert self.verifier.submit(self.request("http://cb1"))
+        assert self.verifier.submit(self.request("http://cb2"))
+        self.wait()
+        assert self.updated == [("subscribe", "http://cb1")]
+        assert self.answers["http://cb2"] == []
+        assert metrics.get("verifications",
+                           {'result': "failed"}) == failed + 1
+
+    def test_max_pending(self):
+        rejected = metrics.get("verifications_rejected")
+        self.answers["http://cb1"] = ["error"] * 9
+        self.verifier.retry_delay = 1
+        for num in range(3):
+            assert self.verifier.submit(self.request("http://cb1"))
+        assert not self.verifier.submit(self.request("http://cb2"))
+        assert metrics.get("verifications_rejected") == rejected + 1
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestVerifier))
+    return suite